@@ -0,0 +1,241 @@
+"""Local stand-in for the Spotify Web API endpoints ZSpotify calls.
+
+The catalog is generated: playlists, albums and artists are numbered and
+every id is a valid 22 character base62 id, so the usual open.spotify.com
+urls resolve. Latency and 429 responses are injected per request.
+"""
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def make_id(kind, number):
+    return f"{kind}{number:0>20}"
+
+
+def _number(spotify_id):
+    return int(spotify_id[2:])
+
+
+class Catalog:
+    """Albums of album_size tracks, by artists of albums_per_artist albums.
+
+    Playlists hold playlist_size tracks taken across albums, shifted by
+    overlap tracks, so consecutive playlists share tracks with each other.
+    """
+
+    def __init__(self, album_size=12, albums_per_artist=4, playlist_size=50, overlap=10):
+        self.album_size = album_size
+        self.albums_per_artist = albums_per_artist
+        self.playlist_size = playlist_size
+        self.overlap = overlap
+
+    def album_of(self, track_number):
+        return track_number // self.album_size
+
+    def artist_of(self, album_number):
+        return album_number // self.albums_per_artist
+
+    def track(self, number, base_url):
+        album = self.album_of(number)
+        artist = self.artist_of(album)
+        return {
+            "id": make_id("tr", number),
+            "name": f"Track {number}",
+            "artists": [{"id": make_id("ar", artist), "name": f"Artist {artist}"}],
+            "album": {
+                "id": make_id("al", album),
+                "name": f"Album {album}",
+                "artists": [{"id": make_id("ar", artist), "name": f"Artist {artist}"}],
+                "images": [
+                    {"url": f"{base_url}/images/{album}.jpg", "height": 64, "width": 64}
+                ],
+                "release_date": f"{2000 + album % 25}-01-01",
+            },
+            "disc_number": 1,
+            "track_number": number % self.album_size + 1,
+            "duration_ms": 30_000,
+            "explicit": False,
+            "is_playable": True,
+        }
+
+    def album(self, number):
+        artist = self.artist_of(number)
+        return {
+            "id": make_id("al", number),
+            "name": f"Album {number}",
+            "artists": [{"id": make_id("ar", artist), "name": f"Artist {artist}"}],
+            "release_date": f"{2000 + number % 25}-01-01",
+            "total_tracks": self.album_size,
+        }
+
+    def album_tracks(self, number):
+        first = number * self.album_size
+        return list(range(first, first + self.album_size))
+
+    def playlist_tracks(self, number):
+        step = self.playlist_size - self.overlap
+        first = number * step
+        return list(range(first, first + self.playlist_size))
+
+
+class FakeWebAPI:
+    def __init__(
+        self,
+        catalog=None,
+        latency=0.0,
+        rate_limit_probability=0.0,
+        retry_after=0,
+        seed=0,
+        host="127.0.0.1",
+        port=0,
+    ):
+        self.catalog = catalog or Catalog()
+        self.latency = latency
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "rate_limited": 0, "images": 0, "by_endpoint": {}}
+        self._cover = None
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self):
+        return f"{self.base_url}/v1/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def cover(self):
+        if self._cover is None:
+            from PIL import Image
+
+            buffer = io.BytesIO()
+            Image.new("RGB", (64, 64), (30, 215, 96)).save(buffer, "JPEG")
+            self._cover = buffer.getvalue()
+        return self._cover
+
+    def count(self, endpoint):
+        """Counts a request, returns True if it should be answered with a 429"""
+        with self._lock:
+            self.stats["requests"] += 1
+            by_endpoint = self.stats["by_endpoint"]
+            by_endpoint[endpoint] = by_endpoint.get(endpoint, 0) + 1
+            limited = (
+                self.rate_limit_probability > 0
+                and self._random.random() < self.rate_limit_probability
+            )
+            if limited:
+                self.stats["rate_limited"] += 1
+            return limited
+
+    def route(self, path, query):
+        """Returns (endpoint name, json body) of an API path, or None"""
+        catalog = self.catalog
+        parts = path.strip("/").split("/")[1:]
+        limit = int(query.get("limit", ["50"])[0])
+        offset = int(query.get("offset", ["0"])[0])
+
+        def page(items):
+            return {"items": items[offset:offset + limit], "total": len(items)}
+
+        if parts == ["tracks"]:
+            ids = query.get("ids", [""])[0].split(",")
+            return "tracks", {"tracks": [catalog.track(_number(i), self.base_url) for i in ids]}
+        if len(parts) == 2 and parts[0] == "playlists":
+            number = _number(parts[1])
+            return "playlist", {
+                "name": f"Playlist {number}",
+                "owner": {"display_name": "benchmark"},
+                "snapshot_id": f"snapshot-{number}",
+            }
+        if len(parts) == 3 and parts[0] == "playlists" and parts[2] == "tracks":
+            tracks = catalog.playlist_tracks(_number(parts[1]))
+            return "playlist_tracks", page(
+                [{"track": catalog.track(n, self.base_url)} for n in tracks]
+            )
+        if len(parts) == 2 and parts[0] == "albums":
+            return "album", catalog.album(_number(parts[1]))
+        if len(parts) == 3 and parts[0] == "albums" and parts[2] == "tracks":
+            tracks = [catalog.track(n, self.base_url) for n in catalog.album_tracks(_number(parts[1]))]
+            return "album_tracks", page(
+                [
+                    {
+                        "id": t["id"],
+                        "name": t["name"],
+                        "track_number": t["track_number"],
+                        "disc_number": t["disc_number"],
+                        "duration_ms": t["duration_ms"],
+                    }
+                    for t in tracks
+                ]
+            )
+        if len(parts) == 2 and parts[0] == "artists":
+            number = _number(parts[1])
+            return "artist", {"id": parts[1], "name": f"Artist {number}", "genres": []}
+        if len(parts) == 3 and parts[0] == "artists" and parts[2] == "albums":
+            first = _number(parts[1]) * catalog.albums_per_artist
+            return "artist_albums", page(
+                [catalog.album(n) for n in range(first, first + catalog.albums_per_artist)]
+            )
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        api = self.server.api
+        url = urlparse(self.path)
+        if url.path.startswith("/images/"):
+            with api._lock:
+                api.stats["images"] += 1
+            self._send(200, api.cover(), "image/jpeg")
+            return
+
+        routed = api.route(url.path, parse_qs(url.query)) if url.path.startswith("/v1/") else None
+        if routed is None:
+            self._send(404, b'{"error": {"status": 404, "message": "Not found"}}')
+            return
+        endpoint, body = routed
+        if api.latency:
+            time.sleep(api.latency)
+        if api.count(endpoint):
+            self._send(
+                429,
+                b'{"error": {"status": 429, "message": "API rate limit exceeded"}}',
+                headers={"Retry-After": str(api.retry_after)},
+            )
+            return
+        self._send(200, json.dumps(body).encode())
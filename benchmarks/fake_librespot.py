@@ -0,0 +1,218 @@
+"""Offline stand-in for the parts of librespot ZSpotify uses.
+
+install() registers fake librespot modules before zspotify is imported, so
+logins always succeed and content_feeder().load() returns synthetic Ogg
+Vorbis streams served at a configurable rate, with stalls and failures.
+"""
+import hashlib
+import random
+import struct
+import sys
+import time
+import types
+from io import BytesIO
+
+from mutagen.ogg import OggPage
+
+
+class StreamConfig:
+    def __init__(
+        self,
+        rate=0,
+        track_seconds=30,
+        bitrate=160_000,
+        stall_probability=0.0,
+        stall_seconds=1.0,
+        read_failure_probability=0.0,
+        load_failure_probability=0.0,
+        seed=0,
+    ):
+        # Bytes per second, 0 serves as fast as the reader asks
+        self.rate = rate
+        self.track_seconds = track_seconds
+        self.bitrate = bitrate
+        self.stall_probability = stall_probability
+        self.stall_seconds = stall_seconds
+        self.read_failure_probability = read_failure_probability
+        self.load_failure_probability = load_failure_probability
+        self.seed = seed
+
+
+def make_ogg(seconds, bitrate, seed, sample_rate=44100, page_size=4096):
+    """Builds an Ogg Vorbis file with valid headers and random audio packets.
+
+    It parses and tags like a real download (mutagen, music_tag), but it
+    does not decode, so benchmarks keep the default ogg output format.
+    """
+    rng = random.Random(seed)
+    serial = rng.getrandbits(31)
+    identification = (
+        b"\x01vorbis"
+        + struct.pack("<IBIiii", 0, 2, sample_rate, 0, bitrate, 0)
+        + bytes([0xB8, 1])
+    )
+    vendor = b"zspotify-benchmarks"
+    comment = b"\x03vorbis" + struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", 0) + b"\x01"
+    setup = b"\x05vorbis" + rng.randbytes(256)
+
+    pages = []
+    page = OggPage()
+    page.serial, page.sequence, page.first, page.packets = serial, 0, True, [identification]
+    pages.append(page)
+    page = OggPage()
+    page.serial, page.sequence, page.packets = serial, 1, [comment, setup]
+    pages.append(page)
+
+    count = max(1, seconds * bitrate // 8 // page_size)
+    for i in range(count):
+        page = OggPage()
+        page.serial = serial
+        page.sequence = 2 + i
+        page.position = (i + 1) * sample_rate * seconds // count
+        page.packets = [rng.randbytes(page_size)]
+        page.last = i == count - 1
+        pages.append(page)
+    return b"".join(page.write() for page in pages)
+
+
+class _Stream:
+    def __init__(self, data, config, rng):
+        self._data = BytesIO(data)
+        self._config = config
+        self._rng = rng
+
+    def read(self, size):
+        config = self._config
+        if config.stall_probability and self._rng.random() < config.stall_probability:
+            time.sleep(config.stall_seconds)
+        if (
+            config.read_failure_probability
+            and self._rng.random() < config.read_failure_probability
+        ):
+            return b""
+        data = self._data.read(size)
+        if config.rate:
+            time.sleep(len(data) / config.rate)
+        return data
+
+
+class _InputStream:
+    def __init__(self, data, config, rng):
+        self.size = len(data)
+        self._stream = _Stream(data, config, rng)
+
+    def stream(self):
+        return self._stream
+
+
+class _LoadedStream:
+    def __init__(self, data, config, rng):
+        self.input_stream = _InputStream(data, config, rng)
+
+
+class StatusCodeException(Exception):
+    pass
+
+
+class FakeContentFeeder:
+    def __init__(self, config, stats):
+        self.config = config
+        self.stats = stats
+
+    def load(self, playable_id, audio_quality, preload, halt_listener):
+        digest = hashlib.sha1(f"{self.config.seed}:{playable_id.base62}".encode()).digest()
+        seed = int.from_bytes(digest[:8], "big")
+        rng = random.Random(seed)
+        self.stats["loads"] += 1
+        if (
+            self.config.load_failure_probability
+            and rng.random() < self.config.load_failure_probability
+        ):
+            self.stats["load_failures"] += 1
+            raise RuntimeError(f"Simulated load failure of {playable_id.base62}")
+        data = make_ogg(self.config.track_seconds, self.config.bitrate, seed)
+        self.stats["bytes"] += len(data)
+        return _LoadedStream(data, self.config, rng)
+
+
+class _Tokens:
+    def get(self, scope):
+        return f"benchmark-token-{scope}"
+
+
+class FakeSession:
+    config = StreamConfig()
+    stats = {"sessions": 0, "loads": 0, "load_failures": 0, "bytes": 0}
+
+    def __init__(self):
+        FakeSession.stats["sessions"] += 1
+        self._feeder = FakeContentFeeder(self.config, self.stats)
+
+    def tokens(self):
+        return _Tokens()
+
+    def get_user_attribute(self, name):
+        return "premium" if name == "type" else None
+
+    def content_feeder(self):
+        return self._feeder
+
+    class Builder:
+        def stored_file(self, stored_credentials=None):
+            return self
+
+        def user_pass(self, username, password):
+            return self
+
+        def create(self):
+            return FakeSession()
+
+
+class _PlayableId:
+    def __init__(self, base62):
+        self.base62 = base62
+
+    @classmethod
+    def from_base62(cls, base62):
+        return cls(base62)
+
+
+class AudioQuality:
+    NORMAL = "NORMAL"
+    HIGH = "HIGH"
+    VERY_HIGH = "VERY_HIGH"
+
+
+class VorbisOnlyAudioQuality:
+    def __init__(self, preferred):
+        self.preferred = preferred
+
+
+def install(config):
+    """Registers the fake librespot modules, must run before zspotify is imported"""
+    FakeSession.config = config
+
+    modules = {
+        name: types.ModuleType(name)
+        for name in (
+            "librespot",
+            "librespot.core",
+            "librespot.audio",
+            "librespot.audio.decoders",
+            "librespot.metadata",
+        )
+    }
+    modules["librespot.core"].Session = FakeSession
+    modules["librespot.core"].ApiClient = types.SimpleNamespace(
+        StatusCodeException=StatusCodeException
+    )
+    modules["librespot.audio.decoders"].AudioQuality = AudioQuality
+    modules["librespot.audio.decoders"].VorbisOnlyAudioQuality = VorbisOnlyAudioQuality
+    modules["librespot.metadata"].TrackId = type("TrackId", (_PlayableId,), {})
+    modules["librespot.metadata"].EpisodeId = type("EpisodeId", (_PlayableId,), {})
+    modules["librespot"].core = modules["librespot.core"]
+    modules["librespot"].audio = modules["librespot.audio"]
+    modules["librespot"].metadata = modules["librespot.metadata"]
+    modules["librespot.audio"].decoders = modules["librespot.audio.decoders"]
+    sys.modules.update(modules)
+    return FakeSession.stats
@@ -0,0 +1,67 @@
+"""Startup budget check: fails when importing zspotify gets slow again.
+
+Imports zspotify.__main__ in a fresh interpreter with -X importtime. The
+check fails when one of the heavy dependencies is imported at startup, or
+when the cumulative import time exceeds the budget:
+
+    python benchmarks/import_time.py --budget-ms 150
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Only needed once a download starts, see respot.py, tagger.py and loudness.py
+HEAVY_MODULES = ("librespot", "pydub", "tqdm", "music_tag", "mutagen", "requests", "numpy")
+
+
+def measure(module="zspotify.__main__", runs=5):
+    """Returns the best cumulative import time in ms and the imported top-level modules"""
+    best = None
+    imported = set()
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stderr
+        for line in output.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line.split("|")
+            name = name.strip()
+            imported.add(name.split(".")[0])
+            if name == module and cumulative.strip().isdigit():
+                microseconds = int(cumulative)
+                best = microseconds if best is None else min(best, microseconds)
+    return (best or 0) / 1000, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--budget-ms", type=float, default=150, help="Cumulative import time allowed"
+    )
+    parser.add_argument("--runs", type=int, default=5, help="Best of this many imports")
+    options = parser.parse_args()
+
+    milliseconds, imported = measure(runs=options.runs)
+    heavy = sorted(m for m in HEAVY_MODULES if m in imported)
+    print(f"zspotify.__main__ imports in {milliseconds:.1f} ms (budget {options.budget_ms:.0f} ms)")
+
+    failed = False
+    if heavy:
+        failed = True
+        print(f"FAILED: imported at startup: {', '.join(heavy)}")
+    if milliseconds > options.budget_ms:
+        failed = True
+        print("FAILED: over budget")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Reservation check: fails when a crashed process on another host stalls a track.
+
+Leaves a reservation of another host in a shared archive, as a container
+that crashed mid-download does, and times how long reserve() takes to get
+the track. A reservation whose owner is alive and keeps touching it must
+still be waited for. The timeouts are scaled down to keep the check short:
+
+    python benchmarks/reservations.py --stale 2
+"""
+import argparse
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from zspotify import utils  # noqa: E402
+
+
+def crashed_takeover(directory):
+    """Seconds reserve() waits for a track reserved by a crashed process of another host"""
+    archive = utils.Archive(directory / "crashed")
+    archive.reservations.mkdir(parents=True, exist_ok=True)
+    (archive.reservations / "track").write_text("other-host+4242")
+    start = time.monotonic()
+    archive.reserve("track")
+    elapsed = time.monotonic() - start
+    archive.release("track")
+    archive.close()
+    return elapsed
+
+
+def live_owner_waited(directory, hold):
+    """Whether reserve() waits for a live owner of another host that holds the track for hold seconds"""
+    owner = utils.Archive(directory / "live")
+    owner._owner = "other-host+4242"
+    owner.reserve("track")
+    waiter = utils.Archive(directory / "live")
+    got = threading.Event()
+
+    def take():
+        waiter.reserve("track")
+        got.set()
+
+    thread = threading.Thread(target=take, daemon=True)
+    thread.start()
+    waited = not got.wait(hold)
+    owner.release("track")
+    thread.join(hold)
+    waiter.release("track")
+    owner.close()
+    waiter.close()
+    return waited and got.is_set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--stale", type=float, default=2, help="RESERVATION_STALE to check with, in seconds"
+    )
+    options = parser.parse_args()
+    utils.RESERVATION_STALE = options.stale
+    utils.RESERVATION_HEARTBEAT = options.stale / 6
+    utils.RESERVATION_POLL = options.stale / 20
+    budget = options.stale + 2 * utils.RESERVATION_HEARTBEAT
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        elapsed = crashed_takeover(Path(tmp))
+        print(f"Crashed foreign reservation taken over in {elapsed:.1f} s (budget {budget:.1f} s)")
+        if elapsed > budget:
+            failed = True
+            print("FAILED: over budget")
+        if not live_owner_waited(Path(tmp), 3 * options.stale):
+            failed = True
+            print("FAILED: took over the reservation of a live owner")
+        else:
+            print("Live foreign reservation waited for")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
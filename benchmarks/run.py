@@ -0,0 +1,278 @@
+"""End-to-end download benchmarks that need no account and no network.
+
+Every scenario runs ZSpotify in a child process against a fake librespot
+session and a local Web API stand-in, then reports tracks per minute, peak
+RSS and Web API calls per track. Thresholds turn it into a CI check:
+
+    python benchmarks/run.py --min-tracks-per-minute 600 --max-api-calls-per-track 1.5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCHMARKS_DIR.parent
+
+sys.path.insert(0, str(BENCHMARKS_DIR))
+
+from fake_api import Catalog, FakeWebAPI, make_id  # noqa: E402
+
+SCENARIOS = ("playlist", "album", "bulk")
+
+
+def scenario_args(scenario, options, workdir):
+    """Returns the ZSpotify command line of a scenario"""
+    playlists = [make_id("pl", n) for n in range(options.playlists)]
+    albums = [make_id("al", n) for n in range(options.albums)]
+    if scenario == "playlist":
+        return ["--playlist", ",".join(playlists)]
+    if scenario == "album":
+        return ["--album", ",".join(albums)]
+    if scenario == "bulk":
+        urls_file = workdir / "urls.txt"
+        urls = [f"https://open.spotify.com/playlist/{p}" for p in playlists]
+        urls += [f"https://open.spotify.com/album/{a}" for a in albums]
+        urls_file.write_text("\n".join(urls) + "\n")
+        return ["--bulk-download", str(urls_file), "--workers", str(options.workers)]
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+def common_args(options):
+    """Returns the ZSpotify options every scenario runs with"""
+    args = []
+    if options.max_bandwidth:
+        args += ["--max-bandwidth", options.max_bandwidth]
+    if options.memory_budget:
+        args += ["--memory-budget", str(options.memory_budget)]
+    return args
+
+
+def peak_rss_mb():
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def run_child(options):
+    """Runs one scenario in this process and writes its result file"""
+    from fake_librespot import StreamConfig, install
+
+    stream_stats = install(StreamConfig(**json.loads(options.stream)))
+    sys.path.insert(0, str(REPO_ROOT))
+    from zspotify.__main__ import ZSpotify
+
+    workdir = Path(options.workdir)
+    config_dir = workdir / "config"
+    config_dir.mkdir(parents=True, exist_ok=True)
+    credentials = config_dir / "credentials.json"
+    credentials.write_text("{}")
+    trace_file = workdir / "trace.jsonl"
+
+    sys.argv = [
+        "zspotify",
+        "--config-dir", str(config_dir),
+        "--download-dir", str(workdir / "downloads"),
+        "--music-dir", str(workdir / "downloads"),
+        "--episodes-dir", str(workdir / "downloads" / "episodes"),
+        "--credentials-file", str(credentials),
+        "--antiban-time", "0",
+        "--antiban-album", "0",
+        "--audio-format", options.audio_format,
+        "--trace", str(trace_file),
+        *json.loads(options.args),
+    ]
+    zspotify = ZSpotify()
+    start = time.monotonic()
+    zspotify.start()
+    elapsed = time.monotonic() - start
+
+    results = {}
+    with open(trace_file, encoding="utf-8") as f:
+        for line in f:
+            result = json.loads(line).get("result", "unknown")
+            results[result] = results.get(result, 0) + 1
+
+    with open(options.result, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "seconds": elapsed,
+                "results": results,
+                "peak_rss_mb": peak_rss_mb(),
+                "stream": stream_stats,
+            },
+            f,
+        )
+
+
+def run_scenario(scenario, options):
+    catalog = Catalog(
+        album_size=options.album_size,
+        playlist_size=options.playlist_size,
+        overlap=options.playlist_overlap,
+    )
+    api = FakeWebAPI(
+        catalog,
+        latency=options.api_latency,
+        rate_limit_probability=options.rate_limit_probability,
+        seed=options.seed,
+    ).start()
+    stream = {
+        "rate": options.stream_rate,
+        "track_seconds": options.track_seconds,
+        "stall_probability": options.stall_probability,
+        "stall_seconds": options.stall_seconds,
+        "read_failure_probability": options.read_failure_probability,
+        "load_failure_probability": options.load_failure_probability,
+        "seed": options.seed,
+    }
+    try:
+        with tempfile.TemporaryDirectory(prefix=f"zspotify-bench-{scenario}-") as tmp:
+            workdir = Path(tmp)
+            result_file = workdir / "result.json"
+            command = [
+                sys.executable,
+                str(Path(__file__).resolve()),
+                "--child",
+                "--workdir", str(workdir),
+                "--result", str(result_file),
+                "--audio-format", options.audio_format,
+                "--stream", json.dumps(stream),
+                "--args", json.dumps(
+                    scenario_args(scenario, options, workdir) + common_args(options)
+                ),
+            ]
+            env = dict(os.environ, ZSPOTIFY_API_URL=api.api_url)
+            output = None if options.verbose else subprocess.DEVNULL
+            subprocess.run(command, env=env, stdout=output, stderr=output, check=True)
+            child = json.loads(result_file.read_text())
+    finally:
+        api.stop()
+
+    completed = child["results"].get("completed", 0)
+    return {
+        "scenario": scenario,
+        "tracks": sum(child["results"].values()),
+        "results": child["results"],
+        "seconds": round(child["seconds"], 3),
+        "tracks_per_minute": round(completed / child["seconds"] * 60, 1) if child["seconds"] else 0,
+        "peak_rss_mb": round(child["peak_rss_mb"], 1),
+        "api_calls": api.stats["requests"],
+        "api_calls_per_track": round(api.stats["requests"] / completed, 2) if completed else None,
+        "rate_limited": api.stats["rate_limited"],
+        "api_calls_by_endpoint": api.stats["by_endpoint"],
+        "downloaded_mb": round(child["stream"]["bytes"] / (1 << 20), 1),
+    }
+
+
+def check(report, options):
+    """Returns the threshold violations of a scenario report"""
+    failures = []
+    if options.min_tracks_per_minute and report["tracks_per_minute"] < options.min_tracks_per_minute:
+        failures.append(f"{report['tracks_per_minute']} tracks/min < {options.min_tracks_per_minute}")
+    if options.max_rss_mb and report["peak_rss_mb"] > options.max_rss_mb:
+        failures.append(f"peak RSS {report['peak_rss_mb']} MB > {options.max_rss_mb} MB")
+    calls = report["api_calls_per_track"]
+    if options.max_api_calls_per_track and (calls is None or calls > options.max_api_calls_per_track):
+        failures.append(f"{calls} API calls/track > {options.max_api_calls_per_track}")
+    return failures
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "scenarios", nargs="*", help=f"Scenarios to run: {', '.join(SCENARIOS)} (default: all)"
+    )
+    parser.add_argument("--playlists", type=int, default=2, help="Playlists per scenario")
+    parser.add_argument("--playlist-size", type=int, default=50)
+    parser.add_argument(
+        "--playlist-overlap", type=int, default=10,
+        help="Tracks consecutive playlists have in common",
+    )
+    parser.add_argument("--albums", type=int, default=4, help="Albums per scenario")
+    parser.add_argument("--album-size", type=int, default=12)
+    parser.add_argument("--workers", type=int, default=4, help="Workers of the bulk scenario")
+    parser.add_argument("--audio-format", default="ogg")
+    parser.add_argument("--track-seconds", type=int, default=30, help="Length of the synthetic tracks")
+    parser.add_argument(
+        "--stream-rate", type=float, default=0,
+        help="Audio bytes per second per stream, 0 for unlimited",
+    )
+    parser.add_argument(
+        "--max-bandwidth", help="Passed to ZSpotify, caps all streams together, e.g. 2M"
+    )
+    parser.add_argument(
+        "--memory-budget", type=int, help="Passed to ZSpotify, MB of audio held in memory"
+    )
+    parser.add_argument("--stall-probability", type=float, default=0.0, help="Per audio read")
+    parser.add_argument("--stall-seconds", type=float, default=1.0)
+    parser.add_argument(
+        "--read-failure-probability", type=float, default=0.0,
+        help="Per audio read, an empty read the client retries",
+    )
+    parser.add_argument(
+        "--load-failure-probability", type=float, default=0.0,
+        help="Per track, the stream fails to open",
+    )
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Seconds per Web API request")
+    parser.add_argument(
+        "--rate-limit-probability", type=float, default=0.0,
+        help="Per Web API request, answered with a 429",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--min-tracks-per-minute", type=float)
+    parser.add_argument("--max-rss-mb", type=float)
+    parser.add_argument("--max-api-calls-per-track", type=float)
+    parser.add_argument("--verbose", action="store_true", help="Show the output of ZSpotify")
+
+    # Used by the child process that runs a scenario
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    parser.add_argument("--stream", help=argparse.SUPPRESS)
+    parser.add_argument("--args", help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    for scenario in options.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario: {scenario}")
+    options.scenarios = options.scenarios or list(SCENARIOS)
+    return options
+
+
+def main():
+    options = parse_args()
+    if options.child:
+        run_child(options)
+        return
+
+    reports = []
+    failed = False
+    print(f"{'SCENARIO':<10}{'TRACKS':>8}{'TRACKS/MIN':>12}{'PEAK RSS':>11}{'API/TRACK':>11}{'429S':>6}")
+    for scenario in options.scenarios:
+        report = run_scenario(scenario, options)
+        report["failures"] = check(report, options)
+        reports.append(report)
+        print(
+            f"{scenario:<10}{report['tracks']:>8}{report['tracks_per_minute']:>12}"
+            f"{report['peak_rss_mb']:>8} MB{report['api_calls_per_track'] or '-':>11}"
+            f"{report['rate_limited']:>6}"
+        )
+        for failure in report["failures"]:
+            failed = True
+            print(f"    FAILED: {failure}")
+
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=4)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
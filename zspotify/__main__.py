@@ -1,19 +1,49 @@
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import signal
+import socket
 import sys
+import threading
 import time
 from getpass import getpass
 from pathlib import Path
 import importlib.metadata as metadata
+import importlib.util
 
 try:
     from respot import Respot, RespotUtils
     from tagger import AudioTagger
-    from utils import FormatUtils, Archive
+    from utils import FormatUtils, Archive, FileIndex, SyncState
+    from verify import LibraryVerifier
+    from jobs import JobQueue, Scheduler, PENDING, IN_PROGRESS, DONE, FAILED
+    from jobs import INTERACTIVE, COLLECTION, BULK, COORDINATOR_HEARTBEAT
+    from server import JobServer
+    from store import ContentStore, LINK_MODES, SOURCE_EXTENSIONS, place
+    from staging import StagingArea, finalize
+    from cache import SourceCache
+    from planner import DownloadPlan, unique_inputs, output_bitrate, estimate_bytes
+    from planner import free_space, filesystem, ESTIMATED_STREAM_RATE
+    from metrics import METRICS, TRACKS, TextfileWriter, job_type, stage
+    from tracing import TRACE, print_summary
+    from throttle import parse_rate
 except ImportError:
     from .respot import Respot, RespotUtils
     from .tagger import AudioTagger
-    from .utils import FormatUtils, Archive
+    from .utils import FormatUtils, Archive, FileIndex, SyncState
+    from .verify import LibraryVerifier
+    from .jobs import JobQueue, Scheduler, PENDING, IN_PROGRESS, DONE, FAILED
+    from .jobs import INTERACTIVE, COLLECTION, BULK, COORDINATOR_HEARTBEAT
+    from .server import JobServer
+    from .store import ContentStore, LINK_MODES, SOURCE_EXTENSIONS, place
+    from .staging import StagingArea, finalize
+    from .cache import SourceCache
+    from .planner import DownloadPlan, unique_inputs, output_bitrate, estimate_bytes
+    from .planner import free_space, filesystem, ESTIMATED_STREAM_RATE
+    from .metrics import METRICS, TRACKS, TextfileWriter, job_type, stage
+    from .tracing import TRACE, print_summary
+    from .throttle import parse_rate
 
 _ANTI_BAN_WAIT_TIME = os.environ.get("ANTI_BAN_WAIT_TIME", 5)
 _ANTI_BAN_WAIT_TIME_ALBUMS = os.environ.get("ANTI_BAN_WAIT_TIME_ALBUMS", 30)
@@ -25,6 +55,14 @@ except metadata.PackageNotFoundError:
     __version__ = "unknown"
 
 
+def _format_dir(value):
+    """Parses FORMAT=DIR of --also-format"""
+    audio_format, _, directory = value.partition("=")
+    if audio_format not in ("mp3", "ogg") or not directory:
+        raise argparse.ArgumentTypeError(f"expected mp3=DIR or ogg=DIR, got {value}")
+    return audio_format, Path(directory).expanduser()
+
+
 class ZSpotify:
     def __init__(self):
         self.SEPARATORS = [",", ";"]
@@ -35,6 +73,17 @@ class ZSpotify:
             credentials=Path(self.args.credentials_file),
             audio_format=self.args.audio_format,
             antiban_wait_time=self.args.antiban_time,
+            max_bandwidth=self.args.max_bandwidth,
+            bandwidth_burst=self.args.bandwidth_burst,
+            memory_budget=self.args.memory_budget * 1024 * 1024,
+            accounts=self.args.account,
+            account_rate=self.args.account_rate,
+            source_cache=(
+                SourceCache(self.args.source_cache, self.args.source_cache_size * 1024 * 1024)
+                if self.args.source_cache
+                else None
+            ),
+            replaygain=self.args.replaygain,
         )
         self.search_limit = self.args.limit
 
@@ -48,9 +97,24 @@ class ZSpotify:
         self.antiban_album_time = self.args.antiban_album
         self.not_skip_existing = self.args.not_skip_existing
         self.skip_downloaded = self.args.skip_downloaded
+        self.extra_formats = dict(self.args.also_format)
         self.archive_file = self.config_dir / self.args.archive
+        self.queue_file = Path(self.args.queue_file or self.config_dir / "queue.db")
         self.archive = Archive(self.archive_file)
+        self.file_index = FileIndex()
+        self.incremental = self.args.incremental
+        self.store = None
+        if self.args.dedup:
+            self.store = ContentStore(
+                Path(self.args.store_dir or self.music_dir / ".zspotify-store"),
+                self.args.link_mode,
+            )
+        self.sync_state = SyncState(self.config_dir / "sync.json")
+        self.staging = StagingArea(Path(self.args.staging_dir or self.config_dir / "staging"))
         self.tagger = AudioTagger()
+        # Loudness of album tracks downloaded this run, {track id: (TrackLoudness, paths)}
+        self.album_loudness = {}
+        self._loudness_lock = threading.Lock()
 
     def parse_args(self):
         parser = argparse.ArgumentParser()
@@ -127,7 +191,8 @@ class ZSpotify:
             "-v",
             "--version",
             help="Shows the current version of ZSpotify and exit",
-            action="store_true",
+            action="version",
+            version=f"ZSpotify {__version__}",
         )
         parser.add_argument(
             "-af",
@@ -136,6 +201,29 @@ class ZSpotify:
             default="mp3",
             choices=["mp3", "ogg", "source"],
         )
+        parser.add_argument(
+            "--also-format",
+            help="Also write every downloaded track as FORMAT under DIR, mirroring the library (FORMAT=DIR, repeatable)",
+            action="append",
+            default=[],
+            type=_format_dir,
+        )
+        parser.add_argument(
+            "--source-cache",
+            help="Folder to keep the original streams in, so other formats are encoded without downloading again",
+        )
+        parser.add_argument(
+            "--source-cache-size",
+            help="Size limit of the source cache in MB, least recently used streams are evicted first",
+            default=4096,
+            type=int,
+        )
+        parser.add_argument(
+            "--replaygain",
+            help="Tags tracks with ReplayGain 2.0 track gain, and album gain once a whole album is downloaded (needs numpy)",
+            action="store_true",
+            default=False,
+        )
         parser.add_argument(
             "--album-in-filename",
             help="Adds the album name to the filename",
@@ -187,8 +275,218 @@ class ZSpotify:
         parser.add_argument(
             "-bd", "--bulk-download", help="Bulk download from file with urls"
         )
+        parser.add_argument(
+            "-i",
+            "--incremental",
+            help="Only download what changed in playlists, liked songs and shows since their last sync",
+            action="store_true",
+            default=False,
+        )
+        parser.add_argument(
+            "--dedup",
+            help="Download every track once and link it into the other collections it appears in",
+            action="store_true",
+            default=False,
+        )
+        parser.add_argument(
+            "--store-dir",
+            help="Folder of the deduplicated content store (default: MUSIC_DIR/.zspotify-store)",
+        )
+        parser.add_argument(
+            "--link-mode",
+            help="How tracks from the content store and the other locations of bulk tracks are placed",
+            default="hardlink",
+            choices=LINK_MODES,
+        )
+        parser.add_argument(
+            "--staging-dir",
+            help="Folder where tracks are converted and tagged before being moved into the library (default: CONFIG_DIR/staging)",
+        )
+        parser.add_argument(
+            "--workers",
+            help="Number of tracks downloaded at the same time in bulk and serve mode",
+            default=1,
+            type=int,
+        )
+        parser.add_argument(
+            "--account",
+            help="Credentials file of another account to spread audio downloads across, repeatable",
+            action="append",
+            default=[],
+        )
+        parser.add_argument(
+            "--account-rate",
+            help="Tracks each account may start per minute, 0 for no limit",
+            default=0,
+            type=float,
+        )
+        parser.add_argument(
+            "--max-bandwidth",
+            help="Cap the audio download rate of all workers together, in bytes per second (K, M, G suffixes), 0 for no cap",
+            default=0,
+            type=parse_rate,
+        )
+        parser.add_argument(
+            "--bandwidth-burst",
+            help="Bytes that may go through at once above --max-bandwidth after an idle period (default: one second worth)",
+            default=0,
+            type=parse_rate,
+        )
+        parser.add_argument(
+            "--memory-budget",
+            help="Audio in MB the downloads running at the same time may hold in memory, 0 for no limit",
+            default=0,
+            type=int,
+        )
+        parser.add_argument(
+            "--plan",
+            help="Resolve the tracks the selected download would get and estimate its size and time, without downloading",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--min-free-space",
+            help="Refuse to start a bulk, artist or all playlists download that would leave less free disk space than this, in MB",
+            default=1024,
+            type=int,
+        )
+        parser.add_argument(
+            "--resume",
+            help="Resume the last bulk download from where it stopped",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--max-attempts",
+            help="Tracks that failed fewer times than this are retried by --resume",
+            default=3,
+            type=int,
+        )
+
+        serve = parser.add_argument_group("daemon mode")
+        serve.add_argument(
+            "--serve",
+            help="Keep running and accept download jobs over a local HTTP API",
+            action="store_true",
+        )
+        serve.add_argument(
+            "--serve-host", help="Address to listen on", default="127.0.0.1"
+        )
+        serve.add_argument(
+            "--serve-port", help="Port to listen on", default=8150, type=int
+        )
+
+        distributed = parser.add_argument_group("distributed mode")
+        distributed.add_argument(
+            "--coordinator",
+            help="Expand the bulk file into --queue-file for --worker processes and wait for them",
+            action="store_true",
+        )
+        distributed.add_argument(
+            "--worker",
+            help="Download the tracks of the jobs in --queue-file until they are all finished",
+            action="store_true",
+        )
+        distributed.add_argument(
+            "--queue-file",
+            help="Job queue of bulk downloads, on a shared volume for workers (default: CONFIG_DIR/queue.db)",
+        )
+        distributed.add_argument(
+            "--lease",
+            help="Seconds a worker's claim on a track lasts without renewal before others take it over",
+            default=120,
+            type=int,
+        )
+
+        parser.add_argument(
+            "--metrics-file",
+            help="Periodically write Prometheus metrics to this file (node_exporter textfile collector)",
+        )
+        parser.add_argument(
+            "--metrics-interval",
+            help="Seconds between rewrites of the metrics file",
+            default=15,
+            type=int,
+        )
+        parser.add_argument(
+            "--trace",
+            help="Append a JSONL record with the stage timings of every track to this file",
+        )
+        parser.add_argument(
+            "--trace-summary",
+            help="Print p50/p95/p99 stage timings of a trace file and exit",
+        )
+
+        query = parser.add_argument_group("archive query")
+        query.add_argument(
+            "-q",
+            "--query",
+            help="Query the archive instead of downloading",
+            action="store_true",
+        )
+        query.add_argument("--query-artist", help="Only entries by this artist")
+        query.add_argument(
+            "--query-dir", help="Only entries whose file is under this directory"
+        )
+        query.add_argument(
+            "--query-type", help="Only entries of this audio type (music, episode)"
+        )
+        query.add_argument(
+            "--query-since", help="Only entries added at or after this timestamp"
+        )
+        query.add_argument(
+            "--query-until", help="Only entries added at or before this timestamp, or on or before this YYYY-MM-DD date"
+        )
+        query.add_argument(
+            "--query-missing",
+            help="Only entries whose file no longer exists",
+            action="store_true",
+        )
+        query.add_argument(
+            "--query-count",
+            help="Print only the number of matching entries",
+            action="store_true",
+        )
+        query.add_argument(
+            "--query-export",
+            help="Export the matching entries instead of listing them",
+            choices=["csv", "jsonl"],
+        )
+        query.add_argument(
+            "--query-output", help="File to write the export to (default: stdout)"
+        )
 
-        return parser.parse_args()
+        verify = parser.add_argument_group("library verify")
+        verify.add_argument(
+            "--verify",
+            help="Check archived files and the library folders for missing, corrupt and orphaned files",
+            action="store_true",
+        )
+        verify.add_argument(
+            "--verify-hash",
+            help="Also compute a sha256 of every archived file",
+            action="store_true",
+        )
+        verify.add_argument(
+            "--verify-workers",
+            help="Number of threads used to check files",
+            default=16,
+            type=int,
+        )
+        verify.add_argument(
+            "--verify-report",
+            help="File to write the verify report to (default: CONFIG_DIR/verify-report.json)",
+        )
+
+        args = parser.parse_args()
+        if args.coordinator and args.worker:
+            parser.error("--coordinator and --worker are separate processes, pick one")
+        if args.coordinator and not (args.bulk_download or args.resume):
+            parser.error("--coordinator needs --bulk-download or --resume")
+        for audio_format, _ in args.also_format:
+            if audio_format == args.audio_format:
+                parser.error(f"--also-format {audio_format} is already the --audio-format")
+        if args.replaygain and importlib.util.find_spec("numpy") is None:
+            parser.error("--replaygain needs numpy: pip install zspotify[replaygain]")
+        return args
 
     def splash(self):
         """Displays splash screen"""
@@ -277,10 +575,14 @@ class ZSpotify:
             filename = f"{artist_name} - " + filename
 
         elif caller == "show":
-            filename = f"{audio_number}. {audio_name}"
+            filename = f"{audio_number}. {audio_name}" if audio_number else audio_name
 
         elif caller == "episode":
-            filename = f"{artist_name} - {audio_number}. {audio_name}"
+            filename = (
+                f"{artist_name} - {audio_number}. {audio_name}"
+                if audio_number
+                else f"{artist_name} - {audio_name}"
+            )
 
         else:
             filename = f"{artist_name} - {audio_name}"
@@ -290,23 +592,140 @@ class ZSpotify:
 
         return filename
 
-    def download_track(self, track_id, path=None, caller=None):
-        if self.args.skip_downloaded and self.archive.exists(track_id):
-            print(f"Skipping {track_id} - Already Downloaded")
-            return True
+    def refresh_file_index(self):
+        """Forgets the scanned folders, files may have changed on disk since the last job"""
+        self.file_index.clear()
+
+    def is_downloaded(self, base_path, filename):
+        """Checks the filesystem index for a downloaded file in any format"""
+        for ext in (".mp3", ".ogg"):
+            if self.file_index.exists(base_path / (filename + ext)):
+                return filename + ext
+        return None
 
+    def download_track(self, track_id, path=None, caller=None, track=None, targets=None):
+        """Downloads and tags a track or episode, track is its metadata if already fetched.
+
+        targets are further (path, caller) locations the downloaded file is placed at.
+        """
+        with job_type(caller or "track"), TRACE.track(track_id, caller or "track"):
+            # Album gain needs the loudness of every track of the album until the last one
+            # is done; workers share albums with other processes, so they only get track gain
+            in_album = self.args.replaygain and not self.args.worker and (
+                caller == "album" or any(target[1] == "album" for target in targets or ())
+            )
+            try:
+                # The metadata fetched after the skip checks names the targets too
+                ok, track = self._download_track(track_id, path, caller, track, in_album)
+            except Exception:
+                self._count("failed")
+                raise
+            if not ok:
+                self._count("failed")
+            elif targets:
+                with stage("place"):
+                    self.place_targets(track_id, targets, track)
+            return ok
+
+    def fetch_metadata(self, track_id, caller):
+        with stage("metadata"):
+            if caller == "show" or caller == "episode":
+                return self.respot.request.get_episode_info(track_id)
+            return self.respot.request.get_track_info(track_id)
+
+    def place_targets(self, track_id, targets, track=None):
+        """Places a downloaded track at more locations, linked or copied per --link-mode"""
+        entry = self.archive.get(track_id) or {}
+        sources = [
+            Path(fullpath)
+            for fullpath in [entry.get("fullpath")] + entry.get("locations", [])
+            if fullpath and Path(fullpath).is_file()
+        ]
+        if not sources:
+            return False
+        placed = {source.parent for source in sources}
+        for path, caller in targets:
+            base_path = Path(path) if path else self.music_dir
+            if not path and caller in ("show", "episode"):
+                base_path = self.episodes_dir
+            if base_path in placed:
+                # Recorded there already, no need to name it
+                continue
+            if track is None and self.store:
+                track = self.store.get_metadata(track_id)
+            if track is None:
+                track = self.fetch_metadata(track_id, caller)
+                if track is None:
+                    return False
+            filename = self.generate_filename(
+                caller,
+                track.get("audio_name"),
+                track.get("audio_number"),
+                track.get("artist_name"),
+                track.get("album_name"),
+            )
+            if self.is_downloaded(base_path, filename):
+                continue
+            output_path = place(
+                sources[0], base_path / (filename + sources[0].suffix), self.args.link_mode
+            )
+            self.place_extra_formats(sources[0], output_path)
+            self.remember_location(track_id, output_path)
+            self.file_index.add(output_path)
+            self.archive.add_location(track_id, output_path)
+            print(f"Placed {output_path.name} in {base_path}")
+        return True
+
+    @staticmethod
+    def _count(result):
+        METRICS.inc(TRACKS, result=result)
+        TRACE.set("result", result)
+
+    @classmethod
+    def _skip(cls, message):
+        print(f"Skipping {message}")
+        cls._count("skipped")
+        return True
+
+    def _download_track(self, track_id, path, caller, track, in_album=False):
+        """Returns whether the track is in place, and its metadata if it was fetched"""
+        if self.args.skip_downloaded:
+            archived = self.archive.exists(track_id)
+            TRACE.cache("archive", archived)
+            if archived:
+                return self._skip(f"{track_id} - Already Downloaded"), track
+
+        base_path = path or self.music_dir
         if caller == "show" or caller == "episode":
-            track = self.respot.request.get_episode_info(track_id)
-        else:
-            track = self.respot.request.get_track_info(track_id)
+            base_path = path or self.episodes_dir
 
+        # Use the filename from the archive to skip before any network I/O
+        entry = self.archive.get(track_id)
+        if self.not_skip_existing and entry and entry.get("fullpath"):
+            existing = self.is_downloaded(base_path, Path(entry["fullpath"]).stem)
+            if existing and not self.has_extra_formats(base_path / existing):
+                existing = None
+            TRACE.cache("archived_file", bool(existing))
+            if existing:
+                return self._skip(f"{existing} - Already downloaded"), track
+
+        if track is None and self.store and self.store.get(track_id, self.args.audio_format):
+            # Stored tracks are named from the info kept with them
+            track = self.store.get_metadata(track_id)
         if track is None:
-            print(f"Skipping {track_id} - Could not get track info")
-            return True
+            # So are tracks encoded again from the source cache
+            track = self.respot.cached_metadata(track_id)
+        TRACE.cache("metadata", track is not None)
+        if track is None:
+            track = self.fetch_metadata(track_id, caller)
+
+        if track is None:
+            # Counted as failed, so a bulk run retries it
+            print(f"Could not get track info of {track_id}")
+            return False, track
 
         if not track["is_playable"]:
-            print(f"Skipping {track['audio_name']} - Not Available")
-            return True
+            return self._skip(f"{track['audio_name']} - Not Available"), track
 
         audio_name = track.get("audio_name")
         audio_number = track.get("audio_number")
@@ -322,71 +741,314 @@ class ZSpotify:
             album_name,
         )
 
-        base_path = path or self.music_dir
-        if caller == "show" or caller == "episode":
-            base_path = path or self.episodes_dir
-        temp_path = base_path / (filename + "." + self.args.audio_format)
+        # A track another thread or process is getting is waited for, then looked up again
+        waited = self.archive.reserve(track_id)
+        try:
+            if waited:
+                self.file_index.forget(base_path)
+                if self.args.skip_downloaded and self.archive.exists(track_id):
+                    return self._skip(f"{track_id} - Already Downloaded"), track
+
+            if self.not_skip_existing:
+                existing = self.is_downloaded(base_path, filename)
+                if existing and not self.has_extra_formats(base_path / existing):
+                    existing = None
+                TRACE.cache("file", bool(existing))
+                if existing:
+                    return self._skip(f"{existing} - Already downloaded"), track
+
+            if self.store:
+                linked = self.link_from_store(track_id, base_path, filename, track)
+                TRACE.cache("store", linked)
+                if linked:
+                    self._count("linked")
+                    return True, track
+
+            # Built in the staging area, so the library never shows a partial or untagged file
+            staging = self.staging.create()
+            try:
+                staged_paths, loudness = self.respot.download(
+                    track_id,
+                    staging / (filename + "." + self.args.audio_format),
+                    self.args.audio_format,
+                    extra_formats=list(self.extra_formats),
+                )
 
-        for ext in (".mp3", ".ogg"):
-            if self.not_skip_existing and (base_path / (filename + ext)).exists():
-                print(f"Skipping {filename + ext} - Already downloaded")
-                return True
+                if not staged_paths:
+                    return False, track
+
+                staged_path, *extra_paths = staged_paths
+                self.respot.cache_metadata(track_id, track)
+                TRACE.set("output_bytes", sum(os.path.getsize(path) for path in staged_paths))
+
+                print(f"Setting audiotags {filename}")
+                with stage("tag"):
+                    for path in staged_paths:
+                        self.tagger.set_audio_tags(
+                            path,
+                            artists=artist_name,
+                            name=audio_name,
+                            album_name=album_name,
+                            release_year=track["release_year"],
+                            disc_number=track["disc_number"],
+                            track_number=audio_number,
+                            album_artist=album_artist,
+                            track_id_str=track.get("scraped_song_id"),
+                            image_url=track["image_url"],
+                        )
+                        if loudness:
+                            self.tagger.set_replaygain(path, loudness.replaygain())
+                output_path = finalize(staged_path, base_path / staged_path.name)
+                for audio_format, path in zip(self.extra_formats, extra_paths):
+                    finalize(path, self.format_path(audio_format, output_path))
+            finally:
+                self.staging.remove(staging)
+
+            if loudness and in_album:
+                with self._loudness_lock:
+                    self.album_loudness[track_id] = (loudness, [])
+                self.remember_location(track_id, output_path)
+
+            self.file_index.add(output_path)
+            self.archive.add(
+                track_id,
+                artist=artist_name,
+                track_name=audio_name,
+                fullpath=output_path,
+                audio_type="episode" if caller in ("show", "episode") else "music",
+            )
+            if self.store:
+                self.store.ingest(track_id, output_path, track)
+            self._count("completed")
+            print(f"Finished downloading {filename}")
+            return True, track
+        finally:
+            self.archive.release(track_id)
+
+    def remember_location(self, track_id, path):
+        """Records a library file of a measured album track, to tag with the album gain"""
+        with self._loudness_lock:
+            if track_id in self.album_loudness:
+                paths = self.album_loudness[track_id][1]
+                paths.append(path)
+                paths.extend(self.format_path(audio_format, path) for audio_format in self.extra_formats)
+
+    def apply_album_gain(self, track_ids, name):
+        """Tags every file of the album's tracks with its album gain.
+
+        The album is gated over the loudness blocks of all its tracks, so
+        it is only done when every one of them was measured in this run.
+        """
+        with self._loudness_lock:
+            measured = [self.album_loudness.pop(track_id, None) for track_id in track_ids]
+        missing = sum(entry is None for entry in measured)
+        if missing:
+            print(
+                f"Skipping album gain of {name}: {missing} of {len(measured)} tracks"
+                " were not downloaded in this run"
+            )
+            return False
+        try:
+            from loudness import album_replaygain
+        except ImportError:
+            from .loudness import album_replaygain
 
-        output_path = self.respot.download(
-            track_id, temp_path, self.args.audio_format, True
+        values = album_replaygain([loudness for loudness, _ in measured])
+        if not values:
+            return False
+        # Written in place, so hard links and symlinks to the files get it too
+        with stage("tag"):
+            for _, paths in measured:
+                for path in paths:
+                    if Path(path).is_file():
+                        self.tagger.set_replaygain(path, values)
+        print(f"Album gain of {name}: {values['REPLAYGAIN_ALBUM_GAIN']}")
+        return True
+
+    def format_path(self, audio_format, path):
+        """Returns where the --also-format copy of a library file goes"""
+        path = Path(path).absolute()
+        relative = Path(path.name)
+        # The deepest library folder the file is in, e.g. episodes inside music
+        for root in sorted(
+            {self.music_dir.absolute(), self.episodes_dir.absolute(), self.download_dir.absolute()},
+            key=lambda root: len(root.parts),
+            reverse=True,
+        ):
+            if path.is_relative_to(root):
+                relative = path.relative_to(root)
+                break
+        return self.extra_formats[audio_format] / relative.with_suffix("." + audio_format)
+
+    def has_extra_formats(self, path):
+        """Whether every --also-format copy of a library file exists"""
+        return all(
+            self.format_path(audio_format, path).is_file() for audio_format in self.extra_formats
         )
 
-        if output_path == "":
-            return
+    def place_extra_formats(self, source, dest):
+        """Places the --also-format copies of source at those of dest, where they exist"""
+        for audio_format in self.extra_formats:
+            extra = self.format_path(audio_format, source)
+            if extra.is_file() and not self.format_path(audio_format, dest).exists():
+                place(extra, self.format_path(audio_format, dest), self.args.link_mode)
+
+    def link_from_store(self, track_id, base_path, filename, track=None):
+        """Places an already downloaded track in another collection"""
+        stored = self.store.get(track_id, self.args.audio_format)
+        if stored is None:
+            # Tracks downloaded before the store existed are adopted from the archive
+            entry = self.archive.get(track_id)
+            extensions = (
+                SOURCE_EXTENSIONS
+                if self.args.audio_format == "source"
+                else (self.args.audio_format,)
+            )
+            if not entry or Path(entry["fullpath"]).suffix.lstrip(".") not in extensions:
+                return False
+            if not Path(entry["fullpath"]).is_file():
+                return False
+            stored = self.store.ingest(track_id, entry["fullpath"], track)
+
+        output_path = base_path / (filename + stored.suffix)
+        self.store.link(stored, output_path)
+        entry = self.archive.get(track_id)
+        if entry and entry.get("fullpath"):
+            self.place_extra_formats(entry["fullpath"], output_path)
+        self.file_index.add(output_path)
+        self.archive.add_location(track_id, output_path)
+        print(f"Linked {output_path.name} from the content store")
+        return True
 
-        self.archive.add(
-            track_id,
-            artist=artist_name,
-            track_name=audio_name,
-            fullpath=output_path,
-            audio_type="music",
-        )
-
-        print(f"Setting audiotags {filename}")
-        self.tagger.set_audio_tags(
-            output_path,
-            artists=artist_name,
-            name=audio_name,
-            album_name=album_name,
-            release_year=track["release_year"],
-            disc_number=track["disc_number"],
-            track_number=audio_number,
-            album_artist=album_artist,
-            track_id_str=track["scraped_song_id"],
-            image_url=track["image_url"],
-        )
-        print(f"Finished downloading {filename}")
-
-    def download_playlist(self, playlist_id):
-        playlist = self.respot.request.get_playlist_info(playlist_id)
+    def expand_playlist(self, playlist_id, playlist=None):
+        """Returns the playlist name and the tracks to download"""
+        playlist = playlist or self.respot.request.get_playlist_info(playlist_id)
         if not playlist:
             print("Playlist not found")
-            return False
+            return None
         songs = self.respot.request.get_playlist_songs(playlist_id)
         if not songs:
             print("Playlist is empty")
-            return False
+            return None
         playlist_name = playlist["name"]
         if playlist_name == "":
             playlist_name = playlist_id
-        print(f"Downloading {playlist_name} playlist")
         basepath = self.music_dir / RespotUtils.sanitize_data(playlist_name)
-        for song in songs:
-            self.download_track(song["id"], basepath, "playlist")
+        tracks = [
+            {
+                "id": song["id"],
+                "path": basepath,
+                "caller": "playlist",
+                "group": playlist_id,
+                "duration_ms": song.get("duration_ms"),
+            }
+            for song in songs
+        ]
+        return {
+            "name": playlist_name,
+            "snapshot_id": playlist.get("snapshot_id"),
+            "tracks": tracks,
+        }
+
+    def expand_playlist_changes(self, playlist_id, snapshot_id=None):
+        """Returns the playlist name and the tracks added since its last sync"""
+        if self.playlist_up_to_date(playlist_id, snapshot_id):
+            return None
+        info = self.respot.request.get_playlist_info(playlist_id)
+        if not info:
+            print("Playlist not found")
+            return None
+        if self.playlist_up_to_date(playlist_id, info["snapshot_id"]):
+            return None
+        playlist = self.expand_playlist(playlist_id, info)
+        if not playlist:
+            return None
+        state = self.sync_state.get("playlists", playlist_id) or {}
+        synced = set(state.get("tracks", []))
+        playlist["tracks"] = [track for track in playlist["tracks"] if track["id"] not in synced]
+        return playlist
+
+    def playlist_up_to_date(self, playlist_id, snapshot_id):
+        """True if the playlist did not change since its last incremental sync"""
+        state = self.sync_state.get("playlists", playlist_id)
+        return bool(
+            self.incremental
+            and snapshot_id
+            and state
+            and state.get("snapshot_id") == snapshot_id
+        )
+
+    def download_playlist(self, playlist_id, snapshot_id=None):
+        self.refresh_file_index()
+        if self.incremental:
+            return self.sync_playlist(playlist_id, snapshot_id)
+        playlist = self.expand_playlist(playlist_id)
+        if not playlist:
+            return False
+        print(f"Downloading {playlist['name']} playlist")
+        for track in playlist["tracks"]:
+            self.download_track(track["id"], track["path"], track["caller"])
         print(f"Finished downloading {playlist['name']} playlist")
 
+    def sync_playlist(self, playlist_id, snapshot_id=None):
+        """Downloads only the tracks added since the last sync of the playlist"""
+        if self.playlist_up_to_date(playlist_id, snapshot_id):
+            print(f"Skipping playlist {playlist_id} - Unchanged since last sync")
+            return True
+        info = self.respot.request.get_playlist_info(playlist_id)
+        if not info:
+            print("Playlist not found")
+            return False
+        if self.playlist_up_to_date(playlist_id, info["snapshot_id"]):
+            print(f"Skipping {info['name']} playlist - Unchanged since last sync")
+            return True
+
+        playlist = self.expand_playlist(playlist_id, info)
+        if not playlist:
+            return False
+        state = self.sync_state.get("playlists", playlist_id) or {}
+        synced = set(state.get("tracks", []))
+        current = {track["id"] for track in playlist["tracks"]}
+
+        removed = synced - current
+        if removed:
+            print(f"{len(removed)} track(s) removed from {playlist['name']} since last sync:")
+            for track_id in sorted(removed):
+                entry = self.archive.get(track_id)
+                print(f"    {entry['artist']} - {entry['track_name']}" if entry else f"    {track_id}")
+
+        added = [track for track in playlist["tracks"] if track["id"] not in synced]
+        print(f"Syncing {playlist['name']} playlist: {len(added)} new track(s)")
+        synced &= current
+        failed = False
+        for track in added:
+            if self.download_track(track["id"], track["path"], track["caller"]):
+                synced.add(track["id"])
+            else:
+                failed = True
+
+        # Without the snapshot id the next sync lists the playlist again to retry failures
+        self.sync_state.set(
+            "playlists",
+            playlist_id,
+            {
+                "snapshot_id": None if failed else playlist["snapshot_id"],
+                "tracks": sorted(synced),
+            },
+        )
+        print(f"Finished syncing {playlist['name']} playlist")
+        return not failed
+
     def download_all_user_playlists(self):
         playlists = self.respot.request.get_all_user_playlists()
         if not playlists:
             print("No playlists found")
             return False
         for playlist in playlists["playlists"]:
-            self.download_playlist(playlist["id"])
+            if self.playlist_up_to_date(playlist["id"], playlist.get("snapshot_id")):
+                print(f"Skipping {playlist['name']} playlist - Unchanged since last sync")
+                continue
+            self.download_playlist(playlist["id"], playlist.get("snapshot_id"))
             self.antiban_wait(self.antiban_album_time)
         print("Finished downloading all user playlists")
 
@@ -421,29 +1083,33 @@ class ZSpotify:
 
         # Clean user input
         invalid_ids = []
-        playlist_ids = []
+        selected = []
         for track_id in user_formatted_input:
             if track_id > len(playlists["playlists"]) or track_id < 1:
                 invalid_ids.append(track_id)
             else:
-                playlist_ids.append(playlists["playlists"][track_id - 1]["id"])
+                selected.append(playlists["playlists"][track_id - 1])
         if invalid_ids:
             print(f"{invalid_ids} do not exist, downloading the rest")
 
-        for playlist in playlist_ids:
-            self.download_playlist(playlist)
+        for playlist in selected:
+            if self.playlist_up_to_date(playlist["id"], playlist.get("snapshot_id")):
+                print(f"Skipping {playlist['name']} playlist - Unchanged since last sync")
+                continue
+            self.download_playlist(playlist["id"], playlist.get("snapshot_id"))
             self.antiban_wait(self.antiban_album_time)
         print("Finished downloading selected playlists")
 
-    def download_album(self, album_id):
+    def expand_album(self, album_id):
+        """Returns the album name and the tracks to download"""
         album = self.respot.request.get_album_info(album_id)
         if not album:
             print("Album not found")
-            return False
+            return None
         songs = self.respot.request.get_album_songs(album_id)
         if not songs:
             print("Album is empty")
-            return False
+            return None
         disc_number_flag = False
         for song in songs:
             if song["disc_number"] > 1:
@@ -455,11 +1121,10 @@ class ZSpotify:
             f"{album['release_date']} - {album['name']}"
         )
 
-        print(f"Downloading {artists} - {album_name} album")
-
         # Concat download path
         basepath = self.music_dir / artists / album_name
 
+        tracks = []
         for song in songs:
             # Append disc number to filepath if more than 1 disc
             newBasePath = basepath
@@ -469,11 +1134,53 @@ class ZSpotify:
                 )
                 newBasePath = basepath / disc_number
 
-            self.download_track(song["id"], newBasePath, "album")
+            tracks.append(
+                {
+                    "id": song["id"],
+                    "path": newBasePath,
+                    "caller": "album",
+                    "group": album_id,
+                    "duration_ms": song.get("duration_ms"),
+                }
+            )
+
+        return {"name": f"{artists} - {album_name}", "album": album, "tracks": tracks}
+
+    def download_album(self, album_id):
+        self.refresh_file_index()
+        album = self.expand_album(album_id)
+        if not album:
+            return False
 
-        print(f"Finished downloading {album['artists']} - {album['name']} album")
+        print(f"Downloading {album['name']} album")
+
+        for track in album["tracks"]:
+            self.download_track(track["id"], track["path"], track["caller"])
+
+        if self.args.replaygain:
+            self.apply_album_gain([track["id"] for track in album["tracks"]], album["name"])
+        print(
+            f"Finished downloading {album['album']['artists']} - {album['album']['name']} album"
+        )
         return True
 
+    def expand_artist(self, artist_id):
+        """Returns the artist name and the tracks of all their albums"""
+        artist = self.respot.request.get_artist_info(artist_id)
+        if not artist:
+            print("Artist not found")
+            return None
+        albums = self.respot.request.get_artist_albums(artist_id)
+        if not albums:
+            print("Artist has no albums")
+            return None
+        tracks = []
+        for album in albums:
+            expanded = self.expand_album(album["id"])
+            if expanded:
+                tracks.extend(expanded["tracks"])
+        return {"name": artist["name"], "tracks": tracks}
+
     def download_artist(self, artist_id):
         artist = self.respot.request.get_artist_info(artist_id)
         if not artist:
@@ -489,19 +1196,95 @@ class ZSpotify:
         print(f"Finished downloading {artist['name']} artist")
         return True
 
-    def download_liked_songs(self):
-        songs = self.respot.request.get_liked_tracks()
+    def expand_liked_songs(self, since=None):
+        """Returns the user's saved tracks to download"""
+        songs = self.respot.request.get_liked_tracks(since)
         if not songs:
-            print("No liked songs found")
+            print("No new liked songs found" if since else "No liked songs found")
+            return None
+        basepath = self.music_dir / "Liked Songs"
+        tracks = [
+            {
+                "id": song["id"],
+                "path": basepath,
+                "caller": "liked_songs",
+                "group": "liked_songs",
+                "added_at": song["added_at"],
+                "duration_ms": song.get("duration_ms"),
+            }
+            for song in songs
+        ]
+        return {"name": "Liked Songs", "tracks": tracks}
+
+    def download_liked_songs(self):
+        self.refresh_file_index()
+        if self.incremental:
+            return self.sync_liked_songs()
+        liked = self.expand_liked_songs()
+        if not liked:
             return False
         print("Downloading liked songs")
-        basepath = self.music_dir / "Liked Songs"
-        for song in songs:
-            self.download_track(song["id"], basepath, "liked_songs")
+        for track in liked["tracks"]:
+            self.download_track(track["id"], track["path"], track["caller"])
         print("Finished downloading liked songs")
         return True
 
+    def sync_liked_songs(self):
+        """Downloads the songs liked since the newest one of the last sync"""
+        state = self.sync_state.get("liked_songs", "me") or {}
+        liked = self.expand_liked_songs(since=state.get("added_at"))
+        if not liked:
+            return True
+        print(f"Syncing liked songs: {len(liked['tracks'])} new track(s)")
+        failed = False
+        for track in liked["tracks"]:
+            if not self.download_track(track["id"], track["path"], track["caller"]):
+                failed = True
+
+        # Only move the mark forward once every newer song is downloaded
+        if not failed:
+            newest = max(track["added_at"] for track in liked["tracks"])
+            self.sync_state.set("liked_songs", "me", {"added_at": newest})
+        print("Finished syncing liked songs")
+        return not failed
+
+    def expand_url(self, url):
+        """Resolves a url into the list of tracks it stands for"""
+        parsed_url = RespotUtils.parse_url(url)
+        if parsed_url["track"]:
+            return {
+                "name": parsed_url["track"],
+                "tracks": [{"id": parsed_url["track"], "path": None, "caller": None, "group": None}],
+            }
+        elif parsed_url["playlist"]:
+            return self.expand_playlist(parsed_url["playlist"])
+        elif parsed_url["album"]:
+            return self.expand_album(parsed_url["album"])
+        elif parsed_url["artist"]:
+            return self.expand_artist(parsed_url["artist"])
+        elif parsed_url["episode"]:
+            return {
+                "name": parsed_url["episode"],
+                "tracks": [
+                    {"id": parsed_url["episode"], "path": None, "caller": "episode", "group": None}
+                ],
+            }
+        elif parsed_url["show"]:
+            return self.expand_show(parsed_url["show"])
+        print("Invalid URL")
+        return None
+
+    def expand_url_changes(self, url):
+        """Resolves a url like expand_url, leaving out what the last --incremental sync got"""
+        parsed_url = RespotUtils.parse_url(url)
+        if parsed_url["playlist"]:
+            return self.expand_playlist_changes(parsed_url["playlist"])
+        if parsed_url["show"]:
+            return self.expand_show(parsed_url["show"], since_sync=True)
+        return self.expand_url(url)
+
     def download_by_url(self, url):
+        self.refresh_file_index()
         parsed_url = RespotUtils.parse_url(url)
         if parsed_url["track"]:
             ret = self.download_track(parsed_url["track"])
@@ -512,7 +1295,7 @@ class ZSpotify:
         elif parsed_url["artist"]:
             ret = self.download_artist(parsed_url["artist"])
         elif parsed_url["episode"]:
-            ret = self.download_track(parsed_url["episode"])
+            ret = self.download_track(parsed_url["episode"], caller="episode")
         elif parsed_url["show"]:
             ret = self.download_all_show_episodes(parsed_url["show"])
         else:
@@ -520,20 +1303,553 @@ class ZSpotify:
             return False
         return ret
 
+    def expand_show(self, show_id, since_sync=False):
+        """Returns the show name and its episodes to download.
+
+        With since_sync, only the episodes released since its last sync.
+        """
+        show = self.respot.request.get_show_info(show_id)
+        if not show:
+            print("Show not found")
+            return None
+        if since_sync:
+            state = self.sync_state.get("shows", show_id) or {}
+            episodes = self.respot.request.get_show_episodes(
+                show_id, known=set(state.get("episodes", [])), since=state.get("latest_release")
+            )
+        else:
+            episodes = self.respot.request.get_show_episodes(show_id)
+        if not episodes:
+            print("Show has no new episodes" if since_sync else "Show has no episodes")
+            return None
+        basepath = self.episodes_dir / show["name"]
+        tracks = [
+            {
+                "id": episode["id"],
+                "path": basepath,
+                "caller": "show",
+                "group": show_id,
+                "duration_ms": episode.get("duration_ms"),
+            }
+            for episode in episodes
+        ]
+        return {"name": show["name"], "tracks": tracks}
+
     def download_all_show_episodes(self, show_id):
+        self.refresh_file_index()
+        if self.incremental:
+            return self.sync_show(show_id)
+        show = self.expand_show(show_id)
+        if not show:
+            return False
+        for track in show["tracks"]:
+            self.download_track(track["id"], track["path"], track["caller"])
+        print(f"Finished downloading {show['name']} show")
+        return True
+
+    def sync_show(self, show_id):
+        """Downloads only the episodes released since the last sync of the show"""
         show = self.respot.request.get_show_info(show_id)
         if not show:
             print("Show not found")
             return False
-        episodes = self.respot.request.get_show_episodes(show_id)
+        state = self.sync_state.get("shows", show_id) or {}
+        seen = set(state.get("episodes", []))
+        latest = state.get("latest_release")
+
+        episodes = self.respot.request.get_show_episodes(show_id, known=seen, since=latest)
         if not episodes:
-            print("Show has no episodes")
-            return False
+            print(f"Skipping {show['name']} show - No new episodes")
+            return True
+
+        print(f"Syncing {show['name']} show: {len(episodes)} new episode(s)")
+        infos = self.respot.request.get_episodes_info([e["id"] for e in episodes])
+        basepath = self.episodes_dir / show["name"]
+        failed = False
         for episode in episodes:
-            self.download_track(episode["id"], "show")
-        print(f"Finished downloading {show['name']} show")
+            info = infos.get(episode["id"])
+            if info and self.download_track(episode["id"], basepath, "show", track=info):
+                seen.add(episode["id"])
+            else:
+                failed = True
+
+        # Keep paging back to the old release date until failed episodes are downloaded
+        if not failed:
+            latest = max([latest or ""] + [e["release_date"] for e in episodes])
+        self.sync_state.set(
+            "shows", show_id, {"latest_release": latest, "episodes": sorted(seen)}
+        )
+        print(f"Finished syncing {show['name']} show")
+        return not failed
+
+    def bulk_download(self):
+        """Downloads the urls of the bulk file through the persistent job queue"""
+        queue = JobQueue(self.queue_file, shared=self.args.coordinator or self.args.worker)
+        try:
+            if self.args.worker:
+                self.run_worker(queue)
+                return
+            if not self.args.resume:
+                queue.clear()
+            else:
+                retried = queue.retry_failed(self.args.max_attempts)
+                if retried:
+                    print(f"Retrying {retried} failed track(s)")
+            if self.args.bulk_download:
+                with open(self.args.bulk_download, "r") as file:
+                    inputs = [url for line in file for url in self.split_input(line.strip())]
+                for url in unique_inputs(inputs):
+                    queue.add_job(url, priority=self.job_priority(url))
+            if self.args.coordinator:
+                self.coordinate(queue)
+            else:
+                self.run_queue(queue)
+        finally:
+            queue.close()
+
+    def run_queue(self, queue):
+        """Plans every unfinished job of the queue and runs the plan through the scheduler"""
+        queue.reset_interrupted()
+        plan = self.plan_queue(queue)
+        print(f"Planned {len(plan)} unique track(s) of {plan.rows} queued")
+        if not self.has_free_space(self.estimate_plan(plan)["directories"]):
+            return
+        scheduler = Scheduler(self.args.workers)
+        scheduler.start()
+        for job in queue.jobs((IN_PROGRESS,)):
+            self.schedule_job(scheduler, queue, job, plan=plan)
+        try:
+            scheduler.wait_idle()
+        except KeyboardInterrupt:
+            # Checkpoint: the tracks being downloaded finish, so no worker writes
+            # their state after the reset; the rest stays pending for --resume
+            print("Stopping once the tracks being downloaded are finished")
+            scheduler.stop()
+            scheduler.join()
+            queue.reset_interrupted()
+            raise
+        scheduler.stop()
+        # Jobs whose tracks were all downloaded by other jobs finish last
+        for job in queue.jobs((IN_PROGRESS,)):
+            self.finish_queued_job(queue, job)
+        self.print_queue_summary(queue)
+
+    def coordinate(self, queue):
+        """Expands the jobs of a shared queue and reports progress until workers finish them.
+
+        The running state is refreshed from a heartbeat thread, so workers
+        can tell a coordinator that crashed from one still expanding jobs.
+        """
+        stopped = threading.Event()
+
+        def heartbeat():
+            while not stopped.wait(COORDINATOR_HEARTBEAT):
+                try:
+                    queue.set_coordinator_state(IN_PROGRESS)
+                except Exception as e:
+                    # A busy or briefly unreachable queue file, the next beat tries again
+                    print(f"Could not refresh the coordinator state: {e}")
+
+        queue.set_coordinator_state(IN_PROGRESS)
+        refresher = threading.Thread(target=heartbeat, name="zspotify-coordinator", daemon=True)
+        refresher.start()
+        try:
+            plan = self.plan_queue(queue)
+            print(f"Queued {len(plan)} unique track(s) of {plan.rows} for workers in {self.queue_file}")
+            last = None
+            while True:
+                queue.finish_completed()
+                totals = queue.totals()
+                if totals != last:
+                    print(
+                        f"{totals[DONE]} done, {totals[FAILED]} failed, {totals[IN_PROGRESS]} in progress,"
+                        f" {totals[PENDING]} pending"
+                    )
+                    last = totals
+                if not totals[PENDING] and not totals[IN_PROGRESS]:
+                    break
+                time.sleep(5)
+        finally:
+            stopped.set()
+            refresher.join()
+        # Lets the workers waiting for more jobs stop
+        queue.set_coordinator_state(DONE)
+        self.print_queue_summary(queue)
+
+    def run_worker(self, queue):
+        """Claims tracks of a shared queue and downloads them until every job is finished.
+
+        Claims are leases renewed from a heartbeat thread. If this process
+        dies, other workers take its tracks over when the leases expire.
+        A worker started before the coordinator waits for it. Once nothing
+        can be claimed it stops if the coordinator is done, or if the
+        coordinator died and no track is left pending or in progress.
+        """
+        name = f"{socket.gethostname()}-{os.getpid()}"
+        print(f"Worker {name} downloading from {self.queue_file}")
+        stopped = threading.Event()
+
+        waiting = threading.Event()
+        orphaned = threading.Event()
+
+        def heartbeat():
+            while not stopped.wait(self.args.lease / 3):
+                try:
+                    queue.renew_leases(name, self.args.lease)
+                except Exception as e:
+                    # A busy or briefly unreachable queue file, the next beat tries again
+                    print(f"Could not renew the leases of {name}: {e}")
+
+        def work():
+            job_id = None
+            while not stopped.is_set():
+                claimed = queue.claim_track(name, self.args.lease)
+                if claimed is None:
+                    state = queue.coordinator_state()
+                    if state == DONE:
+                        return
+                    if state == FAILED:
+                        totals = queue.totals()
+                        if not totals[PENDING] and not totals[IN_PROGRESS]:
+                            if totals["unexpanded"]:
+                                print("Jobs are left unexpanded, start the coordinator again")
+                            return
+                        if not orphaned.is_set():
+                            orphaned.set()
+                            print("The coordinator stopped, finishing the tracks left in the queue")
+                    elif state is None and not waiting.is_set():
+                        waiting.set()
+                        print("Waiting for the coordinator to queue jobs")
+                    # Tracks leased by other workers, or jobs not expanded yet
+                    stopped.wait(5)
+                    continue
+                track, duplicates = claimed
+                if track["job_id"] != job_id:
+                    job_id = track["job_id"]
+                    self.refresh_file_index()
+                self.run_track(queue, track, duplicates)
+
+        renewer = threading.Thread(target=heartbeat, name="zspotify-lease", daemon=True)
+        renewer.start()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.args.workers)) as pool:
+                futures = [pool.submit(work) for _ in range(max(1, self.args.workers))]
+                try:
+                    for future in futures:
+                        future.result()
+                finally:
+                    # On CTRL-C the tracks being downloaded still finish
+                    stopped.set()
+        finally:
+            queue.release_worker(name)
+        queue.finish_completed()
+        self.print_queue_summary(queue)
+
+    def print_queue_summary(self, queue):
+        jobs = queue.jobs()
+        done = sum(1 for job in jobs if job["state"] == DONE)
+        print(f"Finished {done} of {len(jobs)} jobs")
+        for job in jobs:
+            if job["state"] == FAILED:
+                print(f"Failed: {job['url']} ({job['error']})")
+
+    def plan_queue(self, queue):
+        """Expands the unfinished jobs and merges their pending tracks into one plan"""
+        unexpanded = [job for job in queue.jobs((PENDING, IN_PROGRESS)) if not job["expanded"]]
+        with ThreadPoolExecutor(max_workers=max(1, self.args.workers)) as pool:
+            for job, expanded in zip(unexpanded, pool.map(self._expand_job, unexpanded)):
+                if expanded:
+                    queue.set_job_expanded(job["id"], expanded["name"], expanded["tracks"])
+                else:
+                    queue.set_job_state(job["id"], FAILED, "Could not resolve url")
+
+        plan = DownloadPlan()
+        for job in queue.jobs((IN_PROGRESS,)):
+            priority = self.job_priority(job["url"])
+            for track in queue.tracks(job["id"], (PENDING,)):
+                plan.add(job["id"], track, priority)
+        return plan
+
+    def _expand_job(self, job):
+        try:
+            return self.expand_url(job["url"])
+        except Exception as e:
+            print(f"Could not resolve {job['url']}: {e}")
+            return None
+
+    def plan_sources(self):
+        """Returns one expand callable per collection of the selected download mode, or None"""
+        if self.args.all_playlists:
+            playlists = self.respot.request.get_all_user_playlists()["playlists"]
+            if self.incremental:
+                return [
+                    partial(self.expand_playlist_changes, playlist["id"], playlist.get("snapshot_id"))
+                    for playlist in playlists
+                ]
+            return [partial(self.expand_playlist, playlist["id"]) for playlist in playlists]
+        if self.args.liked_songs:
+            if self.incremental:
+                state = self.sync_state.get("liked_songs", "me") or {}
+                return [partial(self.expand_liked_songs, since=state.get("added_at"))]
+            return [self.expand_liked_songs]
+        if self.args.bulk_download:
+            with open(self.args.bulk_download, "r") as file:
+                inputs = [url for line in file for url in self.split_input(line.strip())]
+            return [partial(self.expand_url, url) for url in unique_inputs(inputs)]
+        for kind, value in (
+            ("playlist", self.args.playlist),
+            ("album", self.args.album),
+            ("artist", self.args.artist),
+            ("track", self.args.track),
+            ("episode", self.args.episode),
+            ("show", self.args.full_show),
+        ):
+            if value:
+                urls = [
+                    item if "spotify.com" in item else f"https://open.spotify.com/{kind}/{item}"
+                    for item in self.split_input(value)
+                ]
+                expand = self.expand_url_changes if self.incremental else self.expand_url
+                return [partial(expand, url) for url in unique_inputs(urls)]
+        return None
+
+    def plan_downloads(self):
+        """Resolves every track the selected download would get and prints estimates"""
+        sources = self.plan_sources()
+        if sources is None:
+            print("--plan works with playlists, albums, artists, tracks, episodes, shows, liked songs and bulk files")
+            return None
+        plan, collections = self.build_plan(sources)
+        estimate = self.estimate_plan(plan, fetch_durations=True)
+        quality = getattr(self.respot.auth.quality, "name", self.respot.auth.quality)
+        if self.args.all_playlists:
+            waits = collections
+        elif self.args.artist:
+            waits = len({planned.row["grp"] for planned in plan.tracks.values()})
+        else:
+            waits = 0
+        estimate["seconds"] += waits * self.antiban_album_time
+
+        print(f"Plan: {len(plan)} unique track(s) in {plan.rows} location(s)")
+        print(f"    new:       {estimate['new']}")
+        print(f"    present:   {estimate['present']}")
+        print(
+            f"    download:  {FormatUtils.format_size(estimate['bytes'])}"
+            f" as {self.args.audio_format} at {quality} quality"
+        )
+        print(
+            f"    time:      ~{FormatUtils.format_duration(estimate['seconds'])}"
+            f" (antiban {self.args.antiban_time}s per track, {self.antiban_album_time}s"
+            f" per collection, {FormatUtils.format_size(ESTIMATED_STREAM_RATE)}/s per stream assumed)"
+        )
+        print(f"    free:      {FormatUtils.format_size(free_space(self.music_dir))} in {self.music_dir}")
+        if not self.has_free_space(estimate["directories"], quiet=True):
+            print(
+                f"{FormatUtils.RED}Not enough free disk space: a real run would refuse to start"
+                f"{FormatUtils.RESET}"
+            )
+        return estimate
+
+    def build_plan(self, sources):
+        """Expands every collection and returns the plan with the number of collections found"""
+        plan = DownloadPlan()
+        collections = 0
+        for job_id, expand in enumerate(sources):
+            expanded = expand()
+            if not expanded:
+                continue
+            collections += 1
+            for track in expanded["tracks"]:
+                plan.add(
+                    job_id,
+                    {
+                        "track_id": track["id"],
+                        "path": track["path"],
+                        "caller": track["caller"],
+                        "grp": track.get("group"),
+                        "duration_ms": track.get("duration_ms"),
+                    },
+                )
+        return plan, collections
+
+    def has_room_for_download(self):
+        """Plans the selected download and checks its directories keep --min-free-space"""
+        plan, _ = self.build_plan(self.plan_sources())
+        return self.has_free_space(self.estimate_plan(plan)["directories"])
+
+    def is_present(self, track_id):
+        """Returns True if the archive has the track and one of its files exists"""
+        entry = self.archive.get(track_id)
+        if not entry:
+            return False
+        return any(
+            Path(fullpath).is_file()
+            for fullpath in [entry.get("fullpath")] + entry.get("locations", [])
+            if fullpath
+        )
+
+    def estimate_plan(self, plan, fetch_durations=False):
+        """Counts new and present tracks of a plan and estimates the bytes and seconds to get them"""
+        bitrate = output_bitrate(self.respot.auth.quality, self.args.audio_format)
+        extra_bitrates = {
+            audio_format: output_bitrate(self.respot.auth.quality, audio_format)
+            for audio_format in self.extra_formats
+        }
+        workers = self.args.workers if self.args.bulk_download or self.args.resume else 1
+        estimate = {"new": 0, "present": 0, "bytes": 0, "seconds": 0.0, "directories": {}}
+        directories = estimate["directories"]
+        streamed = 0
+        for planned in plan.tracks.values():
+            if self.is_present(planned.row["track_id"]):
+                estimate["present"] += 1
+                continue
+            duration_ms = planned.row["duration_ms"]
+            if duration_ms is None and fetch_durations:
+                # Single tracks and episodes are not listed with their duration
+                track = self.fetch_metadata(planned.row["track_id"], planned.row["caller"])
+                duration_ms = track.get("duration_ms") if track else None
+            size = estimate_bytes(duration_ms, bitrate)
+            copies = planned.duplicates if self.args.link_mode == "copy" else []
+            for row in [planned.row, *copies]:
+                directory = self.episodes_dir if row["caller"] in ("show", "episode") else self.music_dir
+                directories[directory] = directories.get(directory, 0) + size
+            for audio_format, directory in self.extra_formats.items():
+                directories[directory] = (
+                    directories.get(directory, 0) + estimate_bytes(duration_ms, extra_bitrates[audio_format])
+                )
+            estimate["new"] += 1
+            estimate["seconds"] += (self.args.antiban_time + size / ESTIMATED_STREAM_RATE) / workers
+            streamed += size
+        if self.args.max_bandwidth:
+            # The cap is shared, more workers do not get past it
+            estimate["seconds"] = max(estimate["seconds"], streamed / self.args.max_bandwidth)
+        estimate["bytes"] = sum(directories.values())
+        return estimate
+
+    def has_free_space(self, required, quiet=False):
+        """Checks that the download directories keep --min-free-space.
+
+        required maps directories to the bytes about to be written in them,
+        directories on the same filesystem share its free space.
+        """
+        minimum = self.args.min_free_space * 1024 * 1024
+        directories = sorted({self.music_dir, self.episodes_dir, *required}, key=str)
+        needed = {}
+        for directory in directories:
+            device = filesystem(directory)
+            needed[device] = needed.get(device, 0) + required.get(directory, 0)
+        for directory in directories:
+            free = free_space(directory)
+            total = needed[filesystem(directory)]
+            if free - total < minimum:
+                if not quiet:
+                    print(
+                        f"{FormatUtils.RED}Not enough free disk space in {directory}:"
+                        f" {FormatUtils.format_size(free)} free,"
+                        f" {FormatUtils.format_size(total + minimum)} needed"
+                        f" (see --min-free-space){FormatUtils.RESET}"
+                    )
+                return False
         return True
 
+    def job_priority(self, url):
+        """Single tracks go first, then albums, playlists and shows, then discographies"""
+        parsed_url = RespotUtils.parse_url(url)
+        if parsed_url["track"] or parsed_url["episode"]:
+            return INTERACTIVE
+        if parsed_url["artist"]:
+            return BULK
+        return COLLECTION
+
+    def schedule_job(self, scheduler, queue, job, on_done=None, plan=None):
+        """Submits a queued job; it is expanded once, then runs one task per pending track.
+
+        With a plan, the job is already expanded and runs the planned tracks it owns.
+        """
+
+        def expand():
+            self.refresh_file_index()
+            if plan is not None:
+                print(f"Downloading {job['name']}")
+                return [
+                    partial(self.run_track, queue, planned.row, planned.duplicates)
+                    for planned in plan.for_job(job["id"])
+                ]
+            name = job["name"]
+            if not job["expanded"]:
+                expanded = self.expand_url(job["url"])
+                if not expanded:
+                    queue.set_job_state(job["id"], FAILED, "Could not resolve url")
+                    return []
+                name = expanded["name"]
+                queue.set_job_expanded(job["id"], name, expanded["tracks"])
+            print(f"Downloading {name}")
+            return [
+                partial(self.run_track, queue, track)
+                for track in queue.tracks(job["id"], (PENDING,))
+            ]
+
+        def done():
+            finished = queue.get_job(job["id"])
+            progress = queue.progress(job["id"])
+            # Tracks planned for another job may still be running
+            if finished["expanded"] and not progress[PENDING] and not progress[IN_PROGRESS]:
+                self.finish_queued_job(queue, finished)
+                print(f"Finished downloading {finished['name']}")
+            if on_done:
+                on_done()
+
+        return scheduler.submit(self.job_priority(job["url"]), expand, done, job["url"])
+
+    def finish_queued_job(self, queue, job):
+        """Marks a queued job done or failed and applies the album gain of its albums"""
+        queue.finish_job(job["id"])
+        if self.args.replaygain:
+            self.apply_job_album_gain(queue, job)
+
+    def apply_job_album_gain(self, queue, job):
+        """Applies the album gain of every album of a finished job"""
+        albums = {}
+        for row in queue.tracks(job["id"]):
+            if row["caller"] == "album":
+                albums.setdefault(row["grp"], []).append(row["track_id"])
+        for album_id, track_ids in albums.items():
+            name = job["name"] if len(albums) == 1 else f"{job['name']} ({album_id})"
+            self.apply_album_gain(track_ids, name)
+
+    def run_track(self, queue, track, duplicates=()):
+        """Downloads one track of a queued job and records its state.
+
+        duplicates are the rows of other jobs listing the same track, which
+        are placed from the downloaded file and share its state.
+        """
+        rows = [track, *duplicates]
+        for row in rows:
+            queue.set_track_state(row["id"], IN_PROGRESS)
+        targets = []
+        for row in duplicates:
+            target = (row["path"], row["caller"])
+            if target != (track["path"], track["caller"]) and target not in targets:
+                targets.append(target)
+        try:
+            ok = self.download_track(
+                track["track_id"],
+                Path(track["path"]) if track["path"] else None,
+                track["caller"],
+                targets=targets,
+            )
+        except Exception as e:
+            print(f"Failed downloading {track['track_id']}: {e}")
+            for row in rows:
+                queue.set_track_state(row["id"], FAILED, str(e))
+            return False
+        for row in rows:
+            if ok:
+                queue.set_track_state(row["id"], DONE)
+            else:
+                queue.set_track_state(row["id"], FAILED, "Download failed")
+        return ok
+
     def search(self, query):
         if "https" in query:
             self.download_by_url(query)
@@ -607,10 +1923,73 @@ class ZSpotify:
                 self.download_artist(result["id"])
         return True
 
+    def query_archive(self):
+        """Prints or exports the archive entries matching the query filters"""
+        results = self.archive.query(
+            artist=self.args.query_artist,
+            audio_type=self.args.query_type,
+            directory=Path(self.args.query_dir).expanduser().absolute()
+            if self.args.query_dir
+            else None,
+            since=self.args.query_since,
+            until=self.args.query_until,
+            missing=self.args.query_missing,
+        )
+        if self.args.query_count:
+            print(len(results))
+        elif self.args.query_export:
+            if self.args.query_output:
+                with open(self.args.query_output, "w", newline="", encoding="utf-8") as f:
+                    self.archive.export(results, self.args.query_export, f)
+                print(f"Exported {len(results)} entries to {self.args.query_output}")
+            else:
+                self.archive.export(results, self.args.query_export, sys.stdout)
+        else:
+            for track_id, entry in results:
+                print(
+                    f"{track_id}  {entry['artist']} - {entry['track_name']}  {entry['fullpath']}"
+                )
+        return results
+
+    def verify_library(self):
+        """Writes a report of missing, corrupt and orphaned library files"""
+        verifier = LibraryVerifier(
+            self.archive,
+            (self.music_dir, self.episodes_dir),
+            workers=self.args.verify_workers,
+            hash_files=self.args.verify_hash,
+        )
+        print("Verifying library...")
+        report = verifier.run()
+
+        report_file = Path(self.args.verify_report or self.config_dir / "verify-report.json")
+        report_file.parent.mkdir(parents=True, exist_ok=True)
+        verifier.write_report(report, report_file)
+        requeue_file = report_file.with_suffix(".requeue.txt")
+        verifier.write_requeue(report, requeue_file)
+
+        print(
+            f"Checked {report['checked']} archived files: {report['ok']} ok, "
+            f"{len(report['missing'])} missing, {len(report['corrupt'])} corrupt, "
+            f"{len(report['orphaned'])} orphaned"
+        )
+        print(f"Report saved to {report_file}")
+        if report["missing"] or report["corrupt"]:
+            print(f"Re-queue them with: zspotify --bulk-download {requeue_file}")
+        return report
+
     def start(self):
         """Main client loop"""
-        if self.args.version:
-            print(f"ZSpotify {__version__}")
+        if self.args.query:
+            self.query_archive()
+            return
+
+        if self.args.verify:
+            self.verify_library()
+            return
+
+        if self.args.trace_summary:
+            print_summary(self.args.trace_summary)
             return
 
         self.splash()
@@ -625,8 +2004,59 @@ class ZSpotify:
         )
 
         self.archive.archive_migration(paths_to_check)
+        removed = self.staging.clean()
+        if removed:
+            print(f"Removed {removed} unfinished download(s) from {self.staging.root}")
+
+        metrics_writer = None
+        if self.args.metrics_file:
+            metrics_writer = TextfileWriter(self.args.metrics_file, self.args.metrics_interval)
+            metrics_writer.start()
+        if self.args.trace:
+            TRACE.open(self.args.trace)
+        try:
+            self.run()
+        finally:
+            self.archive.close()
+            self.report_memory()
+            if metrics_writer:
+                metrics_writer.stop()
+            TRACE.close()
+
+    def report_memory(self):
+        """Prints the high-water mark of the --memory-budget"""
+        memory = self.respot.memory
+        if memory is None or not memory.high_water and not memory.spilled:
+            return
+        print(
+            f"Peak audio memory: {FormatUtils.format_size(memory.high_water)}"
+            f" of {FormatUtils.format_size(memory.limit)} budget,"
+            f" {memory.spilled} track(s) streamed to disk"
+        )
+
+    def run(self):
+        """Runs the download mode selected on the command line"""
+        if self.args.plan:
+            self.plan_downloads()
+            return
+
+        if self.args.serve:
+            queue = JobQueue(self.config_dir / "serve.db")
+            try:
+                JobServer(
+                    self,
+                    queue,
+                    self.args.serve_host,
+                    self.args.serve_port,
+                    self.args.workers,
+                ).serve_forever()
+            finally:
+                queue.close()
+            return
 
         if self.args.all_playlists:
+            if not self.has_room_for_download():
+                return
             self.download_all_user_playlists()
         elif self.args.select_playlists:
             self.download_select_user_playlists()
@@ -645,6 +2075,8 @@ class ZSpotify:
                 else:
                     self.download_album(album)
         elif self.args.artist:
+            if not self.has_room_for_download():
+                return
             for artist in self.split_input(self.args.artist):
                 if "spotify.com" in self.args.artist:
                     self.download_by_url(artist)
@@ -662,7 +2094,7 @@ class ZSpotify:
                 if "spotify.com" in self.args.episode:
                     self.download_by_url(episode)
                 else:
-                    self.download_track(episode)
+                    self.download_track(episode, caller="episode")
         elif self.args.full_show:
             for show in self.split_input(self.args.full_show):
                 if "spotify.com" in self.args.full_show:
@@ -675,11 +2107,8 @@ class ZSpotify:
                     self.download_by_url(query)
                 else:
                     self.search(query)
-        elif self.args.bulk_download:
-            with open(self.args.bulk_download, "r") as file:
-                for line in file:
-                    for url in self.split_input(line.strip()):
-                        self.download_by_url(url)
+        elif self.args.bulk_download or self.args.resume or self.args.worker:
+            self.bulk_download()
         else:
             while True:
                 self.args.search = input("Search: ")
@@ -692,8 +2121,14 @@ class ZSpotify:
                     print("Invalid input")
 
 
+def _terminate(signum, frame):
+    """Handles SIGTERM like CTRL-C so running jobs checkpoint before exiting"""
+    raise KeyboardInterrupt
+
+
 def main():
     """Creates an instance of ZSpotify"""
+    signal.signal(signal.SIGTERM, _terminate)
     zs = ZSpotify()
 
     try:
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    track_id TEXT NOT NULL,
+    quality TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (track_id, quality)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    track_id TEXT PRIMARY KEY,
+    info TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sources_digest ON sources(digest);
+CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs(last_used);
+"""
+
+
+class SourceCache:
+    """Original streams of downloaded tracks, to encode them again without Spotify.
+
+    Streams are stored by the sha256 of their bytes, so tracks that stream
+    the same audio share one file. An index maps a track id and quality to
+    its stream and records when each stream was last used. Once the cache
+    grows past max_bytes, the least recently used streams are evicted.
+    The track info is kept as long as one of its streams is, so a track
+    can be encoded again without asking Spotify for anything.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.root / "index.db"), timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(_SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def path_for(self, digest):
+        return self.root / digest[:2] / f"{digest}.ogg"
+
+    def get(self, track_id, qualities):
+        """Returns the cached stream of a track in the first of qualities that has one, or None"""
+        with self._lock:
+            for quality in qualities:
+                row = self.db.execute(
+                    "SELECT digest FROM sources WHERE track_id = ? AND quality = ?",
+                    (track_id, quality),
+                ).fetchone()
+                if row is None:
+                    continue
+                path = self.path_for(row[0])
+                if not path.is_file():
+                    continue
+                self.db.execute(
+                    "UPDATE blobs SET last_used = ? WHERE digest = ?", (time.time(), row[0])
+                )
+                self.db.commit()
+                return path
+        return None
+
+    def get_metadata(self, track_id, qualities):
+        """Returns the track info of a track with a cached stream in one of qualities, or None"""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT info FROM metadata WHERE track_id = ? AND EXISTS (SELECT 1 FROM sources"
+                f" WHERE track_id = ? AND quality IN ({', '.join('?' * len(qualities))}))",
+                (track_id, track_id, *qualities),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_metadata(self, track_id, track):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO metadata (track_id, info) VALUES (?, ?)",
+                (track_id, json.dumps(track)),
+            )
+            self.db.commit()
+
+    def put(self, track_id, quality, audio):
+        """Stores the stream read from a file object, returns its path"""
+        audio.seek(0)
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while chunk := audio.read(1 << 20):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            path = self.path_for(digest.hexdigest())
+            path.parent.mkdir(exist_ok=True)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        finally:
+            audio.seek(0)
+
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO sources (track_id, quality, digest) VALUES (?, ?, ?)",
+                (track_id, quality, digest.hexdigest()),
+            )
+            self.db.execute(
+                "INSERT INTO blobs (digest, size, last_used) VALUES (?, ?, ?)"
+                " ON CONFLICT(digest) DO UPDATE SET last_used = excluded.last_used",
+                (digest.hexdigest(), size, time.time()),
+            )
+            self._evict()
+            self.db.commit()
+        return path
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for digest, size in self.db.execute(
+            "SELECT digest, size FROM blobs ORDER BY last_used"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM sources WHERE digest = ?", (digest,))
+            self.db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            self.path_for(digest).unlink(missing_ok=True)
+            total -= size
+        self.db.execute(
+            "DELETE FROM metadata WHERE track_id NOT IN (SELECT track_id FROM sources)"
+        )
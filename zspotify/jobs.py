@@ -0,0 +1,518 @@
+import sqlite3
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+try:
+    from metrics import METRICS, QUEUE_DEPTH
+except ImportError:
+    from .metrics import METRICS, QUEUE_DEPTH
+
+
+PENDING = "pending"
+IN_PROGRESS = "in-progress"
+DONE = "done"
+FAILED = "failed"
+
+INTERACTIVE = 0
+COLLECTION = 1
+BULK = 2
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", COLLECTION: "collection", BULK: "bulk"}
+
+# A running coordinator refreshes its state this often, in seconds
+COORDINATOR_HEARTBEAT = 10.0
+# A running coordinator whose state is older than this is taken for dead
+COORDINATOR_STALE = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL UNIQUE,
+    name TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    expanded INTEGER NOT NULL DEFAULT 0,
+    priority INTEGER NOT NULL DEFAULT 1,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    track_id TEXT NOT NULL,
+    path TEXT,
+    caller TEXT,
+    grp TEXT,
+    duration_ms INTEGER,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    worker TEXT,
+    lease_until REAL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_job_state ON tracks(job_id, state);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class JobQueue:
+    """Persistent queue of download jobs and their tracks, stored in SQLite.
+
+    Every state change is committed right away, so a crashed or killed run
+    can be resumed from the exact track it stopped at.
+
+    A shared queue is used by several worker processes, possibly on other
+    machines through a network volume. Workers claim tracks with a lease
+    they keep renewing, so the tracks of a worker that died are claimed
+    again once its lease runs out.
+    """
+
+    def __init__(self, file, shared=False):
+        self.file = Path(file)
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self.db = sqlite3.connect(str(self.file), timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        # WAL needs shared memory, which network filesystems do not provide
+        self.db.execute("PRAGMA journal_mode=DELETE" if shared else "PRAGMA journal_mode=WAL")
+        self.db.executescript(_SCHEMA)
+        columns = {row["name"] for row in self.db.execute("PRAGMA table_info(tracks)")}
+        # Queues created before these columns were added
+        for column, kind in (("duration_ms", "INTEGER"), ("worker", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE tracks ADD COLUMN {column} {kind}")
+        columns = {row["name"] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        if "priority" not in columns:
+            self.db.execute(f"ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT {COLLECTION}")
+        self.db.commit()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self.db.execute(sql, params)
+            self.db.commit()
+            return cursor
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self.db.execute(sql, params)]
+
+    def clear(self):
+        with self._lock:
+            self.db.execute("DELETE FROM tracks")
+            self.db.execute("DELETE FROM jobs")
+            self.db.commit()
+
+    def add_job(self, url, requeue=False, priority=COLLECTION):
+        """Queues a url, returns its job id.
+
+        An existing job for the same url is kept as it is, unless requeue is
+        set and it already finished, in which case it is expanded and run again.
+        Workers claim the tracks of jobs of a lower priority class first.
+        """
+        now = time.time()
+        with self._lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO jobs (url, priority, created, updated) VALUES (?, ?, ?, ?)",
+                (url, priority, now, now),
+            )
+            job_id = self.db.execute("SELECT id FROM jobs WHERE url = ?", (url,)).fetchone()["id"]
+            if requeue:
+                finished = self.db.execute(
+                    "SELECT 1 FROM jobs WHERE id = ? AND state IN (?, ?)", (job_id, DONE, FAILED)
+                ).fetchone()
+                if finished:
+                    self.db.execute("DELETE FROM tracks WHERE job_id = ?", (job_id,))
+                    self.db.execute(
+                        "UPDATE jobs SET state = ?, expanded = 0, error = NULL, updated = ?"
+                        " WHERE id = ?",
+                        (PENDING, now, job_id),
+                    )
+            self.db.commit()
+        return job_id
+
+    def get_job(self, job_id):
+        jobs = self._query("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return jobs[0] if jobs else None
+
+    def jobs(self, states=None):
+        if states:
+            marks = ",".join("?" * len(states))
+            return self._query(
+                f"SELECT * FROM jobs WHERE state IN ({marks}) ORDER BY id", tuple(states)
+            )
+        return self._query("SELECT * FROM jobs ORDER BY id")
+
+    def set_job_expanded(self, job_id, name, tracks):
+        """Stores the tracks a job expanded into and marks it in progress"""
+        now = time.time()
+        with self._lock:
+            self.db.executemany(
+                "INSERT INTO tracks (job_id, track_id, path, caller, grp, duration_ms, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        job_id,
+                        track["id"],
+                        str(track["path"]) if track["path"] else None,
+                        track["caller"],
+                        track.get("group"),
+                        track.get("duration_ms"),
+                        now,
+                    )
+                    for track in tracks
+                ],
+            )
+            self.db.execute(
+                "UPDATE jobs SET name = ?, expanded = 1, state = ?, updated = ? WHERE id = ?",
+                (name, IN_PROGRESS, now, job_id),
+            )
+            self.db.commit()
+
+    def set_job_state(self, job_id, state, error=None):
+        self._execute(
+            "UPDATE jobs SET state = ?, error = ?, updated = ? WHERE id = ?",
+            (state, error, time.time(), job_id),
+        )
+
+    def finish_job(self, job_id):
+        """Marks a job done, or failed if any of its tracks failed"""
+        failed = self._query(
+            "SELECT COUNT(*) AS n FROM tracks WHERE job_id = ? AND state = ?",
+            (job_id, FAILED),
+        )[0]["n"]
+        if failed:
+            self.set_job_state(job_id, FAILED, f"{failed} track(s) failed")
+        else:
+            self.set_job_state(job_id, DONE)
+
+    def tracks(self, job_id, states=None):
+        if states:
+            marks = ",".join("?" * len(states))
+            return self._query(
+                f"SELECT * FROM tracks WHERE job_id = ? AND state IN ({marks}) ORDER BY id",
+                (job_id, *states),
+            )
+        return self._query("SELECT * FROM tracks WHERE job_id = ? ORDER BY id", (job_id,))
+
+    def set_track_state(self, track_row_id, state, error=None):
+        if state == IN_PROGRESS:
+            self._execute(
+                "UPDATE tracks SET state = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                (state, time.time(), track_row_id),
+            )
+        else:
+            self._execute(
+                "UPDATE tracks SET state = ?, error = ?, updated = ? WHERE id = ?",
+                (state, error, time.time(), track_row_id),
+            )
+
+    def reset_interrupted(self):
+        """Puts tracks that were in progress when a run stopped back to pending"""
+        self._execute(
+            "UPDATE tracks SET state = ?, updated = ? WHERE state = ?",
+            (PENDING, time.time(), IN_PROGRESS),
+        )
+
+    def retry_failed(self, max_attempts):
+        """Puts failed tracks tried fewer than max_attempts times back to pending.
+
+        Their jobs are reopened, as are the jobs whose url could not be
+        resolved. Returns the number of tracks to retry.
+        """
+        now = time.time()
+        with self._lock:
+            retried = self.db.execute(
+                "UPDATE tracks SET state = ?, error = NULL, updated = ?"
+                " WHERE state = ? AND attempts < ?",
+                (PENDING, now, FAILED, max_attempts),
+            ).rowcount
+            self.db.execute(
+                "UPDATE jobs SET state = ?, error = NULL, updated = ? WHERE state = ? AND expanded = 1"
+                " AND EXISTS (SELECT 1 FROM tracks WHERE tracks.job_id = jobs.id AND tracks.state = ?)",
+                (IN_PROGRESS, now, FAILED, PENDING),
+            )
+            self.db.execute(
+                "UPDATE jobs SET state = ?, error = NULL, updated = ? WHERE state = ? AND expanded = 0",
+                (PENDING, now, FAILED),
+            )
+            self.db.commit()
+        return retried
+
+    def claim_track(self, worker, lease):
+        """Claims the next pending track for lease seconds, with every row of the same track.
+
+        Returns the first row and the rows of other jobs listing the track,
+        or None when nothing can be claimed. Tracks of higher priority jobs
+        come first. Tracks whose lease expired, or that were left in progress
+        without a lease by a run that was not a worker, count as pending.
+        """
+        now = time.time()
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT tracks.* FROM tracks JOIN jobs ON jobs.id = tracks.job_id"
+                    " WHERE jobs.state = ? AND (tracks.state = ?"
+                    " OR (tracks.state = ? AND (tracks.lease_until IS NULL OR tracks.lease_until < ?)))"
+                    " ORDER BY jobs.priority, tracks.job_id, tracks.id LIMIT 1",
+                    (IN_PROGRESS, PENDING, IN_PROGRESS, now),
+                ).fetchone()
+                if row is None:
+                    self.db.commit()
+                    return None
+                rows = self.db.execute(
+                    "SELECT * FROM tracks WHERE track_id = ?"
+                    " AND (state = ? OR (state = ? AND (lease_until IS NULL OR lease_until < ?)))"
+                    " ORDER BY id",
+                    (row["track_id"], PENDING, IN_PROGRESS, now),
+                ).fetchall()
+                self.db.executemany(
+                    "UPDATE tracks SET state = ?, worker = ?, lease_until = ?, updated = ?"
+                    " WHERE id = ?",
+                    [(IN_PROGRESS, worker, now + lease, now, r["id"]) for r in rows],
+                )
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+        rows = [dict(r) for r in rows]
+        first = next(r for r in rows if r["id"] == row["id"])
+        return first, [r for r in rows if r is not first]
+
+    def renew_leases(self, worker, lease):
+        """Extends the leases of the tracks a worker is downloading"""
+        self._execute(
+            "UPDATE tracks SET lease_until = ? WHERE worker = ? AND state = ?",
+            (time.time() + lease, worker, IN_PROGRESS),
+        )
+
+    def release_worker(self, worker):
+        """Puts the tracks a stopping worker was downloading back to pending"""
+        self._execute(
+            "UPDATE tracks SET state = ?, lease_until = NULL, updated = ?"
+            " WHERE worker = ? AND state = ?",
+            (PENDING, time.time(), worker, IN_PROGRESS),
+        )
+
+    def finish_completed(self):
+        """Finishes the expanded jobs with no pending or in-progress track left"""
+        finished = self._query(
+            "SELECT id FROM jobs WHERE state = ? AND expanded = 1 AND NOT EXISTS"
+            " (SELECT 1 FROM tracks WHERE tracks.job_id = jobs.id AND tracks.state IN (?, ?))",
+            (IN_PROGRESS, PENDING, IN_PROGRESS),
+        )
+        for job in finished:
+            self.finish_job(job["id"])
+        return len(finished)
+
+    def totals(self):
+        """Returns the number of tracks in every state across all jobs, and of unexpanded jobs"""
+        counts = {PENDING: 0, IN_PROGRESS: 0, DONE: 0, FAILED: 0}
+        for row in self._query("SELECT state, COUNT(*) AS n FROM tracks GROUP BY state"):
+            counts[row["state"]] = row["n"]
+        counts["total"] = sum(counts.values())
+        counts["unexpanded"] = self._query(
+            "SELECT COUNT(*) AS n FROM jobs WHERE state = ? AND expanded = 0", (PENDING,)
+        )[0]["n"]
+        return counts
+
+    def set_coordinator_state(self, state):
+        """Records whether the coordinator of a shared queue is running or done, and when.
+
+        A running coordinator calls this again every COORDINATOR_HEARTBEAT
+        seconds, like a lease.
+        """
+        with self._lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("coordinator", state), ("coordinator_updated", repr(time.time()))],
+            )
+            self.db.commit()
+
+    def coordinator_state(self):
+        """Returns the coordinator state, FAILED for a running one that stopped refreshing it, or None"""
+        rows = {
+            row["key"]: row["value"]
+            for row in self._query(
+                "SELECT key, value FROM meta WHERE key IN ('coordinator', 'coordinator_updated')"
+            )
+        }
+        state = rows.get("coordinator")
+        updated = float(rows.get("coordinator_updated") or 0)
+        if state == IN_PROGRESS and time.time() - updated > COORDINATOR_STALE:
+            return FAILED
+        return state
+
+    def progress(self, job_id):
+        """Returns the number of tracks of a job in every state"""
+        counts = {PENDING: 0, IN_PROGRESS: 0, DONE: 0, FAILED: 0}
+        for row in self._query(
+            "SELECT state, COUNT(*) AS n FROM tracks WHERE job_id = ? GROUP BY state",
+            (job_id,),
+        ):
+            counts[row["state"]] = row["n"]
+        counts["total"] = sum(counts.values())
+        return counts
+
+
+# A class with work left gets the next slot after being passed over this often
+AGING_LIMIT = 8
+
+
+class _ScheduledJob:
+    def __init__(self, priority, expand, on_done, name):
+        self.priority = priority
+        self.expand = expand
+        self.on_done = on_done
+        self.name = name
+        self.tasks = deque()
+        self.expanded = False
+        self.running = 0
+
+
+class Scheduler:
+    """Hands out track slots to jobs by priority class, round-robin within a class.
+
+    Classes are INTERACTIVE (single tracks and episodes), COLLECTION (albums,
+    playlists, shows) and BULK (discographies, whole libraries). A worker
+    takes the next task of the highest class with work left, so a single
+    track submitted during a large sync runs as soon as a slot frees. A lower
+    class passed over AGING_LIMIT times gets the next slot, so a steady stream
+    of higher-priority jobs cannot starve it.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._classes = {INTERACTIVE: deque(), COLLECTION: deque(), BULK: deque()}
+        self._passed = dict.fromkeys(self._classes, 0)
+        self._threads = []
+        self._stopped = False
+
+    def start(self):
+        METRICS.gauge_callback(QUEUE_DEPTH, self._queue_depth_metric)
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker, name=f"zspotify-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def join(self, poll=0.5):
+        """Waits for the workers to finish the task they are running after stop()"""
+        for thread in self._threads:
+            # Joins with a timeout so a second CTRL-C still reaches the main thread
+            while thread.is_alive():
+                thread.join(poll)
+
+    def submit(self, priority, expand, on_done=None, name=None):
+        """Schedules a job; expand runs in a worker and returns the job's task callables"""
+        job = _ScheduledJob(priority, expand, on_done, name)
+        with self._cond:
+            self._classes[priority].append(job)
+            self._cond.notify_all()
+        return job
+
+    def queue_depths(self):
+        """Returns the number of jobs waiting or running per priority class"""
+        with self._cond:
+            return {priority: len(jobs) for priority, jobs in self._classes.items()}
+
+    def _queue_depth_metric(self):
+        with self._cond:
+            return {
+                (("priority", PRIORITY_NAMES[priority]),): sum(len(job.tasks) for job in jobs)
+                for priority, jobs in self._classes.items()
+            }
+
+    def idle(self):
+        with self._cond:
+            return not any(self._classes.values())
+
+    def wait_idle(self, poll=0.5):
+        """Blocks until every submitted job finished"""
+        with self._cond:
+            # Waits with a timeout so CTRL-C and SIGTERM reach the main thread
+            while any(self._classes.values()):
+                self._cond.wait(poll)
+
+    def _next_task(self):
+        with self._cond:
+            while not self._stopped:
+                ready = [
+                    priority
+                    for priority in sorted(self._classes)
+                    if any(not job.expanded or job.tasks for job in self._classes[priority])
+                ]
+                if ready:
+                    chosen = next(
+                        (priority for priority in ready if self._passed[priority] >= AGING_LIMIT),
+                        ready[0],
+                    )
+                    for priority in ready:
+                        self._passed[priority] = 0 if priority == chosen else self._passed[priority] + 1
+                    return self._take(self._classes[chosen])
+                self._cond.wait()
+            return None
+
+    @staticmethod
+    def _take(jobs):
+        """Takes the next task of a class, round-robin over its jobs"""
+        for _ in range(len(jobs)):
+            job = jobs[0]
+            jobs.rotate(-1)
+            if not job.expanded:
+                job.expanded = True
+                job.running += 1
+                return job, None
+            if job.tasks:
+                job.running += 1
+                return job, job.tasks.popleft()
+
+    def _worker(self):
+        while True:
+            item = self._next_task()
+            if item is None:
+                return
+            job, task = item
+            try:
+                if task is None:
+                    tasks = job.expand() or []
+                    with self._cond:
+                        job.tasks.extend(tasks)
+                else:
+                    task()
+            except Exception as e:
+                print(f"Task of job {job.name} failed: {e}")
+            self._task_done(job)
+
+    def _task_done(self, job):
+        with self._cond:
+            job.running -= 1
+            finished = not job.tasks and not job.running
+        if not finished:
+            return
+        if job.on_done:
+            try:
+                job.on_done()
+            except Exception as e:
+                print(f"Finishing job {job.name} failed: {e}")
+        # Removed only after on_done so wait_idle() sees the final job states
+        with self._cond:
+            self._classes[job.priority].remove(job)
+            self._cond.notify_all()
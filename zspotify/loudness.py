@@ -0,0 +1,170 @@
+import numpy as np
+
+
+# ReplayGain 2.0 plays tracks back at this loudness
+REFERENCE_LUFS = -18.0
+
+_ABSOLUTE_GATE = -70.0
+_RELATIVE_GATE = -10.0
+
+# The filter is applied by FFT overlap-save; its impulse response has died
+# out long before _OVERLAP samples at any common sample rate
+_FFT_SIZE = 1 << 16
+_OVERLAP = 1 << 13
+_STEP = _FFT_SIZE - _OVERLAP
+
+
+def _biquad_response(b, a, w):
+    z1 = np.exp(-1j * w)
+    z2 = z1 * z1
+    return (b[0] + b[1] * z1 + b[2] * z2) / (a[0] + a[1] * z1 + a[2] * z2)
+
+
+def k_weighting(sample_rate, n):
+    """Response of the ITU-R BS.1770 K-weighting filter at the rfft bins of n points"""
+    w = 2 * np.pi * np.arange(n // 2 + 1) / n
+
+    # Stage 1: high shelf, the acoustic effect of the head
+    f0, gain, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = np.tan(np.pi * f0 / sample_rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = _biquad_response(
+        ((vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0),
+        (1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0),
+        w,
+    )
+
+    # Stage 2: RLB high pass
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = np.tan(np.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    high_pass = _biquad_response(
+        (1, -2, 1),
+        (1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0),
+        w,
+    )
+    return shelf * high_pass
+
+
+def _power(lufs):
+    return 10 ** ((lufs + 0.691) / 10)
+
+
+def _lufs(power):
+    return -0.691 + 10 * np.log10(power)
+
+
+def integrated_loudness(blocks):
+    """Gated loudness in LUFS of 400 ms block powers, None if it is all silence"""
+    blocks = blocks[blocks > _power(_ABSOLUTE_GATE)]
+    if not len(blocks):
+        return None
+    relative = _lufs(blocks.mean()) + _RELATIVE_GATE
+    blocks = blocks[blocks > _power(relative)]
+    return float(_lufs(blocks.mean()))
+
+
+class TrackLoudness:
+    """Block powers and sample peak of a measured track"""
+
+    def __init__(self, blocks, peak):
+        self.blocks = blocks
+        self.peak = peak
+
+    @property
+    def loudness(self):
+        return integrated_loudness(self.blocks)
+
+    def replaygain(self):
+        """ReplayGain track tags, empty for a silent track"""
+        loudness = self.loudness
+        if loudness is None:
+            return {}
+        return {
+            "REPLAYGAIN_TRACK_GAIN": f"{REFERENCE_LUFS - loudness:+.2f} dB",
+            "REPLAYGAIN_TRACK_PEAK": f"{self.peak:.6f}",
+        }
+
+
+def album_replaygain(tracks):
+    """ReplayGain album tags of measured tracks, gated over all their blocks together"""
+    loudness = integrated_loudness(np.concatenate([track.blocks for track in tracks]))
+    if loudness is None:
+        return {}
+    return {
+        "REPLAYGAIN_ALBUM_GAIN": f"{REFERENCE_LUFS - loudness:+.2f} dB",
+        "REPLAYGAIN_ALBUM_PEAK": f"{max(track.peak for track in tracks):.6f}",
+    }
+
+
+class LoudnessMeter:
+    """Measures EBU R128 loudness of interleaved PCM fed in pieces of any size.
+
+    Samples are K-weighted per channel, their energy summed over 100 ms
+    segments, and four consecutive segments make a 400 ms gating block.
+    """
+
+    def __init__(self, sample_rate, channels, sample_width=2):
+        if sample_width not in (2, 4):
+            raise ValueError(f"Unsupported sample width: {sample_width}")
+        self.channels = channels
+        self._dtype = np.dtype(f"<i{sample_width}")
+        self._scale = float(1 << (8 * sample_width - 1))
+        self._frame_bytes = sample_width * channels
+        self._response = k_weighting(sample_rate, _FFT_SIZE)
+        self._segment = sample_rate // 10
+        self._pending = b""
+        self._history = np.zeros((channels, _OVERLAP))
+        self._input = np.zeros((channels, 0))
+        self._energy = np.zeros(0)
+        self._segments = []
+        self.peak = 0.0
+
+    def add(self, pcm):
+        """Feeds interleaved little-endian PCM bytes"""
+        if self._pending:
+            pcm = self._pending + bytes(pcm)
+        pcm = memoryview(pcm)
+        usable = len(pcm) - len(pcm) % self._frame_bytes
+        self._pending = bytes(pcm[usable:])
+        # Converted a filter step at a time, a whole track as floats is too big
+        piece = _STEP * self._frame_bytes
+        for start in range(0, usable, piece):
+            samples = np.frombuffer(pcm[start:min(start + piece, usable)], dtype=self._dtype)
+            frames = samples.reshape(-1, self.channels).T / self._scale
+            if frames.size:
+                self.peak = max(self.peak, float(np.abs(frames).max()))
+            self._input = np.concatenate([self._input, frames], axis=1)
+            while self._input.shape[1] >= _STEP:
+                self._accumulate(self._filter(self._input[:, :_STEP]))
+                self._input = self._input[:, _STEP:]
+
+    def _filter(self, block):
+        """K-weights a block of _STEP frames following the ones already filtered"""
+        buffer = np.concatenate([self._history, block], axis=1)
+        self._history = buffer[:, -_OVERLAP:]
+        spectrum = np.fft.rfft(buffer, axis=1) * self._response
+        return np.fft.irfft(spectrum, n=_FFT_SIZE, axis=1)[:, _OVERLAP:]
+
+    def _accumulate(self, weighted):
+        energy = np.concatenate([self._energy, (weighted * weighted).sum(axis=0)])
+        full = len(energy) - len(energy) % self._segment
+        if full:
+            self._segments.append(energy[:full].reshape(-1, self._segment).sum(axis=1))
+        self._energy = energy[full:]
+
+    def result(self):
+        """Returns the TrackLoudness of everything fed so far"""
+        remaining = self._input.shape[1]
+        if remaining:
+            padded = np.pad(self._input, ((0, 0), (0, _STEP - remaining)))
+            self._accumulate(self._filter(padded)[:, :remaining])
+            self._input = self._input[:, :0]
+        segments = np.concatenate(self._segments) if self._segments else np.zeros(0)
+        if len(segments) < 4:
+            blocks = np.zeros(0)
+        else:
+            blocks = np.convolve(segments, np.ones(4), "valid") / (4 * self._segment)
+        return TrackLoudness(blocks, self.peak)
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from tracing import TRACE
+except ImportError:
+    from .tracing import TRACE
+
+
+TRACKS = "zspotify_tracks_total"
+DOWNLOADED_BYTES = "zspotify_downloaded_bytes_total"
+STAGE_SECONDS = "zspotify_stage_seconds"
+API_SECONDS = "zspotify_api_request_seconds"
+RETRIES = "zspotify_retries_total"
+RATE_LIMITED = "zspotify_rate_limited_total"
+QUEUE_DEPTH = "zspotify_queue_depth"
+AUDIO_MEMORY = "zspotify_audio_memory_bytes"
+
+_HELP = {
+    TRACKS: ("counter", "Tracks handled, by result (completed, linked, skipped, failed)"),
+    DOWNLOADED_BYTES: ("counter", "Audio bytes downloaded from Spotify"),
+    STAGE_SECONDS: ("histogram", "Time spent in each stage of a track download"),
+    API_SECONDS: ("histogram", "Latency of Spotify Web API requests"),
+    RETRIES: ("counter", "Retried API requests and audio reads"),
+    RATE_LIMITED: ("counter", "Web API responses with status 429"),
+    QUEUE_DEPTH: ("gauge", "Tracks waiting to be downloaded, by priority class"),
+    AUDIO_MEMORY: ("gauge", "Audio bytes reserved in memory, their high-water mark and the budget"),
+}
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_context = threading.local()
+
+
+def current_job_type():
+    return getattr(_context, "job_type", "none")
+
+
+@contextmanager
+def job_type(name):
+    """Labels the metrics recorded by this thread with the job type"""
+    previous = getattr(_context, "job_type", None)
+    _context.job_type = name
+    try:
+        yield
+    finally:
+        _context.job_type = previous
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms in Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauge_callbacks = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        labels.setdefault("job_type", current_job_type())
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        labels.setdefault("job_type", current_job_type())
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge_callback(self, name, callback):
+        """Registers a function returning {labels tuple: value} read on every render"""
+        with self._lock:
+            self._gauge_callbacks[name] = callback
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self._histograms.items()}
+            callbacks = dict(self._gauge_callbacks)
+
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms.items():
+            lines = samples.setdefault(name, [])
+            for bound, n in zip(BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {n}")
+            lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, callback in callbacks.items():
+            for labels, value in callback().items():
+                samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+
+        out = []
+        for name in sorted(samples):
+            kind, help_text = _HELP.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(samples[name])
+        return "\n".join(out) + "\n"
+
+    def write_textfile(self, file):
+        """Atomically rewrites a textfile for the node_exporter textfile collector"""
+        tmp_file = f"{file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_file, file)
+
+
+METRICS = Metrics()
+
+
+@contextmanager
+def stage(name):
+    """Times a stage of the current track download, for the metrics and the trace"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        end = time.monotonic()
+        METRICS.observe(STAGE_SECONDS, end - start, stage=name)
+        TRACE.stage(name, start, end)
+
+
+class TextfileWriter:
+    """Rewrites the metrics textfile periodically from a background thread"""
+
+    def __init__(self, file, interval=15):
+        self.file = file
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="zspotify-metrics", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            METRICS.write_textfile(self.file)
+        except OSError as e:
+            print(f"Unable to write metrics to {self.file}: {e}")
+
+    def stop(self):
+        self._stop.set()
+        self.write()
@@ -0,0 +1,132 @@
+import shutil
+from pathlib import Path
+
+try:
+    from respot import RespotUtils, QUALITY_BITRATES
+except ImportError:
+    from .respot import RespotUtils, QUALITY_BITRATES
+
+# Assumed speed of one audio stream, only used to estimate run times
+ESTIMATED_STREAM_RATE = 1 << 20
+
+# Assumed length of tracks whose listing has no duration
+DEFAULT_DURATION_MS = 210_000
+
+
+def canonical_url(url):
+    """Returns the open.spotify.com url of a uri or url, or None if it is neither"""
+    for kind, spotify_id in RespotUtils.parse_url(url.strip()).items():
+        if spotify_id:
+            return f"https://open.spotify.com/{kind}/{spotify_id}"
+    return None
+
+
+def unique_inputs(inputs):
+    """Returns the inputs in order with duplicates removed.
+
+    Uris, share links and localized urls of the same item count as one.
+    Inputs that do not parse are kept as they are, so they fail visibly.
+    """
+    seen = set()
+    unique = []
+    for text in inputs:
+        text = text.strip()
+        if not text:
+            continue
+        url = canonical_url(text) or text
+        if url not in seen:
+            seen.add(url)
+            unique.append(url)
+    return unique
+
+
+class PlannedTrack:
+    """A unique track of a plan and the queued rows of every job listing it"""
+
+    def __init__(self, job_id, row, priority=0):
+        self.job_id = job_id
+        self.row = row
+        self.priority = priority
+        self.duplicates = []
+
+    def add(self, row):
+        self.duplicates.append(row)
+
+    def take_over(self, job_id, row, priority):
+        """Makes another job the one downloading the track"""
+        self.duplicates.append(self.row)
+        self.job_id = job_id
+        self.row = row
+        self.priority = priority
+
+
+class DownloadPlan:
+    """Unique tracks of a set of queued jobs, in job order.
+
+    A track listed by several jobs, such as an album track that is in a
+    playlist as well, is downloaded once for the job of the highest priority
+    class listing it, the first one among equals, and placed in the
+    locations of the other jobs from that file.
+    """
+
+    def __init__(self):
+        self.tracks = {}
+        self._by_job = {}
+        self.rows = 0
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def add(self, job_id, row, priority=0):
+        """Adds a queued track row, returns True if its track is new to the plan.
+
+        priority is the class of the job, lower runs first.
+        """
+        self.rows += 1
+        planned = self.tracks.get(row["track_id"])
+        if planned is None:
+            planned = self.tracks[row["track_id"]] = PlannedTrack(job_id, row, priority)
+            self._by_job.setdefault(job_id, []).append(planned)
+            return True
+        if priority < planned.priority:
+            self._by_job[planned.job_id].remove(planned)
+            planned.take_over(job_id, row, priority)
+            self._by_job.setdefault(job_id, []).append(planned)
+        else:
+            planned.add(row)
+        return False
+
+    def for_job(self, job_id):
+        """Returns the planned tracks a job downloads"""
+        return self._by_job.get(job_id, [])
+
+
+def output_bitrate(quality, audio_format):
+    """Bits per second of the files written for an AudioQuality and output format"""
+    name = getattr(quality, "name", str(quality))
+    if audio_format == "mp3":
+        # Same bitrates as RespotTrackHandler.convert_audio_format
+        return 320_000 if name == "VERY_HIGH" else 160_000
+    return QUALITY_BITRATES.get(name, QUALITY_BITRATES["HIGH"])
+
+
+def estimate_bytes(duration_ms, bitrate):
+    return (duration_ms or DEFAULT_DURATION_MS) * bitrate // 8000
+
+
+def _existing(path):
+    """The deepest existing folder of path"""
+    path = Path(path).absolute()
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+def free_space(path):
+    """Free bytes on the filesystem path is or will be created on"""
+    return shutil.disk_usage(_existing(path)).free
+
+
+def filesystem(path):
+    """Device id of the filesystem path is or will be created on"""
+    return _existing(path).stat().st_dev
@@ -1,24 +1,72 @@
 from io import BytesIO
 from pathlib import Path
+import errno
 import json
+import os
 import re
-import requests
+import socket
 import time
 import shutil
+import subprocess
+import tempfile
+import threading
 
-from librespot.audio.decoders import AudioQuality, VorbisOnlyAudioQuality
-from librespot.core import ApiClient, Session
-from librespot.metadata import TrackId, EpisodeId
-from pydub import AudioSegment
-from tqdm import tqdm
+# librespot, pydub, tqdm and requests take seconds to import on slow machines,
+# so they are imported where they are used, not by commands that never log in
 
+try:
+    from metrics import METRICS, stage, API_SECONDS, DOWNLOADED_BYTES, RETRIES, RATE_LIMITED
+    from metrics import AUDIO_MEMORY
+    from tracing import TRACE
+    from throttle import TokenBucket, MemoryBudget
+except ImportError:
+    from .metrics import METRICS, stage, API_SECONDS, DOWNLOADED_BYTES, RETRIES, RATE_LIMITED
+    from .metrics import AUDIO_MEMORY
+    from .tracing import TRACE
+    from .throttle import TokenBucket, MemoryBudget
 
-API_ME = "https://api.spotify.com/v1/me/"
+
+# Overridable to point the client at a local stand-in, e.g. for benchmarks
+API_URL = os.environ.get("ZSPOTIFY_API_URL", "https://api.spotify.com/v1/").rstrip("/") + "/"
+API_ME = API_URL + "me/"
+
+# Vorbis bitrates Spotify streams at per AudioQuality
+QUALITY_BITRATES = {"NORMAL": 96_000, "HIGH": 160_000, "VERY_HIGH": 320_000}
+
+
+def quality_name(quality):
+    """Name of an AudioQuality, e.g. VERY_HIGH"""
+    return getattr(quality, "name", str(quality))
+
+
+# 16 bit stereo at 44.1 kHz, what pydub decodes a stream to before converting
+PCM_BITRATE = 1_411_200
+
+
+def loudness_meter(sample_rate, channels, sample_width=2):
+    """Returns a LoudnessMeter; numpy is only imported by runs that measure loudness"""
+    try:
+        from loudness import LoudnessMeter
+    except ImportError:
+        from .loudness import LoudnessMeter
+    return LoudnessMeter(sample_rate, channels, sample_width)
 
 
 class Respot:
     def __init__(
-        self, config_dir, force_premium, credentials, audio_format, antiban_wait_time
+        self,
+        config_dir,
+        force_premium,
+        credentials,
+        audio_format,
+        antiban_wait_time,
+        max_bandwidth=0,
+        bandwidth_burst=0,
+        memory_budget=0,
+        accounts=(),
+        account_rate=0,
+        source_cache=None,
+        replaygain=False,
     ):
         self.config_dir: Path = config_dir
         self.credentials: Path = credentials
@@ -27,48 +75,152 @@ class Respot:
         self.antiban_wait_time: int = antiban_wait_time
         self.auth: RespotAuth = RespotAuth(self.credentials, self.force_premium)
         self.request: RespotRequest = None
+        self.accounts = [Path(account) for account in accounts]
+        self.account_rate = account_rate
+        self.pool: RespotAccountPool = None
+        # One bucket shared by every download, so the cap holds across workers
+        self.bandwidth: TokenBucket = (
+            TokenBucket(max_bandwidth, bandwidth_burst) if max_bandwidth else None
+        )
+        self.memory: MemoryBudget = MemoryBudget(memory_budget) if memory_budget else None
+        if self.memory:
+            METRICS.gauge_callback(AUDIO_MEMORY, self._memory_metric)
+        self.cache = source_cache
+        self.replaygain = replaygain
 
     def is_authenticated(self, username=None, password=None) -> bool:
         if self.auth.login(username, password):
             self.request = RespotRequest(self.auth)
+            if self.accounts or self.account_rate:
+                self.pool = RespotAccountPool.login(
+                    self.auth, self.accounts, self.force_premium, self.account_rate
+                )
             return True
         return False
 
-    def download(self, track_id, temp_path: Path, extension, make_dirs=True) -> str:
-        handler = RespotTrackHandler(
-            self.auth, self.audio_format, self.antiban_wait_time, self.auth.quality
+    def _memory_metric(self):
+        return {
+            (("state", "reserved"),): self.memory.reserved,
+            (("state", "high_water"),): self.memory.high_water,
+            (("state", "limit"),): self.memory.limit,
+        }
+
+    def _handler(self, auth):
+        return RespotTrackHandler(
+            auth,
+            self.audio_format,
+            self.antiban_wait_time,
+            auth.quality,
+            self.bandwidth,
+            self.memory,
         )
+
+    def download(self, track_id, temp_path: Path, extension, make_dirs=True, extra_formats=()):
+        """Downloads a track and saves it in every format from one fetch.
+
+        Returns the paths of the files written next to temp_path, in the
+        order of extension and extra_formats, or an empty list on failure,
+        and the TrackLoudness measured while decoding if replaygain is on.
+        """
         if make_dirs:
-            handler.create_out_dirs(temp_path.parent)
+            RespotTrackHandler.create_out_dirs(temp_path.parent)
 
-        # Download the audio
         filename = temp_path.stem
-        audio_bytes = handler.download_audio(track_id, filename)
-
+        formats = [extension, *extra_formats]
+        convert = self.replaygain or any(
+            audio_format not in ("source", "ogg") for audio_format in formats
+        )
+        handler, audio_bytes = self._load_cached(track_id, temp_path.parent, convert)
         if audio_bytes is None:
-            return ""
+            handler, audio_bytes = self._download_audio(track_id, filename, temp_path.parent, convert)
+            if audio_bytes is None:
+                return [], None
+            if self.cache and handler.complete:
+                self.cache.put(track_id, quality_name(handler.quality), audio_bytes)
+
+        try:
+            return self._save(handler, audio_bytes, temp_path, formats, self.replaygain)
+        finally:
+            handler.release(audio_bytes)
+
+    def _cache_qualities(self):
+        # A stream of better quality than this account gets is just as good
+        names = list(QUALITY_BITRATES)
+        return names[names.index(quality_name(self.auth.quality)):][::-1]
+
+    def cached_metadata(self, track_id):
+        """Returns the track info kept with a usable stream in the source cache, or None"""
+        if self.cache is None:
+            return None
+        return self.cache.get_metadata(track_id, self._cache_qualities())
+
+    def cache_metadata(self, track_id, track):
+        """Keeps the track info of a downloaded track with its stream in the source cache"""
+        if self.cache is not None:
+            self.cache.put_metadata(track_id, track)
+
+    def _load_cached(self, track_id, spill_dir, convert):
+        """Returns the handler and audio of a track from the source cache, or None audio"""
+        handler = self._handler(self.auth)
+        if self.cache is None:
+            return handler, None
+        path = self.cache.get(track_id, self._cache_qualities())
+        TRACE.cache("source", path is not None)
+        if path is None:
+            return handler, None
+        return handler, handler.load_audio(path, spill_dir, convert)
+
+    def _download_audio(self, track_id, filename, spill_dir, convert):
+        """Streams a track from Spotify, returns the handler and audio, None on failure"""
+        if self.pool is None:
+            handler = self._handler(self.auth)
+            audio_bytes = handler.download_audio(track_id, filename, spill_dir, convert)
+        else:
+            # An account that fails is benched and the track tried on another one
+            for _ in range(len(self.pool)):
+                account = self.pool.acquire()
+                TRACE.set("account", account.name)
+                handler = self._handler(account.auth)
+                audio_bytes = handler.download_audio(track_id, filename, spill_dir, convert)
+                failed = RespotAccountPool.is_account_failure(handler.error)
+                self.pool.release(account, handler.error if failed else None)
+                if not failed:
+                    break
+        return handler, audio_bytes
+
+    @staticmethod
+    def _save(handler, audio_bytes, temp_path, formats, analyze=False):
+        filename = temp_path.stem
 
         # Determine format of file downloaded
         audio_bytes_format = handler.determine_file_extension(audio_bytes)
 
         # Format handling
-        output_path = temp_path
-
-        if extension == audio_bytes_format:
-            print(f"Saving {output_path.stem} directly")
-            handler.bytes_to_file(audio_bytes, output_path)
-        elif extension == "source":
-            output_str = filename + "." + audio_bytes_format
-            output_path = temp_path.parent / output_str
-            print(f"Saving {filename} as {extension}")
-            handler.bytes_to_file(audio_bytes, output_path)
-        else:
-            output_str = filename + "." + extension
-            output_path = temp_path.parent / output_str
-            print(f"Converting {filename} to {extension}")
-            handler.convert_audio_format(audio_bytes, output_path)
+        output_paths = []
+        conversions = {}
+        loudness = None
+        with stage("convert"):
+            for extension in formats:
+                if extension == "source":
+                    print(f"Saving {filename} as {extension}")
+                    extension = audio_bytes_format
+                output_path = temp_path.parent / (filename + "." + extension)
+                if output_path in output_paths:
+                    # An extra format the source already is in, such as ogg
+                    # next to source, is staged as a file of its own
+                    output_path = temp_path.parent / f"{filename}.{len(output_paths)}.{extension}"
+                output_paths.append(output_path)
+                if extension == audio_bytes_format:
+                    print(f"Saving {output_path.name} directly")
+                    handler.bytes_to_file(audio_bytes, output_path)
+                else:
+                    conversions[output_path] = extension
+            if conversions:
+                print(f"Converting {filename} to {', '.join(conversions.values())}")
+            if conversions or analyze:
+                loudness = handler.convert_audio_format(audio_bytes, conversions, analyze)
 
-        return output_path
+        return output_paths, loudness
 
 
 class RespotAuth:
@@ -110,6 +262,8 @@ class RespotAuth:
             return False
 
     def _authenticate_with_user_pass(self, username, password) -> bool:
+        from librespot.core import Session
+
         try:
             self.session = Session.Builder().user_pass(username, password).create()
             self._persist_credentials_file()
@@ -119,6 +273,8 @@ class RespotAuth:
             return False
 
     def refresh_token(self) -> (str, str):
+        from librespot.core import Session
+
         self.session = (
             Session.Builder()
             .stored_file(stored_credentials=str(self.credentials))
@@ -132,6 +288,8 @@ class RespotAuth:
 
     def _check_premium(self) -> None:
         """If user has Spotify premium, return true"""
+        from librespot.audio.decoders import AudioQuality
+
         if not self.session:
             raise RuntimeError("You must login first")
 
@@ -144,38 +302,190 @@ class RespotAuth:
             print("[ DETECTED FREE ACCOUNT - USING HIGH QUALITY ]\n")
 
 
+class RespotAccount:
+    """An account of the pool: its session, quality and download pacing"""
+
+    def __init__(self, auth: RespotAuth):
+        self.auth = auth
+        self.name = auth.credentials.stem
+        self.next_start = 0.0
+        self.active = 0
+        self.failures = 0
+        self.benched_until = 0.0
+        self.stale = False
+        self.lock = threading.Lock()
+
+
+class RespotAccountPool:
+    """Spreads audio downloads across accounts, each with its own session.
+
+    Every account starts at most rate downloads per minute. An account whose
+    session fails or that gets throttled sits out a cooldown, doubled with
+    every failure in a row, and logs in again before its next download.
+    """
+
+    COOLDOWN = 60
+    MAX_COOLDOWN = 3600
+
+    # Waits for a download slot shorter than this are not worth a message
+    QUIET_WAIT = 5
+
+    # Socket errors of the network or the session, unlike a full disk or a denied write
+    NETWORK_ERRNOS = {errno.ENETDOWN, errno.ENETUNREACH, errno.ENETRESET, errno.EHOSTUNREACH}
+
+    def __init__(self, accounts, rate=0):
+        self.accounts = accounts
+        self.interval = 60 / rate if rate else 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.accounts)
+
+    @classmethod
+    def login(cls, primary, credentials, force_premium, rate=0):
+        """Returns a pool of the logged in primary auth and the accounts that log in"""
+        accounts = [RespotAccount(primary)]
+        for file in credentials:
+            print(f"Logging in account {file}")
+            auth = RespotAuth(file, force_premium)
+            if auth.login(None, None):
+                accounts.append(RespotAccount(auth))
+            else:
+                print(f"Unable to log in with {file}, skipping the account")
+        return cls(accounts, rate)
+
+    @staticmethod
+    def is_account_failure(error) -> bool:
+        """Whether a download error is the account's, not the track's"""
+        if error is None:
+            return False
+        # Throttled accounts stop getting audio keys, dead sessions fail on the socket
+        if isinstance(error, (ConnectionError, TimeoutError, socket.herror, socket.gaierror)):
+            return True
+        if isinstance(error, OSError):
+            return error.errno in RespotAccountPool.NETWORK_ERRNOS
+        return "audio key" in str(error).lower()
+
+    def acquire(self) -> RespotAccount:
+        """Waits for the account that can start a download first and returns it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                ready = [a for a in self.accounts if a.benched_until <= now]
+                if ready:
+                    account = min(ready, key=lambda a: (max(a.next_start, now), a.active))
+                    start = max(account.next_start, now)
+                    account.next_start = start + self.interval
+                    account.active += 1
+                    wait = start - now
+                else:
+                    account = None
+                    wait = min(a.benched_until for a in self.accounts) - now
+            if wait >= self.QUIET_WAIT:
+                if account is None:
+                    print(f"Every account is cooling down, waiting {wait:.0f}s")
+                else:
+                    print(f"Waiting {wait:.0f}s for the next download slot of account {account.name}")
+            time.sleep(max(wait, 0))
+            if account is None:
+                continue
+            if self._refresh(account):
+                return account
+            self.release(account, RuntimeError("login failed"))
+
+    def _refresh(self, account) -> bool:
+        """Logs a benched account in again, returns False if that fails"""
+        with account.lock:
+            if not account.stale:
+                return True
+            old_session = account.auth.session
+            try:
+                account.auth.refresh_token()
+            except Exception:
+                return False
+            if old_session is not None and old_session is not account.auth.session:
+                # Its socket and threads stay alive until closed
+                try:
+                    old_session.close()
+                except Exception:
+                    pass
+            account.stale = False
+            return True
+
+    def release(self, account, error=None) -> None:
+        """Hands an account back, benching it if error is set"""
+        with self._lock:
+            account.active -= 1
+            if error is None:
+                account.failures = 0
+                return
+            account.failures += 1
+            cooldown = min(self.COOLDOWN * 2 ** (account.failures - 1), self.MAX_COOLDOWN)
+            account.benched_until = time.monotonic() + cooldown
+            account.stale = True
+        print(f"Account {account.name} taken out of rotation for {cooldown}s: {error}")
+
+
 class RespotRequest:
+    # 429 responses have their own budget, the throttling can outlast a few retries
+    MAX_RATE_LIMITED = 10
+    MAX_RETRY_AFTER = 60
+
     def __init__(self, auth: RespotAuth):
         self.auth = auth
         self.token = auth.token
         self.token_your_library = auth.token_your_library
+        import requests
+
+        # Keep-alive connection pool shared by every Web API request
+        self.session = requests.Session()
+
+    def authorized_get_request(self, url: str, retry_count: int = 0, rate_limited: int = 0, **kwargs):
+        import requests
 
-    def authorized_get_request(self, url: str, retry_count: int = 0, **kwargs):
         if retry_count > 3:
             raise RuntimeError("Connection Error: Too many retries")
 
         try:
-            response = requests.get(
-                url,
-                headers={
-                    "Authorization": f"Bearer {self.token_your_library if url.startswith(API_ME) else self.token}"
-                },
-                **kwargs,
-            )
+            TRACE.add("api_calls")
+            with METRICS.time(API_SECONDS):
+                response = self.session.get(
+                    url,
+                    headers={
+                        "Authorization": f"Bearer {self.token_your_library if url.startswith(API_ME) else self.token}"
+                    },
+                    **kwargs,
+                )
             if response.status_code == 401:
                 print("Token expired, refreshing...")
+                METRICS.inc(RETRIES, kind="api")
                 self.token, self.token_your_library = self.auth.refresh_token()
-                return self.authorized_get_request(url, retry_count + 1, **kwargs)
+                return self.authorized_get_request(url, retry_count + 1, rate_limited, **kwargs)
+            if response.status_code == 429:
+                if rate_limited >= self.MAX_RATE_LIMITED:
+                    raise RuntimeError("Rate limited: Too many retries")
+                try:
+                    retry_after = int(response.headers.get("Retry-After", 1))
+                except ValueError:
+                    retry_after = 1
+                retry_after = min(max(retry_after, 1), self.MAX_RETRY_AFTER)
+                print(f"Rate limited, retrying in {retry_after} second(s)...")
+                METRICS.inc(RATE_LIMITED)
+                TRACE.add("rate_limited")
+                METRICS.inc(RETRIES, kind="api")
+                time.sleep(retry_after)
+                return self.authorized_get_request(url, retry_count, rate_limited + 1, **kwargs)
             return response
         except requests.exceptions.ConnectionError:
-            return self.authorized_get_request(url, retry_count + 1, **kwargs)
+            METRICS.inc(RETRIES, kind="api")
+            return self.authorized_get_request(url, retry_count + 1, rate_limited, **kwargs)
 
     def get_track_info(self, track_id) -> dict:
         """Retrieves metadata for downloaded songs"""
         try:
             info = json.loads(
                 self.authorized_get_request(
-                    "https://api.spotify.com/v1/tracks?ids="
+                    API_URL + "tracks?ids="
                     + track_id
                     + "&market=from_token"
                 ).text
@@ -208,6 +518,7 @@ class RespotRequest:
                 "scraped_song_id": info["tracks"][0]["id"],
                 "is_playable": info["tracks"][0]["is_playable"],
                 "release_date": info["tracks"][0]["album"]["release_date"],
+                "duration_ms": info["tracks"][0].get("duration_ms"),
             }
 
         except Exception as e:
@@ -243,7 +554,7 @@ class RespotRequest:
 
         while True:
             resp = self.authorized_get_request(
-                f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks",
+                f"{API_URL}playlists/{playlist_id}/tracks",
                 params={"limit": limit, "offset": offset},
             ).json()
             offset += limit
@@ -254,6 +565,7 @@ class RespotRequest:
                             "id": song["track"]["id"],
                             "name": song["track"]["name"],
                             "artist": song["track"]["artists"][0]["name"],
+                            "duration_ms": song["track"].get("duration_ms"),
                         }
                     )
 
@@ -264,12 +576,13 @@ class RespotRequest:
     def get_playlist_info(self, playlist_id):
         """Returns information scraped from playlist"""
         resp = self.authorized_get_request(
-            f"https://api.spotify.com/v1/playlists/{playlist_id}?fields=name,owner(display_name)&market=from_token"
+            f"{API_URL}playlists/{playlist_id}?fields=name,owner(display_name),snapshot_id&market=from_token"
         ).json()
         return {
             "name": resp["name"].strip(),
             "owner": resp["owner"]["display_name"].strip(),
             "id": playlist_id,
+            "snapshot_id": resp.get("snapshot_id"),
         }
 
     def get_album_songs(self, album_id):
@@ -281,7 +594,7 @@ class RespotRequest:
 
         while True:
             resp = self.authorized_get_request(
-                f"https://api.spotify.com/v1/albums/{album_id}/tracks",
+                f"{API_URL}albums/{album_id}/tracks",
                 params={
                     "limit": limit,
                     "include_groups": include_groups,
@@ -296,6 +609,7 @@ class RespotRequest:
                         "name": song["name"],
                         "number": song["track_number"],
                         "disc_number": song["disc_number"],
+                        "duration_ms": song.get("duration_ms"),
                     }
                 )
 
@@ -307,7 +621,7 @@ class RespotRequest:
     def get_album_info(self, album_id):
         """Returns album name"""
         resp = self.authorized_get_request(
-            f"https://api.spotify.com/v1/albums/{album_id}"
+            f"{API_URL}albums/{album_id}"
         ).json()
 
         artists = []
@@ -338,7 +652,7 @@ class RespotRequest:
 
         albums = []
         resp = self.authorized_get_request(
-            f"https://api.spotify.com/v1/artists/{artists_id}/albums",
+            f"{API_URL}artists/{artists_id}/albums",
             params={"limit": limit, "include_groups": include_groups, "offset": offset},
         ).json()
         print("###   Albums   ###")
@@ -365,8 +679,12 @@ class RespotRequest:
                 )
         return resp["items"]
 
-    def get_liked_tracks(self):
-        """Returns user's saved tracks"""
+    def get_liked_tracks(self, since=None):
+        """Returns user's saved tracks, newest first.
+
+        If since is given, paging stops at the first track saved at or
+        before that added_at timestamp.
+        """
         songs = []
         offset = 0
         limit = 50
@@ -378,11 +696,15 @@ class RespotRequest:
             ).json()
             offset += limit
             for song in resp["items"]:
+                if since and song["added_at"] <= since:
+                    return songs
                 songs.append(
                     {
                         "id": song["track"]["id"],
                         "name": song["track"]["name"],
                         "artist": song["track"]["artists"][0]["name"],
+                        "added_at": song["added_at"],
+                        "duration_ms": song["track"].get("duration_ms"),
                     }
                 )
 
@@ -397,7 +719,7 @@ class RespotRequest:
         try:
             info = json.loads(
                 self.authorized_get_request(
-                    "https://api.spotify.com/v1/artists/" + artist_id
+                    API_URL + "artists/" + artist_id
                 ).text
             )
 
@@ -413,11 +735,28 @@ class RespotRequest:
     def get_episode_info(self, episode_id_str):
         info = json.loads(
             self.authorized_get_request(
-                "https://api.spotify.com/v1/episodes/" + episode_id_str
+                API_URL + "episodes/" + episode_id_str
             ).text
         )
         if not info:
             return None
+        return self._parse_episode_info(info)
+
+    def get_episodes_info(self, episode_ids):
+        """Returns metadata of many episodes, 50 per request, keyed by id"""
+        episodes = {}
+        for i in range(0, len(episode_ids), 50):
+            resp = self.authorized_get_request(
+                API_URL + "episodes",
+                params={"ids": ",".join(episode_ids[i:i + 50]), "market": "from_token"},
+            ).json()
+            for info in resp.get("episodes", []):
+                if info:
+                    episodes[info["id"]] = self._parse_episode_info(info)
+        return episodes
+
+    @staticmethod
+    def _parse_episode_info(info):
         sum_total = []
         for sum_px in info["images"]:
             sum_total.append(sum_px["height"] + sum_px["width"])
@@ -425,7 +764,7 @@ class RespotRequest:
         img_index = sum_total.index(max(sum_total)) if sum_total else -1
 
         return {
-            "id": episode_id_str,
+            "id": info["id"],
             "artist_id": info["show"]["id"],
             "artist_name": info["show"]["publisher"],
             "show_name": RespotUtils.sanitize_data(info["show"]["name"]),
@@ -434,29 +773,42 @@ class RespotRequest:
             "release_year": info["release_date"].split("-")[0],
             "disc_number": None,
             "audio_number": None,
-            "scraped_episode_id": ["id"],
+            "scraped_episode_id": info["id"],
             "is_playable": info["is_playable"],
             "release_date": info["release_date"],
+            "duration_ms": info.get("duration_ms"),
         }
 
-    def get_show_episodes(self, show_id):
-        """returns episodes of a show"""
+    def get_show_episodes(self, show_id, known=None, since=None):
+        """returns episodes of a show, newest first.
+
+        With since, paging stops at the first episode released before that
+        date; episodes whose id is in known are left out.
+        """
         episodes = []
         offset = 0
         limit = 50
+        known = known or ()
 
         while True:
             resp = self.authorized_get_request(
-                f"https://api.spotify.com/v1/shows/{show_id}/episodes",
+                f"{API_URL}shows/{show_id}/episodes",
                 params={"limit": limit, "offset": offset},
             ).json()
             offset += limit
             for episode in resp["items"]:
+                if episode is None:
+                    continue
+                if since and episode["release_date"] < since:
+                    return episodes
+                if episode["id"] in known:
+                    continue
                 episodes.append(
                     {
                         "id": episode["id"],
                         "name": episode["name"],
                         "release_date": episode["release_date"],
+                        "duration_ms": episode.get("duration_ms"),
                     }
                 )
 
@@ -468,7 +820,7 @@ class RespotRequest:
     def get_show_info(self, show_id):
         """returns show info"""
         resp = self.authorized_get_request(
-            f"https://api.spotify.com/v1/shows/{show_id}"
+            f"{API_URL}shows/{show_id}"
         ).json()
         return {
             "name": RespotUtils.sanitize_data(resp["name"]),
@@ -481,7 +833,7 @@ class RespotRequest:
         """Searches Spotify's API for relevant data"""
 
         resp = self.authorized_get_request(
-            "https://api.spotify.com/v1/search",
+            API_URL + "search",
             params={
                 "limit": search_limit,
                 "offset": "0",
@@ -570,75 +922,166 @@ class RespotTrackHandler:
     CHUNK_SIZE = 50000
     RETRY_DOWNLOAD = 30
 
-    def __init__(self, auth, audio_format, antiban_wait_time, quality):
+    def __init__(
+        self, auth, audio_format, antiban_wait_time, quality, bandwidth=None, memory=None
+    ):
         """
         Args:
             audio_format (str): The desired format for the converted audio.
             quality (str): The quality setting of Spotify playback.
+            bandwidth (TokenBucket): Shared limit of the download byte rate, if any.
+            memory (MemoryBudget): Shared limit of the audio held in memory, if any.
         """
         self.auth = auth
         self.format = audio_format
         self.antiban_wait_time = antiban_wait_time
         self.quality = quality
+        self.bandwidth = bandwidth
+        self.memory = memory
+        self.reserved = 0
+        self.error = None
+        self.complete = False
 
-    def create_out_dirs(self, parent_path) -> None:
+    @staticmethod
+    def create_out_dirs(parent_path) -> None:
         parent_path.mkdir(parents=True, exist_ok=True)
 
-    def download_audio(self, track_id, filename) -> BytesIO:
-        """Downloads raw song audio from Spotify"""
+    def memory_needed(self, size, convert) -> int:
+        """Bytes of memory a stream of size bytes takes until it is saved"""
+        if not convert:
+            return size
+        # pydub decodes the whole stream, and copies the PCM once more to export
+        # it; measuring loudness reads the decoded PCM in place
+        source_bitrate = QUALITY_BITRATES.get(quality_name(self.quality), 160_000)
+        return size + 2 * size * PCM_BITRATE // source_bitrate
+
+    def audio_buffer(self, size, spill_dir, convert):
+        """Returns a BytesIO if the memory budget has room for the track, else a temp file"""
+        if self.memory is None:
+            return BytesIO()
+        needed = self.memory_needed(size, convert)
+        if self.memory.reserve(needed):
+            self.reserved = needed
+            return BytesIO()
+        print("Track is larger than the memory budget, streaming it to disk")
+        TRACE.set("spilled", True)
+        return tempfile.NamedTemporaryFile(
+            dir=spill_dir, prefix=".zspotify-", suffix=".part", delete=False
+        )
+
+    def release(self, audio_bytes) -> None:
+        """Frees the memory reserved for a download, or removes its temp file"""
+        if self.reserved:
+            self.memory.release(self.reserved)
+            self.reserved = 0
+        if not isinstance(audio_bytes, BytesIO):
+            audio_bytes.close()
+            Path(audio_bytes.name).unlink(missing_ok=True)
+
+    def load_audio(self, path, spill_dir, convert):
+        """Reads a cached stream like a download, within the same memory budget"""
+        try:
+            size = path.stat().st_size
+        except OSError:
+            # Evicted in the meantime
+            return None
+        audio_bytes = self.audio_buffer(size, spill_dir, convert)
+        try:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, audio_bytes)
+        except OSError:
+            self.release(audio_bytes)
+            return None
+        audio_bytes.seek(0)
+        self.complete = True
+        return audio_bytes
+
+    def download_audio(self, track_id, filename, spill_dir=None, convert=False) -> BytesIO:
+        """Downloads raw song audio from Spotify
+
+        Returns a temp file in spill_dir instead of a BytesIO when the track
+        does not fit in the memory budget.
+        """
         # TODO: ADD disc_number IF > 1
+        from librespot.audio.decoders import VorbisOnlyAudioQuality
+        from librespot.core import ApiClient
+        from librespot.metadata import TrackId, EpisodeId
+        from tqdm import tqdm
 
+        audio_bytes = None
         try:
-            try:
-                _track_id = TrackId.from_base62(track_id)
-                stream = self.auth.session.content_feeder().load(
-                    _track_id, VorbisOnlyAudioQuality(self.quality), False, None
-                )
-            except ApiClient.StatusCodeException:
-                _track_id = EpisodeId.from_base62(track_id)
-                stream = self.auth.session.content_feeder().load(
-                    _track_id, VorbisOnlyAudioQuality(self.quality), False, None
-                )
+            with stage("stream_open"):
+                try:
+                    _track_id = TrackId.from_base62(track_id)
+                    stream = self.auth.session.content_feeder().load(
+                        _track_id, VorbisOnlyAudioQuality(self.quality), False, None
+                    )
+                except ApiClient.StatusCodeException:
+                    _track_id = EpisodeId.from_base62(track_id)
+                    stream = self.auth.session.content_feeder().load(
+                        _track_id, VorbisOnlyAudioQuality(self.quality), False, None
+                    )
 
             total_size = stream.input_stream.size
             downloaded = 0
             fail_count = 0
-            audio_bytes = BytesIO()
+            audio_bytes = self.audio_buffer(total_size, spill_dir or Path.cwd(), convert)
             progress_bar = tqdm(total=total_size, unit="B", unit_scale=True)
 
-            while downloaded < total_size:
-                remaining = total_size - downloaded
-                read_size = min(self.CHUNK_SIZE, remaining)
-                data = stream.input_stream.stream().read(read_size)
-
-                if not data:
-                    fail_count += 1
-                    if fail_count > self.RETRY_DOWNLOAD:
-                        break
-                else:
-                    fail_count = 0  # reset fail_count on successful data read
-
-                downloaded += len(data)
-                progress_bar.update(len(data))
-                audio_bytes.write(data)
+            with stage("download"):
+                while downloaded < total_size:
+                    remaining = total_size - downloaded
+                    read_size = min(self.CHUNK_SIZE, remaining)
+                    data = stream.input_stream.stream().read(read_size)
+                    if self.bandwidth and data:
+                        # Charged for what arrived, a short read costs less than a chunk
+                        TRACE.add("throttle_seconds", self.bandwidth.acquire(len(data)))
+
+                    if not data:
+                        fail_count += 1
+                        METRICS.inc(RETRIES, kind="download")
+                        if fail_count > self.RETRY_DOWNLOAD:
+                            break
+                    else:
+                        fail_count = 0  # reset fail_count on successful data read
+
+                    downloaded += len(data)
+                    METRICS.inc(DOWNLOADED_BYTES, len(data))
+                    progress_bar.update(len(data))
+                    audio_bytes.write(data)
 
             progress_bar.close()
+            self.complete = downloaded >= total_size
+            TRACE.set("stream_bytes", total_size)
+            TRACE.set("downloaded_bytes", downloaded)
 
             # Sleep to avoid ban
-            time.sleep(self.antiban_wait_time)
+            with stage("antiban_wait"):
+                time.sleep(self.antiban_wait_time)
 
             audio_bytes.seek(0)
 
             return audio_bytes
 
         except Exception as e:
+            self.error = e
             print("###   download_track - FAILED TO DOWNLOAD   ###")
             print(e)
             print(track_id, filename)
+            if audio_bytes is not None:
+                self.release(audio_bytes)
             return None
 
-    def convert_audio_format(self, audio_bytes: BytesIO, output_path: Path) -> None:
-        """Converts raw audio (ogg vorbis) to user specified format"""
+    def convert_audio_format(self, audio_bytes: BytesIO, outputs: dict, analyze=False):
+        """Converts raw audio (ogg vorbis) to every {output path: format} of outputs
+
+        The audio is decoded once for all of them. With analyze, the loudness
+        of the decoded audio is measured in the same pass and returned as a
+        TrackLoudness, otherwise None is returned.
+        """
+        from librespot.audio.decoders import AudioQuality
+        from pydub import AudioSegment
+
         # Make sure stream is at the start or else AudioSegment will act up
         audio_bytes.seek(0)
 
@@ -646,12 +1089,42 @@ class RespotTrackHandler:
         if self.quality == AudioQuality.VERY_HIGH:
             bitrate = "320k"
 
-        AudioSegment.from_file(audio_bytes).export(
-            output_path, format=self.format, bitrate=bitrate
-        )
+        if not isinstance(audio_bytes, BytesIO):
+            # Spilled to disk: let ffmpeg stream it instead of decoding it into memory
+            from pydub.utils import get_encoder_name
+
+            audio_bytes.flush()
+            command = [get_encoder_name(), "-y", "-loglevel", "error", "-i", audio_bytes.name]
+            for output_path, audio_format in outputs.items():
+                command += ["-b:a", bitrate, "-f", audio_format, str(output_path)]
+            if not analyze:
+                subprocess.run(command, check=True)
+                return None
+            # One more output: the decoded PCM, measured as ffmpeg pipes it out
+            command += ["-f", "s16le", "-ac", "2", "-ar", "44100", "pipe:1"]
+            meter = loudness_meter(44100, 2)
+            with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+                while chunk := process.stdout.read(1 << 20):
+                    meter.add(chunk)
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, command)
+            return meter.result()
+
+        audio = AudioSegment.from_file(audio_bytes)
+        for output_path, audio_format in outputs.items():
+            audio.export(output_path, format=audio_format, bitrate=bitrate)
+        if not analyze:
+            return None
+        if audio.sample_width not in (2, 4):
+            audio = audio.set_sample_width(2)
+        meter = loudness_meter(audio.frame_rate, audio.channels, audio.sample_width)
+        meter.add(audio.raw_data)
+        return meter.result()
 
     def bytes_to_file(self, audio_bytes: BytesIO, output_path: Path) -> None:
-        output_path.write_bytes(audio_bytes.getvalue())
+        audio_bytes.seek(0)
+        with open(output_path, "wb") as f:
+            shutil.copyfileobj(audio_bytes, f)
 
     @staticmethod
     def determine_file_extension(audio_bytes: BytesIO) -> str:
@@ -671,117 +1144,29 @@ class RespotTrackHandler:
             raise ValueError("The audio stream is malformed.")
 
 
+_URL_KINDS = ("track", "album", "playlist", "episode", "show", "artist")
+
+# One pass over spotify:<kind>:<id> uris and open.spotify.com urls, with or
+# without a localized intl-xx/ segment and a ?si= share suffix
+_URL_PATTERN = re.compile(
+    r"^(?:spotify:(?P<uri_kind>{kinds}):(?P<uri_id>[0-9a-zA-Z]{{22}})"
+    r"|(?:https?://)?open\.spotify\.com/(?:intl-[^/]+/)?(?P<url_kind>{kinds})/"
+    r"(?P<url_id>[0-9a-zA-Z]{{22}})(?:\?si=.+?)?)$".format(kinds="|".join(_URL_KINDS))
+)
+
+
 class RespotUtils:
     @staticmethod
     def parse_url(search_input) -> dict:
         """Determines type of audio from url"""
-        pattern = r"intl-[^/]+/"
-        search_input = re.sub(pattern, "", search_input)
-
-        track_uri_search = re.search(
-            r"^spotify:track:(?P<TrackID>[0-9a-zA-Z]{22})$", search_input
-        )
-        track_url_search = re.search(
-            r"^(https?://)?open\.spotify\.com/track/(?P<TrackID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-            search_input,
-        )
-
-        album_uri_search = re.search(
-            r"^spotify:album:(?P<AlbumID>[0-9a-zA-Z]{22})$", search_input
-        )
-        album_url_search = re.search(
-            r"^(https?://)?open\.spotify\.com/album/(?P<AlbumID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-            search_input,
-        )
-
-        playlist_uri_search = re.search(
-            r"^spotify:playlist:(?P<PlaylistID>[0-9a-zA-Z]{22})$", search_input
-        )
-        playlist_url_search = re.search(
-            r"^(https?://)?open\.spotify\.com/playlist/(?P<PlaylistID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-            search_input,
-        )
-
-        episode_uri_search = re.search(
-            r"^spotify:episode:(?P<EpisodeID>[0-9a-zA-Z]{22})$", search_input
-        )
-        episode_url_search = re.search(
-            r"^(https?://)?open\.spotify\.com/episode/(?P<EpisodeID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-            search_input,
-        )
-
-        show_uri_search = re.search(
-            r"^spotify:show:(?P<ShowID>[0-9a-zA-Z]{22})$", search_input
-        )
-        show_url_search = re.search(
-            r"^(https?://)?open\.spotify\.com/show/(?P<ShowID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-            search_input,
-        )
-
-        artist_uri_search = re.search(
-            r"^spotify:artist:(?P<ArtistID>[0-9a-zA-Z]{22})$", search_input
-        )
-        artist_url_search = re.search(
-            r"^(https?://)?open\.spotify\.com/artist/(?P<ArtistID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-            search_input,
-        )
-
-        if track_uri_search is not None or track_url_search is not None:
-            track_id_str = (
-                track_uri_search if track_uri_search is not None else track_url_search
-            ).group("TrackID")
-        else:
-            track_id_str = None
-
-        if album_uri_search is not None or album_url_search is not None:
-            album_id_str = (
-                album_uri_search if album_uri_search is not None else album_url_search
-            ).group("AlbumID")
-        else:
-            album_id_str = None
-
-        if playlist_uri_search is not None or playlist_url_search is not None:
-            playlist_id_str = (
-                playlist_uri_search
-                if playlist_uri_search is not None
-                else playlist_url_search
-            ).group("PlaylistID")
-        else:
-            playlist_id_str = None
-
-        if episode_uri_search is not None or episode_url_search is not None:
-            episode_id_str = (
-                episode_uri_search
-                if episode_uri_search is not None
-                else episode_url_search
-            ).group("EpisodeID")
-        else:
-            episode_id_str = None
-
-        if show_uri_search is not None or show_url_search is not None:
-            show_id_str = (
-                show_uri_search if show_uri_search is not None else show_url_search
-            ).group("ShowID")
-        else:
-            show_id_str = None
-
-        if artist_uri_search is not None or artist_url_search is not None:
-            artist_id_str = (
-                artist_uri_search
-                if artist_uri_search is not None
-                else artist_url_search
-            ).group("ArtistID")
-        else:
-            artist_id_str = None
-
-        return {
-            "track": track_id_str,
-            "album": album_id_str,
-            "playlist": playlist_id_str,
-            "episode": episode_id_str,
-            "show": show_id_str,
-            "artist": artist_id_str,
-        }
+        parsed = dict.fromkeys(_URL_KINDS)
+        match = _URL_PATTERN.match(search_input)
+        if match:
+            if match.group("uri_kind"):
+                parsed[match.group("uri_kind")] = match.group("uri_id")
+            else:
+                parsed[match.group("url_kind")] = match.group("url_id")
+        return parsed
 
     @staticmethod
     def conv_artist_format(artists: list) -> str:
@@ -0,0 +1,140 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    from jobs import Scheduler, PENDING, IN_PROGRESS
+    from metrics import METRICS
+    from planner import canonical_url
+except ImportError:
+    from .jobs import Scheduler, PENDING, IN_PROGRESS
+    from .metrics import METRICS
+    from .planner import canonical_url
+
+# Largest POST body accepted, a long list of urls fits easily
+MAX_BODY = 1 << 20
+
+
+class JobServer:
+    """Long-running daemon accepting download jobs over a local HTTP API.
+
+    The logged in session, the loaded archive and the HTTP pools of the
+    ZSpotify instance stay warm between jobs.
+
+    POST /jobs          {"url": "..."} or {"urls": [...]}, returns the job ids
+    GET  /jobs          status and progress of every job
+    GET  /jobs/<id>     status and progress of one job
+    GET  /metrics       Prometheus metrics
+    GET  /health        liveness check
+    """
+
+    def __init__(self, zspotify, queue, host="127.0.0.1", port=8150, workers=1):
+        self.zspotify = zspotify
+        self.queue = queue
+        self.host = host
+        self.port = port
+        self.scheduler = Scheduler(workers)
+        self._lock = threading.Lock()
+        self._active = set()
+
+    def submit(self, url):
+        """Queues a url; a job that is already queued or running is not run twice.
+
+        Uris, share links and localized urls of the same item are one job.
+        """
+        url = canonical_url(url) or url
+        with self._lock:
+            job_id = self.queue.add_job(url, priority=self.zspotify.job_priority(url))
+            if job_id not in self._active:
+                self.queue.add_job(url, requeue=True)
+                self._schedule(self.queue.get_job(job_id))
+        return job_id
+
+    def _schedule(self, job):
+        self._active.add(job["id"])
+        self.zspotify.schedule_job(
+            self.scheduler,
+            self.queue,
+            job,
+            on_done=lambda: self._active.discard(job["id"]),
+        )
+
+    def job_status(self, job):
+        return {**job, "progress": self.queue.progress(job["id"])}
+
+    def serve_forever(self):
+        self.queue.reset_interrupted()
+        self.scheduler.start()
+        with self._lock:
+            for job in self.queue.jobs((PENDING, IN_PROGRESS)):
+                self._schedule(job)
+        httpd = ThreadingHTTPServer((self.host, self.port), _JobRequestHandler)
+        httpd.app = self
+        print(f"Serving on http://{self.host}:{self.port}")
+        try:
+            httpd.serve_forever()
+        finally:
+            self.scheduler.stop()
+            httpd.server_close()
+
+
+class _JobRequestHandler(BaseHTTPRequestHandler):
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        app = self.server.app
+        parts = self.path.strip("/").split("/")
+        if parts == ["health"]:
+            self._send_json(200, {"status": "ok"})
+        elif parts == ["metrics"]:
+            data = METRICS.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif parts == ["jobs"]:
+            self._send_json(200, [app.job_status(job) for job in app.queue.jobs()])
+        elif len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+            job = app.queue.get_job(int(parts[1]))
+            if job:
+                self._send_json(200, app.job_status(job))
+            else:
+                self._send_json(404, {"error": "Job not found"})
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        app = self.server.app
+        if self.path.rstrip("/") != "/jobs":
+            self._send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if not 0 <= length <= MAX_BODY:
+                raise ValueError(length)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            urls = body["urls"] if "urls" in body else [body["url"]]
+            if not isinstance(urls, list) or not all(isinstance(url, str) and url for url in urls):
+                raise ValueError(urls)
+        except (ValueError, KeyError, TypeError):
+            # What is left of the body must not be read as the next request
+            self.close_connection = True
+            self._send_json(400, {"error": 'Expected {"url": ...} or {"urls": [...]}'})
+            return
+        canonical = [canonical_url(url) for url in urls]
+        invalid = [url for url, spotify_url in zip(urls, canonical) if spotify_url is None]
+        if invalid:
+            self._send_json(400, {"error": "Not a Spotify url", "urls": invalid})
+            return
+        self._send_json(202, {"ids": [app.submit(url) for url in canonical]})
+
+    def log_message(self, format, *args):
+        pass
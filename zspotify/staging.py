@@ -0,0 +1,95 @@
+import errno
+import os
+import shutil
+import socket
+import tempfile
+import time
+from pathlib import Path
+
+
+# Without a safe way to probe a pid on Windows, leftovers older than this are stale
+_STALE_AGE = 24 * 3600
+
+
+def atomic_copy(src, dest):
+    """Copies src to dest so that readers only ever see the complete file"""
+    dest = Path(dest)
+    fd, tmp = tempfile.mkstemp(dir=dest.parent, prefix=f".{dest.name}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    return dest
+
+
+def finalize(src, dest):
+    """Moves a finished file into place atomically, copying across filesystems"""
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.replace(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        atomic_copy(src, dest)
+        os.remove(src)
+    return dest
+
+
+def process_running(pid):
+    """Whether a process of this host is alive"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class StagingArea:
+    """Folder where tracks are downloaded, converted and tagged before entering the library.
+
+    Every track gets its own subfolder named after the host and process, so
+    a run can tell the leftovers of crashed runs from those of live ones.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self._prefix = f"{socket.gethostname()}+{os.getpid()}+"
+
+    def create(self):
+        """Returns a new empty folder for one track"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        return Path(tempfile.mkdtemp(dir=self.root, prefix=self._prefix))
+
+    @staticmethod
+    def remove(folder):
+        shutil.rmtree(folder, ignore_errors=True)
+
+    def clean(self):
+        """Removes the folders left by runs of this host that are gone, returns how many.
+
+        Runs at startup, before this process creates any folder.
+        """
+        if not self.root.is_dir():
+            return 0
+        host = socket.gethostname()
+        removed = 0
+        for entry in self.root.iterdir():
+            parts = entry.name.rsplit("+", 2)
+            if len(parts) != 3 or parts[0] != host or not parts[1].isdigit():
+                continue
+            pid = int(parts[1])
+            if os.name == "nt":
+                stale = time.time() - entry.stat().st_mtime > _STALE_AGE
+            else:
+                # A restarted container often gets the pid of the run that crashed
+                stale = pid == os.getpid() or not process_running(pid)
+            if stale:
+                self.remove(entry)
+                removed += 1
+        return removed
@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+try:
+    from staging import atomic_copy
+except ImportError:
+    from .staging import atomic_copy
+
+
+LINK_MODES = ("hardlink", "reflink", "symlink", "copy")
+
+# Linux ioctl to share the extents of a file (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+SOURCE_EXTENSIONS = ("ogg", "mp3", "flac", "wav")
+
+
+def place(src, dest, link_mode="hardlink"):
+    """Creates dest from src with the link mode, copying where linking fails"""
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if link_mode == "symlink":
+        return _replace_with_link(os.symlink, Path(src).absolute(), dest)
+    if link_mode == "hardlink":
+        try:
+            return _replace_with_link(os.link, src, dest)
+        except OSError:
+            # Different filesystem or no hardlink support
+            pass
+    elif link_mode == "reflink" and _reflink(src, dest):
+        return dest
+    return atomic_copy(src, dest)
+
+
+def _replace_with_link(make_link, src, dest):
+    """Links dest to src, atomically replacing a file already at dest"""
+    fd, tmp = tempfile.mkstemp(dir=dest.parent, prefix=f".{dest.name}.", suffix=".tmp")
+    os.close(fd)
+    os.remove(tmp)
+    make_link(src, tmp)
+    try:
+        os.replace(tmp, dest)
+    finally:
+        # Renaming onto another link of the same file leaves tmp behind
+        Path(tmp).unlink(missing_ok=True)
+    return dest
+
+
+def _reflink(src, dest):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), _FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dest)
+    return False
+
+
+class ContentStore:
+    """Keeps one copy of every downloaded track per output format.
+
+    Other collection locations of the same track are created from the stored
+    file with the configured link mode instead of being downloaded again.
+    """
+
+    def __init__(self, root, link_mode="hardlink"):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"Unknown link mode: {link_mode}")
+        self.root = Path(root)
+        self.link_mode = link_mode
+
+    def path_for(self, track_id, extension):
+        return self.root / extension / track_id[:2] / f"{track_id}.{extension}"
+
+    def get(self, track_id, audio_format):
+        """Returns the stored file of a track in the given format, or None"""
+        extensions = SOURCE_EXTENSIONS if audio_format == "source" else (audio_format,)
+        for extension in extensions:
+            path = self.path_for(track_id, extension)
+            if path.exists():
+                return path
+        return None
+
+    def metadata_path(self, track_id):
+        return self.root / "metadata" / track_id[:2] / f"{track_id}.json"
+
+    def get_metadata(self, track_id):
+        """Returns the track info stored with a track, or None"""
+        try:
+            with open(self.metadata_path(track_id), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _put_metadata(self, track_id, track):
+        path = self.metadata_path(track_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(track, f)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def ingest(self, track_id, output_path, track=None):
+        """Stores a freshly downloaded file, which stays in place as well.
+
+        The track info is kept with it, so other locations can be named
+        without asking Spotify again.
+        """
+        output_path = Path(output_path)
+        if track is not None:
+            self._put_metadata(track_id, track)
+        store_path = self.path_for(track_id, output_path.suffix.lstrip("."))
+        if store_path.exists():
+            return store_path
+        store_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.link_mode == "symlink":
+            # The store holds the real file, the collection gets the link
+            shutil.move(output_path, store_path)
+            os.symlink(store_path.absolute(), output_path)
+        else:
+            place(output_path, store_path, self.link_mode)
+        return store_path
+
+    def link(self, store_path, dest):
+        """Creates dest from a stored file"""
+        return place(store_path, dest, self.link_mode)
@@ -1,6 +1,7 @@
-import music_tag
-import requests
-from mutagen import id3
+try:
+    from metrics import stage
+except ImportError:
+    from .metrics import stage
 
 class AudioTagger:
     
@@ -22,8 +23,34 @@ class AudioTagger:
             self._set_other_tags(fullpath, artists, name, album_name, release_year, disc_number,
                                  track_number, track_id_str, image_url)
 
+    def set_replaygain(self, fullpath, values):
+        """sets ReplayGain tags such as {"REPLAYGAIN_TRACK_GAIN": "-6.20 dB"}, keeping the others"""
+        if not values:
+            return
+
+        extension = str(fullpath).split('.')[-1]
+
+        if extension == 'mp3':
+            from mutagen import id3
+
+            tags = id3.ID3(fullpath)
+            for key, value in values.items():
+                tags.add(id3.TXXX(encoding=3, desc=key, text=value))
+        else:
+            import mutagen
+
+            tags = mutagen.File(fullpath)
+            for key, value in values.items():
+                tags[key] = value
+
+        with stage("tag_save"):
+            tags.save()
+
     def _set_mp3_tags(self, fullpath, artist, name, album_name, release_year, disc_number, 
                       track_number, track_id_str, album_artist, image_url):
+        import requests
+        from mutagen import id3
+
         tags = id3.ID3(fullpath)
 
         mp3_map = {
@@ -43,14 +70,19 @@ class AudioTagger:
                 tags[tag] = id3.Frames[tag](encoding=3, text=value)
 
         if image_url:
-            albumart = requests.get(image_url).content
+            with stage("cover_fetch"):
+                albumart = requests.get(image_url).content
             if albumart:
                 tags["APIC"] = id3.APIC(encoding=3, mime="image/jpeg", type=3, desc="0", data=albumart)
 
-        tags.save()
+        with stage("tag_save"):
+            tags.save()
 
     def _set_other_tags(self, fullpath, artist, name, album_name, release_year, disc_number, 
                         track_number, track_id_str, image_url):
+        import music_tag
+        import requests
+
         tags = music_tag.load_file(fullpath)
 
         other_map = {
@@ -68,8 +100,10 @@ class AudioTagger:
                 tags[tag] = value
 
         if image_url:
-            albumart = requests.get(image_url).content
+            with stage("cover_fetch"):
+                albumart = requests.get(image_url).content
             if albumart:
                 tags["artwork"] = albumart
 
-        tags.save()
+        with stage("tag_save"):
+            tags.save()
@@ -0,0 +1,79 @@
+import re
+import threading
+import time
+
+
+_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_rate(value):
+    """Parses a byte count such as 500K, 2M or 2MB/s into bytes"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?\s*", str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid byte rate: {value}")
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+class TokenBucket:
+    """Shapes the byte rate of every thread sharing it.
+
+    Up to burst bytes go through at once after an idle period, after that
+    reads are spread evenly at rate bytes per second. A read larger than
+    the remaining tokens borrows from the future and waits for the debt.
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        # One second worth of traffic unless set
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount):
+        """Takes amount bytes from the bucket, returns the seconds waited for them"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class MemoryBudget:
+    """Bytes of audio the downloads running at the same time may hold in memory.
+
+    reserve() waits while other downloads hold the room a track needs. A
+    track that would not fit even in an empty budget is refused, and the
+    caller keeps it on disk instead.
+    """
+
+    def __init__(self, limit):
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+        self.limit = limit
+        self.reserved = 0
+        self.high_water = 0
+        self.spilled = 0
+        self._cond = threading.Condition()
+
+    def reserve(self, amount):
+        """Reserves amount bytes, returns False if they can never fit"""
+        with self._cond:
+            if amount > self.limit:
+                self.spilled += 1
+                return False
+            self._cond.wait_for(lambda: self.reserved + amount <= self.limit)
+            self.reserved += amount
+            self.high_water = max(self.high_water, self.reserved)
+            return True
+
+    def release(self, amount):
+        with self._cond:
+            self.reserved -= amount
+            self._cond.notify_all()
@@ -0,0 +1,148 @@
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+PERCENTILES = (50, 95, 99)
+
+
+class Tracer:
+    """Writes one JSONL record per track with the timestamps of its stages.
+
+    Stage timestamps are time.monotonic() values, so they are comparable
+    within one run but not with wall clock time, which "started" holds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = None
+        self._context = threading.local()
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def open(self, file):
+        self._file = open(file, "a", encoding="utf-8")
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def _current(self):
+        return getattr(self._context, "record", None)
+
+    @contextmanager
+    def track(self, track_id, job_type):
+        """Collects the stages run by this thread into the record of a track"""
+        if not self.enabled:
+            yield
+            return
+        record = {
+            "track_id": track_id,
+            "job_type": job_type,
+            "started": time.time(),
+            "start": time.monotonic(),
+            "stages": [],
+            "cache": {},
+        }
+        previous = self._current()
+        self._context.record = record
+        try:
+            yield
+        finally:
+            self._context.record = previous
+            record["end"] = time.monotonic()
+            record["total"] = record["end"] - record["start"]
+            self._write(record)
+
+    def _write(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            if self._file:
+                self._file.write(line)
+                self._file.flush()
+
+    def stage(self, name, start, end):
+        record = self._current()
+        if record is not None:
+            record["stages"].append({"stage": name, "start": start, "end": end})
+
+    def set(self, key, value):
+        """Sets a field of the current track's record, e.g. its result"""
+        record = self._current()
+        if record is not None:
+            record[key] = value
+
+    def add(self, key, value=1):
+        """Adds to a counter of the current track's record, e.g. its API calls"""
+        record = self._current()
+        if record is not None:
+            record[key] = record.get(key, 0) + value
+
+    def cache(self, name, hit):
+        """Records whether a lookup (archive, file index, content store) was a hit"""
+        record = self._current()
+        if record is not None:
+            record["cache"][name] = hit
+
+
+TRACE = Tracer()
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    rank = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[rank]
+
+
+def summarize(file):
+    """Returns {stage: sorted per-track durations} of a trace file, "total" included"""
+    durations = {}
+    with open(file, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            per_track = {}
+            for entry in record.get("stages", []):
+                # A stage can run more than once per track, e.g. retried reads
+                per_track[entry["stage"]] = (
+                    per_track.get(entry["stage"], 0) + entry["end"] - entry["start"]
+                )
+            if "total" in record:
+                per_track["total"] = record["total"]
+            for name, seconds in per_track.items():
+                durations.setdefault(name, []).append(seconds)
+    for values in durations.values():
+        values.sort()
+    return durations
+
+
+def print_summary(file):
+    durations = summarize(file)
+    if not durations:
+        print("No tracks in trace")
+        return
+    header = f"{'STAGE':<16}{'COUNT':>8}" + "".join(f"{'P' + str(p):>10}" for p in PERCENTILES)
+    print(header)
+    # The stages that took longest at the median first, total last
+    names = sorted(
+        (name for name in durations if name != "total"),
+        key=lambda name: -percentile(durations[name], 50),
+    )
+    if "total" in durations:
+        names.append("total")
+    for name in names:
+        values = durations[name]
+        print(
+            f"{name:<16}{len(values):>8}"
+            + "".join(f"{percentile(values, p):>9.3f}s" for p in PERCENTILES)
+        )
@@ -1,102 +1,621 @@
 import os
+import csv
 import json
+import socket
 import datetime
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
+try:
+    from staging import process_running
+except ImportError:
+    from .staging import process_running
 
-class Archive:
+
+MIGRATION_BATCH_SIZE = 512
+MIGRATION_WORKERS = 16
+
+# Changes appended to the journal before the archive file is rewritten with them
+COMPACT_EVERY = 1000
+
+# The owner of a reservation touches it this often while it downloads. One
+# left untouched for RESERVATION_STALE seconds belongs to a crashed run, even
+# on another host or container where its process can't be looked up
+RESERVATION_HEARTBEAT = 10.0
+RESERVATION_STALE = 60.0
+RESERVATION_POLL = 1.0
+
+
+class FileLock:
+    """Advisory inter-process lock held on a separate lock file"""
 
     def __init__(self, file):
         self.file = file
+        self._fd = None
+
+    def acquire(self, shared=False):
+        self._fd = os.open(self.file, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.name == "nt":
+            import msvcrt
+
+            # msvcrt has no shared locks, readers lock exclusively as well.
+            # LK_LOCK gives up after 10 attempts a second apart, keep waiting
+            while True:
+                try:
+                    msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            import fcntl
+
+            fcntl.flock(self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+    def release(self):
+        if os.name == "nt":
+            import msvcrt
+
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    @contextmanager
+    def __call__(self, shared=False):
+        self.acquire(shared)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class Archive:
+    """Track archive shared safely between processes.
+
+    Changes are appended to ``<file>.journal`` under an exclusive lock on
+    ``<file>.lock``; every COMPACT_EVERY changes the journal is folded into
+    the archive file, which is replaced atomically. Other processes read
+    only the journal lines they have not seen yet.
+
+    A track being downloaded is reserved in ``<file>.reserved``, so other
+    threads and processes wait for it instead of fetching it again.
+    """
+
+    def __init__(self, file):
+        self.file = Path(file)
+        self.journal = Path(f"{file}.journal")
+        self.reservations = Path(f"{file}.reserved")
+        self._file_lock = FileLock(f"{file}.lock")
+        self._lock = threading.RLock()
+        self._dirty = {}
+        self._stat = None
+        self._journal_offset = 0
+        self._journal_lines = 0
+        self._owner = f"{socket.gethostname()}+{os.getpid()}"
+        self._reserved = set()
+        self._reserved_cond = threading.Condition()
+        self._claimed = set()
+        self._heartbeat = None
+        self._closed = threading.Event()
         self.data = self.load()
+        self._build_indexes()
+
+    @staticmethod
+    def _stat_of(file):
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _file_stat(self):
+        return (self._stat_of(self.file), self._stat_of(self.journal))
 
     def load(self):
+        self._stat = self._file_stat()
+        self._journal_offset = 0
+        self._journal_lines = 0
+        data = {}
         if self.file.exists():
             with open(self.file, "r") as f:
                 try:
-                    return json.load(f)
+                    data = json.load(f)
                 except json.JSONDecodeError as e:
                     print(f"Error loading archive: {e}")
-                    return {}
-        return {}
+        for track_id, entry in self._read_journal():
+            if entry is None:
+                data.pop(track_id, None)
+            else:
+                data[track_id] = entry
+        return data
 
-    def save(self):
-        with open(self.file, "w") as f:
+    def _read_journal(self):
+        """Returns the (track_id, entry) changes appended since the last read"""
+        try:
+            with open(self.journal, "rb") as f:
+                f.seek(self._journal_offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return []
+        # An unfinished last line is read again once it is complete
+        end = chunk.rfind(b"\n") + 1
+        changes = []
+        for line in chunk[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Left by a writer that crashed mid-line
+                continue
+            changes.append((record["id"], record["entry"]))
+        self._journal_offset += end
+        self._journal_lines += len(changes)
+        return changes
+
+    def _reload_if_changed(self):
+        """Reloads entries written by other processes, keeping unsaved local changes"""
+        stat = self._file_stat()
+        if stat == self._stat:
+            return False
+        (main, journal), (old_main, old_journal) = stat, self._stat
+        if (
+            main == old_main
+            and journal is not None
+            and (old_journal is None or journal[0] == old_journal[0])
+            and journal[1] >= self._journal_offset
+        ):
+            # Only appended to: apply the new lines
+            self._stat = stat
+            for track_id, entry in self._read_journal():
+                if track_id in self._dirty:
+                    continue
+                self._unindex(track_id)
+                if entry is None:
+                    self.data.pop(track_id, None)
+                else:
+                    self.data[track_id] = entry
+                    self._index(track_id, entry)
+            return True
+        data = self.load()
+        for track_id, entry in self._dirty.items():
+            if entry is None:
+                data.pop(track_id, None)
+            else:
+                data[track_id] = entry
+        self.data = data
+        self._build_indexes()
+        return True
+
+    def refresh(self):
+        # A stat is enough to tell that nothing changed, without the lock file
+        if self._file_stat() == self._stat:
+            return False
+        with self._lock, self._file_lock(shared=True):
+            return self._reload_if_changed()
+
+    def save(self, compact=False):
+        with self._lock, self._file_lock():
+            self._reload_if_changed()
+            if self._dirty:
+                lines = "".join(
+                    json.dumps({"id": track_id, "entry": entry}) + "\n"
+                    for track_id, entry in self._dirty.items()
+                )
+                with open(self.journal, "a") as f:
+                    if f.tell() > self._journal_offset:
+                        # End the unfinished line of a writer that crashed
+                        lines = "\n" + lines
+                    f.write(lines)
+                    self._journal_offset = f.tell()
+                self._journal_lines += len(self._dirty)
+                self._dirty.clear()
+            if self._journal_lines >= COMPACT_EVERY or compact and self._journal_lines:
+                self._compact()
+            self._stat = self._file_stat()
+
+    def _compact(self):
+        """Rewrites the archive file with every change and empties the journal"""
+        tmp_file = f"{self.file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
             json.dump(self.data, f, indent=4)
+        os.replace(tmp_file, self.file)
+        open(self.journal, "w").close()
+        self._journal_offset = 0
+        self._journal_lines = 0
+
+    def close(self):
+        """Folds the journal into the archive file"""
+        self._closed.set()
+        self.save(compact=True)
 
     def add(self, track_id, artist=None, track_name=None, fullpath=None,
             audio_type=None, timestamp=None, save=True):
         if not timestamp:
             timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.data[track_id] = {
-            "artist": artist,
-            "track_name": track_name,
-            "audio_type": audio_type,
-            "fullpath": str(fullpath),
-            "timestamp": timestamp
-        }
+        with self._lock:
+            # Places the track was saved to before stay recorded as locations
+            old_paths = self._entry_paths(self.data.get(track_id))
+            self._unindex(track_id)
+            self.data[track_id] = {
+                "artist": artist,
+                "track_name": track_name,
+                "audio_type": audio_type,
+                "fullpath": str(fullpath),
+                "timestamp": timestamp
+            }
+            locations = [p for p in old_paths if p != str(fullpath)]
+            if locations:
+                self.data[track_id]["locations"] = locations
+            self._dirty[track_id] = self.data[track_id]
+            self._index(track_id, self.data[track_id])
         print(f"Added to archive: {artist} - {track_name}")
         if save:
             self.save()
 
+    def add_location(self, track_id, fullpath, save=True):
+        """Records another place the archived track appears in"""
+        with self._lock:
+            entry = self.data.get(track_id)
+            if entry is None or str(fullpath) in self._entry_paths(entry):
+                return
+            self._unindex(track_id)
+            entry.setdefault("locations", []).append(str(fullpath))
+            self._dirty[track_id] = entry
+            self._index(track_id, entry)
+        if save:
+            self.save()
+
+    def reserve(self, track_id):
+        """Reserves a track to download, waiting while another thread or process has it.
+
+        Returns True if it had to wait: the track may be downloaded by now,
+        and the archive has been reloaded to tell.
+        """
+        waited = False
+        with self._reserved_cond:
+            while track_id in self._reserved:
+                waited = True
+                self._reserved_cond.wait()
+            self._reserved.add(track_id)
+        try:
+            self.reservations.mkdir(parents=True, exist_ok=True)
+            while not self._claim(track_id):
+                waited = True
+                time.sleep(RESERVATION_POLL)
+        except BaseException:
+            with self._reserved_cond:
+                self._reserved.discard(track_id)
+                self._reserved_cond.notify_all()
+            raise
+        if waited:
+            self.refresh()
+        return waited
+
+    def release(self, track_id):
+        with self._reserved_cond:
+            self._claimed.discard(track_id)
+        (self.reservations / track_id).unlink(missing_ok=True)
+        with self._reserved_cond:
+            self._reserved.discard(track_id)
+            self._reserved_cond.notify_all()
+
+    def _claim(self, track_id):
+        path = self.reservations / track_id
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            inode = self._abandoned(path)
+            if inode is not None:
+                try:
+                    # Not if another waiter took it over and claimed it meanwhile
+                    if path.stat().st_ino == inode:
+                        path.unlink()
+                except OSError:
+                    pass
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self._owner)
+        with self._reserved_cond:
+            self._claimed.add(track_id)
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(
+                    target=self._keep_reservations, name="zspotify-reservations", daemon=True
+                )
+                self._heartbeat.start()
+        return True
+
+    def _keep_reservations(self):
+        """Touches the reservations of this process, so others see it is alive"""
+        while not self._closed.wait(RESERVATION_HEARTBEAT):
+            with self._reserved_cond:
+                claimed = list(self._claimed)
+            for track_id in claimed:
+                try:
+                    os.utime(self.reservations / track_id)
+                except OSError:
+                    pass
+
+    def _abandoned(self, path):
+        """Returns the inode of a reservation left by a crashed run, None if it is alive"""
+        try:
+            owner = path.read_text()
+            stat = path.stat()
+        except OSError:
+            return None
+        host, _, pid = owner.partition("+")
+        if host == socket.gethostname() and pid.isdigit() and os.name != "nt":
+            # This process only gets here for tracks no thread of it holds
+            abandoned = int(pid) == os.getpid() or not process_running(int(pid))
+        else:
+            abandoned = time.time() - stat.st_mtime > RESERVATION_STALE
+        return stat.st_ino if abandoned else None
+
     def get(self, track_id):
         return self.data.get(track_id)
 
     def remove(self, track_id):
-        self.data.pop(track_id)
+        with self._lock:
+            self._unindex(track_id)
+            self.data.pop(track_id)
+            self._dirty[track_id] = None
         self.save()
 
     def exists(self, track_id):
+        """Checks the archive, picking up entries saved by other processes"""
+        if track_id in self.data:
+            return True
+        self.refresh()
         return track_id in self.data
 
     def get_all(self):
         return self.data
 
-    def get_ids_from_old_archive(self, old_archive_file):
-        archive = []
+    def _build_indexes(self):
+        """Builds the secondary indexes used by query()"""
+        self._by_path = {}
+        self._by_artist = {}
+        self._by_type = {}
+        self._by_time = []
+        for track_id, entry in self.data.items():
+            for fullpath in self._entry_paths(entry):
+                self._by_path[fullpath] = track_id
+            for artist in self._split_artists(entry.get("artist")):
+                self._by_artist.setdefault(artist, set()).add(track_id)
+            self._by_type.setdefault(entry.get("audio_type"), set()).add(track_id)
+            self._by_time.append((entry.get("timestamp") or "", track_id))
+        self._paths = sorted(p for p in self._by_path if p)
+        self._by_time.sort()
+
+    def _index(self, track_id, entry):
+        for fullpath in self._entry_paths(entry):
+            if fullpath not in self._by_path:
+                insort(self._paths, fullpath)
+            self._by_path[fullpath] = track_id
+        for artist in self._split_artists(entry.get("artist")):
+            self._by_artist.setdefault(artist, set()).add(track_id)
+        self._by_type.setdefault(entry.get("audio_type"), set()).add(track_id)
+        insort(self._by_time, (entry.get("timestamp") or "", track_id))
+
+    def _unindex(self, track_id):
+        entry = self.data.get(track_id)
+        if entry is None:
+            return
+        for fullpath in self._entry_paths(entry):
+            if self._by_path.get(fullpath) == track_id:
+                del self._by_path[fullpath]
+                i = bisect_left(self._paths, fullpath)
+                if i < len(self._paths) and self._paths[i] == fullpath:
+                    del self._paths[i]
+        for artist in self._split_artists(entry.get("artist")):
+            ids = self._by_artist.get(artist)
+            if ids is not None:
+                ids.discard(track_id)
+                if not ids:
+                    del self._by_artist[artist]
+        ids = self._by_type.get(entry.get("audio_type"))
+        if ids is not None:
+            ids.discard(track_id)
+            if not ids:
+                del self._by_type[entry.get("audio_type")]
+        key = (entry.get("timestamp") or "", track_id)
+        i = bisect_left(self._by_time, key)
+        if i < len(self._by_time) and self._by_time[i] == key:
+            del self._by_time[i]
+
+    @staticmethod
+    def _entry_paths(entry):
+        """Returns the primary fullpath and every other location of an entry"""
+        if not entry:
+            return []
+        paths = [entry["fullpath"]] if entry.get("fullpath") else []
+        return paths + entry.get("locations", [])
+
+    @staticmethod
+    def _split_artists(artist):
+        if not artist:
+            return []
+        return [a.strip().lower() for a in artist.split(",") if a.strip()]
+
+    @staticmethod
+    def _parse_date(value):
+        """Returns the date of a YYYY-MM-DD string, None for anything else"""
+        if len(value) != 10:
+            return None
+        try:
+            return datetime.date.fromisoformat(value)
+        except ValueError:
+            return None
+
+    def get_by_path(self, fullpath):
+        return self._by_path.get(str(fullpath))
+
+    def query(self, artist=None, audio_type=None, directory=None, since=None,
+              until=None, missing=False):
+        """Returns the (track_id, entry) pairs matching every given filter"""
+        candidates = None
+
+        def narrow(ids):
+            nonlocal candidates
+            candidates = set(ids) if candidates is None else candidates & set(ids)
+
+        if artist:
+            narrow(self._by_artist.get(artist.strip().lower(), ()))
+        if audio_type:
+            narrow(self._by_type.get(audio_type, ()))
+        if directory:
+            prefix = os.path.join(str(directory), "")
+            start = bisect_left(self._paths, prefix)
+            ids = []
+            for fullpath in self._paths[start:]:
+                if not fullpath.startswith(prefix):
+                    break
+                ids.append(self._by_path[fullpath])
+            narrow(ids)
+        if since or until:
+            start = bisect_left(self._by_time, (since, "")) if since else 0
+            end = len(self._by_time)
+            if until:
+                # "\uffff" sorts after any track id sharing the same timestamp
+                end = bisect_left(self._by_time, (until, "\uffff"))
+                day = self._parse_date(until)
+                if day:
+                    # A date alone takes in that whole day, up to the next one
+                    next_day = (day + datetime.timedelta(days=1)).isoformat()
+                    end = bisect_left(self._by_time, (next_day, ""))
+            narrow(track_id for _, track_id in self._by_time[start:end])
+
+        if candidates is None:
+            candidates = self.data.keys()
+        results = [(track_id, self.data[track_id]) for track_id in candidates]
+        if missing:
+            results = [
+                (track_id, entry) for track_id, entry in results
+                if not os.path.exists(entry.get("fullpath") or "")
+            ]
+        results.sort(key=lambda item: item[1].get("fullpath") or "")
+        return results
+
+    @staticmethod
+    def export(results, fmt, f):
+        """Writes query results to a file object as csv or jsonl"""
+        fields = [
+            "track_id", "artist", "track_name", "audio_type", "fullpath", "timestamp", "locations"
+        ]
+        if fmt == "csv":
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+            writer.writeheader()
+            for track_id, entry in results:
+                writer.writerow({
+                    "track_id": track_id,
+                    **entry,
+                    "locations": ";".join(entry.get("locations", [])),
+                })
+        elif fmt == "jsonl":
+            for track_id, entry in results:
+                f.write(json.dumps({"track_id": track_id, **entry}) + "\n")
+        else:
+            raise ValueError(f"Unknown export format: {fmt}")
+
+    def add_many(self, tracks, save=True):
+        """Adds many entries at once, saving the archive a single time"""
+        count = 0
+        with self._lock:
+            for track_id, entry in tracks:
+                self._unindex(track_id)
+                entry["fullpath"] = str(entry.get("fullpath"))
+                self.data[track_id] = entry
+                self._dirty[track_id] = entry
+                self._index(track_id, entry)
+                count += 1
+        if save and count:
+            self.save()
+        return count
+
+    def get_ids_from_old_archive(self, old_archive_file, batch_size=MIGRATION_BATCH_SIZE):
+        """Streams the entries of a legacy archive whose file still exists"""
         folder = old_archive_file.parent
-        with open(old_archive_file, "r", encoding="utf-8") as f:
-            for line in f.readlines():
-                song = line.split("\t")
-                try:
-                    track_id, timestamp, artist, track_name, file_name = song
-                    fullpath = folder / file_name
-                    if fullpath.exists():
-                        archive.append({
-                            "track_id": track_id,
-                            "track_artist": artist,
-                            "track_name": track_name,
-                            "timestamp": timestamp,
-                            "fullpath": str(fullpath)
-                        })
-                except ValueError:
-                    print(f"Error parsing line: {line}")
-
-        return archive
+        with open(old_archive_file, "r", encoding="utf-8") as f, \
+                ThreadPoolExecutor(max_workers=MIGRATION_WORKERS) as pool:
+            while lines := list(islice(f, batch_size)):
+                batch = self._parse_old_archive_lines(lines, folder)
+                exists = pool.map(os.path.exists, [track["fullpath"] for track in batch])
+                for track, found in zip(batch, exists):
+                    if found:
+                        yield track
+
+    @staticmethod
+    def _parse_old_archive_lines(lines, folder):
+        tracks = []
+        for line in lines:
+            song = line.rstrip("\r\n").split("\t")
+            try:
+                track_id, timestamp, artist, track_name, file_name = song
+                tracks.append({
+                    "track_id": track_id,
+                    "track_artist": artist,
+                    "track_name": track_name,
+                    "timestamp": timestamp,
+                    "fullpath": str(folder / file_name)
+                })
+            except ValueError:
+                print(f"Error parsing line: {line}")
+        return tracks
 
     def archive_migration(self, paths_to_check):
         """Migrates the old archive to the new one"""
+        migrated = self._load_migrated()
         for path in paths_to_check:
             old_archive_path = path / ".song_archive"
-            if old_archive_path.exists():
-                print("Found old archive, migrating to new one...")
-                self._migrate_tracks_from_old_to_new_archive(old_archive_path)
-                self._remove_old_archive(old_archive_path)
+            try:
+                stat = old_archive_path.stat()
+            except OSError:
+                continue
+            key = str(old_archive_path.absolute())
+            marker = [stat.st_size, stat.st_mtime_ns]
+            if migrated.get(key) == marker:
+                continue
+            print("Found old archive, migrating to new one...")
+            self._migrate_tracks_from_old_to_new_archive(old_archive_path)
+            migrated[key] = marker
+            self._save_migrated(migrated)
+            self._remove_old_archive(old_archive_path)
 
     def _migrate_tracks_from_old_to_new_archive(self, old_archive_path):
-        tracks = self.get_ids_from_old_archive(old_archive_path)
-        for track in tracks:
-            if self.exists(track['track_id']):
-                print(f"Skipping {track['track_name']} - Already in archive")
-                continue
-            self.add(track['track_id'],
-                     artist=track['track_artist'],
-                     track_name=track['track_name'],
-                     fullpath=track['fullpath'],
-                     timestamp=track['timestamp'],
-                     audio_type="music",
-                     save=False)
-        self.save()
-        print(f"Migration complete from: {old_archive_path}")
+        tracks = (
+            (track["track_id"], {
+                "artist": track["track_artist"],
+                "track_name": track["track_name"],
+                "audio_type": "music",
+                "fullpath": track["fullpath"],
+                "timestamp": track["timestamp"],
+            })
+            for track in self.get_ids_from_old_archive(old_archive_path)
+            if not self.exists(track["track_id"])
+        )
+        count = self.add_many(tracks)
+        print(f"Migration complete from: {old_archive_path} ({count} tracks added)")
+
+    def _migrated_file(self):
+        return self.file.with_name(self.file.name + ".migrated")
+
+    def _load_migrated(self):
+        try:
+            with open(self._migrated_file(), "r") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def _save_migrated(self, migrated):
+        with open(self._migrated_file(), "w") as f:
+            json.dump(migrated, f, indent=4)
 
     def _remove_old_archive(self, old_archive_path):
         try:
@@ -105,6 +624,76 @@ class Archive:
             print(f"Unable to remove old archive: {old_archive_path}. Reason: {e}")
 
 
+class SyncState:
+    """Per-collection state of the last incremental sync, saved as json"""
+
+    def __init__(self, file):
+        self.file = file
+        self._lock = threading.RLock()
+        self.data = self.load()
+
+    def load(self):
+        if self.file.exists():
+            with open(self.file, "r") as f:
+                try:
+                    return json.load(f)
+                except json.JSONDecodeError as e:
+                    print(f"Error loading sync state: {e}")
+        return {}
+
+    def save(self):
+        with self._lock:
+            tmp_file = f"{self.file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(self.data, f)
+            os.replace(tmp_file, self.file)
+
+    def get(self, kind, key):
+        return self.data.get(kind, {}).get(key)
+
+    def set(self, kind, key, value):
+        with self._lock:
+            self.data.setdefault(kind, {})[key] = value
+            self.save()
+
+
+class FileIndex:
+    """In-memory set of existing filenames, one os.scandir pass per directory"""
+
+    def __init__(self):
+        self._dirs = {}
+
+    def _names(self, directory):
+        key = str(directory)
+        names = self._dirs.get(key)
+        if names is None:
+            names = set()
+            try:
+                with os.scandir(key) as it:
+                    for entry in it:
+                        names.add(entry.name)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            self._dirs[key] = names
+        return names
+
+    def exists(self, path):
+        return path.name in self._names(path.parent)
+
+    def add(self, path):
+        self._names(path.parent).add(path.name)
+
+    def discard(self, path):
+        self._names(path.parent).discard(path.name)
+
+    def forget(self, directory):
+        """Scans directory again on the next lookup"""
+        self._dirs.pop(str(directory), None)
+
+    def clear(self):
+        self._dirs.clear()
+
+
 class FormatUtils:
     """Utility class for string formatting and sanitization."""
 
@@ -121,3 +710,20 @@ class FormatUtils:
             value = value.replace(char, "" if char != "|" else "-")
         return value
 
+    @staticmethod
+    def format_size(num_bytes):
+        """Returns a byte count as a human readable size, e.g. 1.5 GB"""
+        size = float(num_bytes)
+        for unit in ("B", "KB", "MB", "GB"):
+            if abs(size) < 1024:
+                return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+            size /= 1024
+        return f"{size:.1f} TB"
+
+    @staticmethod
+    def format_duration(seconds):
+        """Returns seconds as hours and minutes, e.g. 2h 05m"""
+        minutes = int(seconds) // 60
+        if minutes < 60:
+            return f"{minutes}m {int(seconds) % 60:02d}s"
+        return f"{minutes // 60}h {minutes % 60:02d}m"
@@ -0,0 +1,154 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+
+AUDIO_EXTENSIONS = (".mp3", ".ogg", ".flac", ".wav")
+
+
+class LibraryVerifier:
+    """Reconciles the archive with the files in the library directories"""
+
+    HASH_CHUNK_SIZE = 1 << 20
+
+    def __init__(self, archive, library_dirs, workers=16, hash_files=False):
+        self.archive = archive
+        self.library_dirs = [Path(d) for d in library_dirs]
+        self.workers = workers
+        self.hash_files = hash_files
+
+    def run(self):
+        """Checks every archived file, each location of a track on its own, and looks for orphaned ones"""
+        entries = self.archive.get_all()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            files = [
+                (track_id, entry, fullpath)
+                for track_id, entry in entries.items()
+                for fullpath in [entry.get("fullpath") or ""] + entry.get("locations", [])
+            ]
+            known = {
+                os.path.normcase(os.path.abspath(fullpath)) for _, _, fullpath in files if fullpath
+            }
+
+            checks = pool.map(
+                self.check_file, [fullpath for _, _, fullpath in files], chunksize=64
+            )
+            missing, corrupt, ok = [], [], []
+            for (track_id, entry, _), result in zip(files, checks):
+                record = {"track_id": track_id, "audio_type": entry.get("audio_type"), **result}
+                if result["status"] == "missing":
+                    missing.append(record)
+                elif result["status"] == "corrupt":
+                    corrupt.append(record)
+                else:
+                    ok.append(record)
+
+            orphaned = [
+                {"fullpath": path}
+                for path in self.walk(pool)
+                if os.path.normcase(os.path.abspath(path)) not in known
+            ]
+
+        return {
+            "checked": len(files),
+            "ok": len(ok),
+            "missing": missing,
+            "corrupt": corrupt,
+            "orphaned": orphaned,
+        }
+
+    def check_file(self, fullpath):
+        """Stats, optionally hashes and parses a single file"""
+        result = {"fullpath": fullpath}
+        try:
+            size = os.stat(fullpath).st_size
+        except OSError:
+            result["status"] = "missing"
+            return result
+
+        result["size"] = size
+        if size == 0:
+            result["status"] = "corrupt"
+            result["reason"] = "empty file"
+            return result
+
+        if self.hash_files:
+            result["sha256"] = self.hash_file(fullpath)
+
+        reason = self.parse_error(fullpath)
+        if reason:
+            result["status"] = "corrupt"
+            result["reason"] = reason
+        else:
+            result["status"] = "ok"
+        return result
+
+    def hash_file(self, fullpath):
+        digest = hashlib.sha256()
+        with open(fullpath, "rb") as f:
+            while chunk := f.read(self.HASH_CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def parse_error(fullpath):
+        """Returns why the file does not parse as audio, or None"""
+        import mutagen
+
+        try:
+            audio = mutagen.File(fullpath)
+        except Exception as e:
+            return str(e) or type(e).__name__
+        if audio is None:
+            return "unknown audio format"
+        if not getattr(audio.info, "length", 0):
+            return "no audio frames"
+        return None
+
+    def walk(self, pool):
+        """Lists the audio files under the library directories in parallel"""
+        roots = sorted({d.absolute() for d in self.library_dirs})
+        # Nested roots (the default episodes dir is inside the music dir) are walked once
+        roots = [d for d in roots if not any(r in d.parents for r in roots)]
+        pending = {pool.submit(self._scan_dir, d) for d in roots}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                yield from files
+                pending.update(pool.submit(self._scan_dir, d) for d in subdirs)
+
+    @staticmethod
+    def _scan_dir(directory):
+        files, subdirs = [], []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        # Hidden folders such as the content store are not collections
+                        if not entry.name.startswith("."):
+                            subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                        files.append(entry.path)
+        except OSError:
+            pass
+        return files, subdirs
+
+    @staticmethod
+    def write_report(report, report_file):
+        with open(report_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+    @staticmethod
+    def write_requeue(report, requeue_file):
+        """Writes the urls of missing and corrupt entries, usable with --bulk-download"""
+        urls = {}
+        for record in report["missing"] + report["corrupt"]:
+            kind = "episode" if record.get("audio_type") == "episode" else "track"
+            # A track with several bad locations is downloaded once
+            urls.setdefault(f"https://open.spotify.com/{kind}/{record['track_id']}", None)
+        with open(requeue_file, "w", encoding="utf-8") as f:
+            for url in urls:
+                f.write(url + "\n")